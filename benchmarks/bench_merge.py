@@ -0,0 +1,78 @@
+"""
+Compare merging language pairs of a movie by paths, when both subtitles are parsed for every pair,
+with parsing every subtitle once and merging the loaded files.
+Run from the repository root: python -m benchmarks.bench_merge
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+import mergesubs
+
+_LANGUAGES = ['ru', 'en', 'fr', 'de', 'es', 'it', 'pt', 'nl', 'pl']
+
+
+def _write_srt(path: str, lines: int, text: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            start = i * 3
+            f.write(f"{i + 1}\n00:{start // 60 % 60:02}:{start % 60:02},000 --> 00:{start // 60 % 60:02}:"
+                    f"{start % 60:02},900\n{text} {i}\n\n")
+
+
+def _pairs(tmp_dir: str, pairs: int) -> List[tuple]:
+    top = os.path.join(tmp_dir, f"movie.{_LANGUAGES[0]}.srt")
+    return [(top, os.path.join(tmp_dir, f"movie.{lang}.srt"), os.path.join(tmp_dir, f"movie.ru_{lang}.ass"))
+            for lang in _LANGUAGES[1:pairs + 1]]
+
+
+def _merge_by_paths(tmp_dir: str, pairs: int) -> float:
+    mergesubs._detect_encoding.cache_clear()
+    start = time.perf_counter()
+    for top, bot, out in _pairs(tmp_dir, pairs):
+        mergesubs.merge(top, bot, out)
+    return time.perf_counter() - start
+
+
+def _merge_loaded(tmp_dir: str, pairs: int) -> float:
+    mergesubs._detect_encoding.cache_clear()
+    start = time.perf_counter()
+    loaded = {}
+    for top, bot, out in _pairs(tmp_dir, pairs):
+        for path in (top, bot):
+            if path not in loaded:
+                loaded[path] = mergesubs.load(path)
+        mergesubs.merge_loaded(loaded[top], loaded[bot]).save(out)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=2000, help='count of lines in every subtitle')
+    parser.add_argument('--max-pairs', type=int, default=len(_LANGUAGES) - 1)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for lang in _LANGUAGES:
+            _write_srt(os.path.join(tmp_dir, f"movie.{lang}.srt"), args.lines, f"Субтитр {lang}")
+        results = []
+        pairs = 1
+        while pairs <= min(args.max_pairs, len(_LANGUAGES) - 1):
+            results.append({
+                'pairs': pairs,
+                'merge_by_paths_seconds': _merge_by_paths(tmp_dir, pairs),
+                'merge_loaded_seconds': _merge_loaded(tmp_dir, pairs),
+            })
+            pairs *= 2
+        print(json.dumps({'lines': args.lines, 'results': results}, indent=4))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
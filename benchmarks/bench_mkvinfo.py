@@ -0,0 +1,51 @@
+"""
+Compare reading track info natively with spawning `mkvmerge -J`.
+Run from the repository root: python -m benchmarks.bench_mkvinfo
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from typing import Callable, List
+
+from benchmarks.samples import make_mkv_library
+from extract_mkv_info import parse_mkvinfo_from_file, parse_mkvinfo_from_file_with_mkvmerge
+
+_SUBTITLE_TRACKS = [
+    ('S_TEXT/UTF8', 'rus', 'ru', 'Forced'),
+    ('S_TEXT/UTF8', 'rus', 'ru', None),
+    ('S_TEXT/ASS', 'eng', 'en', 'SDH'),
+    ('S_HDMV/PGS', 'fre', 'fr', None),
+]
+
+
+def _time_per_file(parse: Callable, paths: List[str]) -> float:
+    start = time.perf_counter()
+    for path in paths:
+        parse(path)
+    return (time.perf_counter() - start) / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--media-size-mb', type=int, default=64, help='size of the sparse media data of every file')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = make_mkv_library(tmp_dir, args.files, _SUBTITLE_TRACKS, args.media_size_mb * 1024 * 1024)
+        result = {
+            'files': args.files,
+            'native_ms_per_file': _time_per_file(parse_mkvinfo_from_file, paths) * 1000,
+        }
+        if shutil.which('mkvmerge'):
+            result['mkvmerge_ms_per_file'] = _time_per_file(parse_mkvinfo_from_file_with_mkvmerge, paths) * 1000
+        print(json.dumps(result, indent=4))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
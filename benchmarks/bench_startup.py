@@ -0,0 +1,58 @@
+"""
+Measure the cold start of extract_subs.py: import time of the module and the wall time of a run with nothing to do.
+Run from the repository root: python -m benchmarks.bench_startup
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+_REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_time_ms() -> float:
+    # the last line of -X importtime is the module itself: "import time: self | cumulative | name"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import extract_subs'],
+                            cwd=_REPOSITORY_ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True)
+    last_line = result.stderr.decode('utf-8').strip().splitlines()[-1]
+    return int(last_line.split('|')[1]) / 1000
+
+
+def _noop_run_ms(library_dir: str, db_file: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(_REPOSITORY_ROOT, 'extract_subs.py'), library_dir,
+                    '--db-file', db_file, '--no-download-subtitles-online'],
+                   cwd=_REPOSITORY_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-noop-ms', type=float, help='fail if the median no-op run is slower')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        library_dir = os.path.join(tmp_dir, 'library')
+        os.makedirs(library_dir)
+        db_file = os.path.join(tmp_dir, 'db.sqlite3')
+        result = {
+            'import_ms': statistics.median(_import_time_ms() for _ in range(args.runs)),
+            'noop_run_ms': statistics.median(_noop_run_ms(library_dir, db_file) for _ in range(args.runs)),
+        }
+        print(json.dumps(result, indent=4))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if args.max_noop_ms is not None and result['noop_run_ms'] > args.max_noop_ms:
+        sys.exit(f"No-op run takes {result['noop_run_ms']:.0f} ms, more than {args.max_noop_ms:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare saving subtitle rows one insert per transaction with the batched save_scan_results.
+Run from the repository root: python -m benchmarks.bench_storage
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from storage import Storage, VideoFileScanRecord, VideoSubtitleRecord
+
+_SUBTITLES_PER_FILE = 10
+
+
+def _scans(rows: int):
+    for i in range(rows // _SUBTITLES_PER_FILE):
+        yield VideoFileScanRecord(f"/movies/movie_{i}", f"movie_{i}.mkv", None,
+                                  [VideoSubtitleRecord(f"/movies/movie_{i}/movie_{i}_{track}.srt", 'eng', track, 'FILE')
+                                   for track in range(_SUBTITLES_PER_FILE)])
+
+
+def _old_path(db_file: str, rows: int) -> float:
+    # the rollback journal with synchronous=FULL of the old path fsyncs every insert
+    with Storage(db_file, wal=False) as storage:
+        start = time.perf_counter()
+        for scan in _scans(rows):
+            video_file = storage.create_video_file(scan.dir, scan.filename)
+            for subtitle in scan.subtitles:
+                storage.create_video_subtitle(video_file['id'], subtitle.full_path, subtitle.language_iso639_3,
+                                              subtitle.track_id, subtitle.source)
+        return time.perf_counter() - start
+
+
+def _bulk_path(db_file: str, rows: int, commit_every: int) -> float:
+    with Storage(db_file) as storage:
+        start = time.perf_counter()
+        with storage.bulk_session(commit_every=commit_every):
+            for scan in _scans(rows):
+                storage.save_scan_results([scan])
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000, help='count of subtitle rows to insert')
+    parser.add_argument('--commit-every', type=int, default=100)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        result = {
+            'rows': args.rows,
+            'old_path_seconds': _old_path(os.path.join(tmp_dir, 'old.sqlite3'), args.rows),
+            'bulk_path_seconds': _bulk_path(os.path.join(tmp_dir, 'bulk.sqlite3'), args.rows, args.commit_every),
+        }
+        print(json.dumps(result, indent=4))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
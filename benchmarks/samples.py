@@ -0,0 +1,167 @@
+"""
+Generators of synthetic sample files for benchmarks
+"""
+import os
+import random
+import shutil
+import subprocess
+from typing import List, Optional, Tuple
+
+# (codec id, language, language ietf, track name)
+SubtitleTrack = Tuple[str, str, str, str]
+
+
+def _vint_size(size: int) -> bytes:
+    length = 1
+    while size >= (1 << (7 * length)) - 1:
+        length += 1
+    return ((1 << (7 * length)) | size).to_bytes(length, 'big')
+
+
+def ebml_element(element_id: int, payload: bytes) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + _vint_size(len(payload)) + payload
+
+
+def _uint(element_id: int, value: int) -> bytes:
+    return ebml_element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+
+def _str(element_id: int, value: str) -> bytes:
+    return ebml_element(element_id, value.encode('utf-8'))
+
+
+def _track_entry(number: int, track_type: int, codec_id: str, language: str = None, language_ietf: str = None,
+                 name: str = None) -> bytes:
+    payload = _uint(0xD7, number) + _uint(0x73C5, number * 7919) + _uint(0x83, track_type) + _str(0x86, codec_id)
+    if language:
+        payload += _str(0x22B59C, language)
+    if language_ietf:
+        payload += _str(0x22B59D, language_ietf)
+    if name:
+        payload += _str(0x536E, name)
+    return ebml_element(0xAE, payload)
+
+
+def make_mkv(file_path: str, subtitle_tracks: List[SubtitleTrack], media_size: int = 0):
+    """
+    Write a minimal Matroska file: EBML header, SeekHead, Tracks with a video, an audio and
+    the given subtitle tracks, followed by a Cluster of media_size zero bytes
+    """
+    header = ebml_element(0x1A45DFA3, _uint(0x4286, 1) + _str(0x4282, 'matroska') + _uint(0x4287, 4))
+    tracks = _track_entry(1, 1, 'V_MPEG4/ISO/AVC', 'und') + _track_entry(2, 2, 'A_AAC', 'eng', 'en')
+    for index, (codec_id, language, language_ietf, name) in enumerate(subtitle_tracks):
+        tracks += _track_entry(index + 3, 0x11, codec_id, language, language_ietf, name)
+    tracks = ebml_element(0x1654AE6B, tracks)
+
+    def seek_head(tracks_position: int) -> bytes:
+        seek = ebml_element(0x53AB, (0x1654AE6B).to_bytes(4, 'big')) + \
+               ebml_element(0x53AC, tracks_position.to_bytes(8, 'big'))
+        return ebml_element(0x114D9B74, ebml_element(0x4DBB, seek))
+
+    # the Void element imitates the space muxers reserve for the Cues and Tags entries of the SeekHead
+    void = ebml_element(0xEC, bytes(256))
+    segment_payload = seek_head(len(seek_head(0)) + len(void)) + void + tracks
+    cluster_header = bytes.fromhex('1F43B675') + _vint_size(media_size)
+    segment_size = len(segment_payload) + len(cluster_header) + media_size
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(bytes.fromhex('18538067') + _vint_size(segment_size))
+        f.write(segment_payload)
+        f.write(cluster_header)
+        if media_size:
+            f.truncate(f.tell() + media_size)
+
+
+def make_mkv_library(root: str, files_count: int, subtitle_tracks: List[SubtitleTrack],
+                     media_size: int = 0) -> List[str]:
+    paths = []
+    for i in range(files_count):
+        file_dir = os.path.join(root, f"movie_{i}")
+        os.makedirs(file_dir, exist_ok=True)
+        path = os.path.join(file_dir, f"movie_{i}.mkv")
+        make_mkv(path, subtitle_tracks, media_size)
+        paths.append(path)
+    return paths
+
+
+_SUBTITLE_TEXTS = {
+    'rus': "Привет, как дела? Всё хорошо, спасибо.",
+    'eng': "Hello, how are you? I'm fine, thank you.",
+    'fre': "Bonjour, comment ça va ? Très bien, merci.",
+}
+_ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, \
+Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, \
+MarginV, Encoding
+Style: Default,Arial,20,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,2,2,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+def _time(seconds: int, separator: str) -> str:
+    return f"{seconds // 3600:02}:{seconds // 60 % 60:02}:{seconds % 60:02}{separator}"
+
+
+def make_srt(file_path: str, lines: int, language: str = 'eng', encoding: str = 'utf-8'):
+    with open(file_path, 'w', encoding=encoding) as f:
+        for i in range(lines):
+            f.write(f"{i + 1}\n{_time(i * 3, ',')}000 --> {_time(i * 3 + 2, ',')}500\n"
+                    f"{_SUBTITLE_TEXTS[language]} {i}\n\n")
+
+
+def make_ass(file_path: str, lines: int, language: str = 'eng', encoding: str = 'utf-8'):
+    with open(file_path, 'w', encoding=encoding) as f:
+        f.write(_ASS_HEADER)
+        for i in range(lines):
+            f.write(f"Dialogue: 0,{_time(i * 3, '.')[1:]}00,{_time(i * 3 + 2, '.')[1:]}50,Default,,0,0,0,,"
+                    f"{_SUBTITLE_TEXTS[language]} {i}\n")
+
+
+# (language, encoding) of subtitles generated for a movie, cp1251 is still common for russian subtitles
+SUBTITLE_VARIANTS = [('rus', 'cp1251'), ('rus', 'utf-8'), ('eng', 'utf-8'), ('fre', 'utf-8'), ('fre', 'utf-16')]
+
+
+def make_subtitle_library(root: str, dirs_count: int, lines_range: Tuple[int, int], seed: int = 0,
+                          subtitles_per_dir: int = 2) -> List[List[str]]:
+    """
+    Write srt and ass subtitles of random size and encoding next to every movie directory movie_<i>,
+    the same seed gives the same library
+    :return: subtitle paths of every directory
+    """
+    rnd = random.Random(seed)
+    library = []
+    for i in range(dirs_count):
+        file_dir = os.path.join(root, f"movie_{i}")
+        os.makedirs(file_dir, exist_ok=True)
+        paths = []
+        for language, encoding in rnd.sample(SUBTITLE_VARIANTS, subtitles_per_dir):
+            lines = rnd.randint(*lines_range)
+            extension = rnd.choice(['.srt', '.ass'])
+            path = os.path.join(file_dir, f"movie_{i}_{language}_{encoding}{extension}")
+            (make_srt if extension == '.srt' else make_ass)(path, lines, language, encoding)
+            paths.append(path)
+        library.append(paths)
+    return library
+
+
+def make_real_mkv(file_path: str, subtitle_paths: List[Tuple[str, str]]) -> Optional[str]:
+    """
+    Mux subtitle files into a Matroska file with mkvmerge
+    :param subtitle_paths: list of (subtitle path, language)
+    :return: None if mkvtoolnix isn't installed
+    """
+    if not shutil.which('mkvmerge'):
+        return None
+    command = ['mkvmerge', '-q', '-o', file_path]
+    for subtitle_path, language in subtitle_paths:
+        command += ['--language', f"0:{language}", subtitle_path]
+    # https://mkvtoolnix.download/doc/mkvmerge.html#mkvmerge.exit_codes, 1 - warnings
+    result = subprocess.run(command, stdout=subprocess.DEVNULL)
+    if result.returncode not in [0, 1]:
+        raise RuntimeError(f"mkvmerge exit code {result.returncode}")
+    return file_path
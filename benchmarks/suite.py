@@ -0,0 +1,198 @@
+"""
+Reproducible benchmark suite on a synthetic library: walking with _scrap_files_to_scan, parse_mkvinfo,
+Storage inserts and lookups and mergesubs.merge. Runs offline, real MKV files are muxed only if mkvtoolnix is installed.
+The JSON report contains the commit, so reports of two commits can be compared.
+Run from the repository root: python -m benchmarks.suite --output report.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+import mergesubs
+from benchmarks.samples import make_mkv_library, make_real_mkv, make_subtitle_library
+from extract_mkv_info import parse_mkvinfo, parse_mkvinfo_from_file, parse_mkvinfo_from_file_with_mkvmerge
+from extract_subs import AppRunConfig, ExtractSubs
+from mkv_ebml import read_tracks
+from storage import Storage, VideoFileScanRecord, VideoSubtitleRecord
+from util import file_fingerprint
+
+_REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SUBTITLE_TRACKS = [
+    ('S_TEXT/UTF8', 'rus', 'ru', 'Forced'),
+    ('S_TEXT/UTF8', 'rus', 'ru', None),
+    ('S_TEXT/ASS', 'eng', 'en', 'SDH'),
+    ('S_TEXT/UTF8', 'fre', 'fr', None),
+    ('S_HDMV/PGS', 'ger', 'de', None),
+]
+
+
+def _measure(fn: Callable, repeat: int, per: int = 1) -> dict:
+    """
+    :param per: count of operations of one fn call, times are reported per operation
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) / per)
+    return {'median_ms': statistics.median(times) * 1000, 'min_ms': min(times) * 1000, 'repeat': repeat,
+            'operations': per}
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=_REPOSITORY_ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _scan_record(path: str) -> VideoFileScanRecord:
+    file_dir, filename = os.path.split(path)
+    basename = os.path.splitext(filename)[0]
+    return VideoFileScanRecord(file_dir, filename, file_fingerprint(path),
+                               [VideoSubtitleRecord(os.path.join(file_dir, f"{basename}_{track}.srt"), 'eng', track,
+                                                    'FILE', codec_id='S_TEXT/UTF8') for track in range(3, 8)])
+
+
+def _bench_walk(tmp_dir: str, mkv_paths: list, repeat: int) -> dict:
+    """
+    Half of the library is scanned, the other half is new
+    """
+    with Storage(os.path.join(tmp_dir, 'walk.sqlite3')) as storage:
+        storage.save_scan_results([_scan_record(path) for path in mkv_paths[::2]])
+        extract_subs = ExtractSubs(AppRunConfig(os.path.join(tmp_dir, 'library'), [], [], '.*', {}, False), storage)
+        result = _measure(extract_subs._scrap_files_to_scan, repeat)
+        result['files_to_scan'] = len(extract_subs._scrap_files_to_scan())
+        return result
+
+
+def _bench_mkvinfo(tmp_dir: str, mkv_paths: list, subtitle_library: list, repeat: int) -> dict:
+    mkvmerge_json = json.dumps({'tracks': read_tracks(mkv_paths[0])})
+    result = {
+        'parse_mkvinfo_from_file': _measure(lambda: [parse_mkvinfo_from_file(path) for path in mkv_paths], repeat,
+                                            len(mkv_paths)),
+        'parse_mkvinfo_json': _measure(lambda: [parse_mkvinfo(mkvmerge_json) for _ in range(1000)], repeat, 1000),
+    }
+    real_mkv = make_real_mkv(os.path.join(tmp_dir, 'real.mkv'),
+                             [(path, 'und') for subtitles in subtitle_library[:3] for path in subtitles])
+    if real_mkv:
+        result['parse_real_mkv_native'] = _measure(lambda: parse_mkvinfo_from_file(real_mkv), repeat)
+        result['parse_real_mkv_mkvmerge'] = _measure(lambda: parse_mkvinfo_from_file_with_mkvmerge(real_mkv), repeat)
+    return result
+
+
+def _bench_storage(tmp_dir: str, mkv_paths: list, repeat: int) -> dict:
+    records = [_scan_record(path) for path in mkv_paths]
+    rnd = random.Random(0)
+    lookups = [rnd.choice(mkv_paths) for _ in range(1000)]
+    db_files = iter(os.path.join(tmp_dir, f"storage_{i}.sqlite3") for i in range(repeat))
+
+    def insert():
+        with Storage(next(db_files)) as storage, storage.bulk_session():
+            for record in records:
+                storage.save_scan_results([record])
+
+    result = {'save_scan_results': _measure(insert, repeat, len(records))}
+    with Storage(os.path.join(tmp_dir, 'storage_0.sqlite3')) as storage:
+        result['get_video_file_by_full_path'] = _measure(
+            lambda: [storage.get_video_file_by_full_path(path) for path in lookups], repeat, len(lookups))
+        result['get_scanned_fingerprints'] = _measure(storage.get_scanned_fingerprints, repeat)
+    return result
+
+
+def _bench_merge(tmp_dir: str, subtitle_library: list, repeat: int) -> dict:
+    out_path = os.path.join(tmp_dir, 'merged.ass')
+
+    def merge():
+        # charset detection is a part of a merge of new subtitles
+        mergesubs._detect_encoding.cache_clear()
+        for top, bot in subtitle_library:
+            mergesubs.merge(top, bot, out_path)
+
+    result = _measure(merge, repeat, len(subtitle_library))
+    result['subtitle_bytes'] = sum(os.path.getsize(path) for pair in subtitle_library for path in pair)
+    return result
+
+
+def _medians(results: dict, prefix: str = '') -> dict:
+    medians = {}
+    for name, value in results.items():
+        if 'median_ms' in value:
+            medians[f"{prefix}{name}"] = value['median_ms']
+        else:
+            medians.update(_medians(value, f"{prefix}{name}."))
+    return medians
+
+
+def _compare(results: dict, baseline_file: str) -> dict:
+    """
+    :return: median time of this run / median time of the baseline report for every benchmark, > 1 is slower
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    baseline_medians = _medians(baseline['results'])
+    return {
+        'commit': baseline.get('commit'),
+        'ratios': {name: median / baseline_medians[name] for name, median in _medians(results).items()
+                   if baseline_medians.get(name)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dirs', type=int, default=2000, help='count of movie directories of the library')
+    parser.add_argument('--merge-dirs', type=int, default=50, help='count of movies with subtitles to merge')
+    parser.add_argument('--subtitle-lines', type=str, default='200-3000', help='range of lines of a subtitle')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='write the report to a file instead of stdout')
+    parser.add_argument('--baseline', type=str, help='report of another commit to compare the results with')
+    args = parser.parse_args()
+    lines_range = tuple(int(x) for x in args.subtitle_lines.split('-'))
+    # info logs of every scanned file would be measured too
+    logging.disable(logging.INFO)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        library_dir = os.path.join(tmp_dir, 'library')
+        mkv_paths = make_mkv_library(library_dir, args.dirs, _SUBTITLE_TRACKS)
+        subtitle_library = make_subtitle_library(os.path.join(tmp_dir, 'subtitles'), args.merge_dirs, lines_range,
+                                                 args.seed)
+        report = {
+            'commit': _commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'mkvtoolnix': shutil.which('mkvmerge') is not None,
+            'parameters': vars(args),
+            'results': {
+                'scrap_files_to_scan': _bench_walk(tmp_dir, mkv_paths, args.repeat),
+                'mkvinfo': _bench_mkvinfo(tmp_dir, mkv_paths, subtitle_library, args.repeat),
+                'storage': _bench_storage(tmp_dir, mkv_paths, args.repeat),
+                'merge': _bench_merge(tmp_dir, subtitle_library, args.repeat),
+            },
+        }
+        if args.baseline:
+            report['baseline'] = _compare(report['results'], args.baseline)
+        output = json.dumps(report, indent=4)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output)
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
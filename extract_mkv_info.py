@@ -1,14 +1,43 @@
 import json
 import logging
+import os
+import signal
 import subprocess
+import tempfile
+import threading
 from collections import defaultdict
 from dataclasses import dataclass
 from json import JSONDecodeError
-from pathlib import Path
-from tempfile import mktemp
-from typing import List
+from typing import Dict, List, Optional
+
+from mkv_ebml import read_tracks, EBMLError
 
 _MKV_TRACK_TYPE_SUBTITLE = 'subtitles'
+# https://www.matroska.org/technical/codec_specs.html, the others (S_HDMV/PGS, S_VOBSUB, S_DVBSUB...) are bitmaps
+_TEXT_SUBTITLE_CODEC_IDS = {'S_TEXT/UTF8', 'S_TEXT/ASCII', 'S_TEXT/SSA', 'S_TEXT/ASS', 'S_TEXT/USF', 'S_TEXT/WEBVTT',
+                            'S_SSA', 'S_ASS'}
+# extensions of files mkvextract writes, https://mkvtoolnix.download/doc/mkvextract.html#mkvextract.output_formats
+_SUBTITLE_FILE_EXTENSIONS = {
+    'S_TEXT/UTF8': '.srt',
+    'S_TEXT/ASCII': '.srt',
+    'S_TEXT/SSA': '.ssa',
+    'S_SSA': '.ssa',
+    'S_TEXT/ASS': '.ass',
+    'S_ASS': '.ass',
+    'S_TEXT/USF': '.usf',
+    'S_TEXT/WEBVTT': '.vtt',
+    'S_HDMV/PGS': '.sup',
+    'S_HDMV/TEXTST': '.textst',
+    'S_VOBSUB': '.sub',
+    'S_KATE': '.ogg',
+}
+# mkvmerge reads only headers of a file
+MKVMERGE_TIMEOUT = 60
+# mkvextract reads the whole file, a slow disk or a network share should read at least this speed
+_MKVEXTRACT_BASE_TIMEOUT = 60
+_MKVEXTRACT_MIN_BYTES_PER_SECOND = 5 * 1024 * 1024
+# a terminated process is killed if it doesn't exit in time
+_TERMINATE_GRACE_SECONDS = 5
 
 
 @dataclass
@@ -21,10 +50,75 @@ class MKVTrackInfo:
     language_ietf: str
     _raw_properties: dict
 
+    @property
+    def codec_id(self) -> Optional[str]:
+        return self._raw_properties.get('codec_id')
+
+
+def subtitle_file_extension(codec_id: Optional[str]) -> str:
+    """
+    :param codec_id: Matroska codec id, unknown (None) is considered SRT
+    """
+    return _SUBTITLE_FILE_EXTENSIONS.get(codec_id, '.srt')
+
+
+def is_text_subtitle_codec(codec_id: Optional[str]) -> bool:
+    """
+    :param codec_id: Matroska codec id, unknown (None) is considered text
+    """
+    return codec_id is None or codec_id in _TEXT_SUBTITLE_CODEC_IDS
+
+
+def mkvextract_timeout(file_size: int) -> float:
+    """
+    :return: seconds mkvextract may run for a file of file_size bytes
+    """
+    return _MKVEXTRACT_BASE_TIMEOUT + file_size / _MKVEXTRACT_MIN_BYTES_PER_SECOND
+
+
+def _terminate_process_group(process: subprocess.Popen):
+    """
+    Terminate the process with all its children, kill them if they don't exit in _TERMINATE_GRACE_SECONDS
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.communicate(timeout=_TERMINATE_GRACE_SECONDS)
+            return
+        except subprocess.TimeoutExpired:
+            logging.warning(f"Process {process.args[0]} ({process.pid}) doesn't exit after {sig.name}")
+
+
+def _run(command: List[str], timeout: Optional[float]) -> subprocess.CompletedProcess:
+    """
+    Run a command in its own process group, the whole group is terminated on timeout
+    :param timeout: seconds, None - wait forever
+    :raise subprocess.TimeoutExpired: the command didn't exit in time
+    """
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logging.error(f"{command[0]} didn't finish in {timeout} seconds, terminating it")
+            _terminate_process_group(process)
+            raise
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+
+def parse_mkvinfo_from_file(file_path: str, timeout: Optional[float] = None) -> List[MKVTrackInfo]:
+    try:
+        return [_extract_mkvinfo(track) for track in read_tracks(file_path)]
+    except EBMLError as e:
+        logging.debug(f"Can't read tracks of {file_path} natively, fallback to mkvmerge: {e}")
+    return parse_mkvinfo_from_file_with_mkvmerge(file_path, timeout)
+
 
-def parse_mkvinfo_from_file(file_path: str) -> List[MKVTrackInfo]:
-    result = subprocess.run(['mkvmerge', '-i', '-J', '--output-charset', 'UTF-8', '--ui-language', 'en_US', file_path],
-                            stdout=subprocess.PIPE)
+def parse_mkvinfo_from_file_with_mkvmerge(file_path: str,
+                                          timeout: Optional[float] = None) -> List[MKVTrackInfo]:
+    result = _run(['mkvmerge', '-i', '-J', '--output-charset', 'UTF-8', '--ui-language', 'en_US', file_path], timeout)
     # https://mkvtoolnix.download/doc/mkvmerge.html#mkvmerge.exit_codes
     if result.returncode in [0, 1]:
         return parse_mkvinfo(result.stdout.decode('utf-8'))
@@ -33,8 +127,9 @@ def parse_mkvinfo_from_file(file_path: str) -> List[MKVTrackInfo]:
                          f"stderr: {result.stderr.decode('utf-8')}, stdout: {result.stdout.decode('utf-8')}")
 
 
-def parse_mkv_subtitles_info_from_file(file_path: str) -> List[MKVTrackInfo]:
-    mkv_tracks_info = parse_mkvinfo_from_file(file_path)
+def parse_mkv_subtitles_info_from_file(file_path: str,
+                                       timeout: Optional[float] = None) -> List[MKVTrackInfo]:
+    mkv_tracks_info = parse_mkvinfo_from_file(file_path, timeout)
     return [i for i in mkv_tracks_info if i.track_type == _MKV_TRACK_TYPE_SUBTITLE]
 
 
@@ -64,7 +159,11 @@ def _extract_mkvinfo(track: dict) -> MKVTrackInfo:
     return MKVTrackInfo(name, track_type, track_number, language, language_ietf, properties)
 
 
-def extract_mkv_tracks(mkv_file_path: str, tracks_info: List[dict]) -> bool:
+def extract_mkv_tracks(mkv_file_path: str, tracks_info: List[dict], timeout: Optional[float] = None) -> bool:
+    """
+    :param timeout: seconds, None - wait forever, mkvextract_timeout gives a timeout scaled by the file size
+    :raise subprocess.TimeoutExpired: mkvextract didn't finish in time
+    """
     logging.info(f"Extracting embedded subtitles from file {mkv_file_path}")
     if not tracks_info and not len(tracks_info):
         return False
@@ -73,16 +172,65 @@ def extract_mkv_tracks(mkv_file_path: str, tracks_info: List[dict]) -> bool:
         return [str(s['srt_track_id']) + ":" + s['srt_full_path'] for s in _tracks_info]
 
     tracks_to_srt_paths = _track_to_srt_path(tracks_info)
-    temp_file = mktemp()
-    command = ["mkvextract", "tracks", mkv_file_path,
-               *tracks_to_srt_paths, '-r', temp_file, '--ui-language', 'en_US']
-    result = subprocess.run(command, stdout=subprocess.PIPE)
-    logging.info(f"tmp logs file: {temp_file}")
+    command = ["mkvextract", "tracks", mkv_file_path, *tracks_to_srt_paths, '--ui-language', 'en_US']
+    return _is_extracted(mkv_file_path, _run(command, timeout))
+
+
+def _is_extracted(mkv_file_path: str, result: subprocess.CompletedProcess) -> bool:
     # https://mkvtoolnix.download/doc/mkvextract.html#d4e1284
     if result.returncode not in [0, 1]:
-        mkvextract_output = Path(temp_file).read_text()
         logging.info(f"Can't extract subtitles from file {mkv_file_path}. Exit code: {result.returncode}, "
-                     f"stderr: {result.stderr}, stdout: {result.stdout}, output: {mkvextract_output}")
+                     f"stderr: {result.stderr.decode('utf-8', errors='replace')}, "
+                     f"stdout: {result.stdout.decode('utf-8', errors='replace')}")
         return False
-    else:
-        return True
+    return True
+
+
+def _read_fifo(fifo_path: str, track_id: int, contents: Dict[int, bytes]):
+    with open(fifo_path, 'rb') as fifo:
+        contents[track_id] = fifo.read()
+
+
+def _release_fifo_reader(fifo_path: str, reader: threading.Thread):
+    """
+    A reader waits for a writer forever if mkvextract didn't open its pipe, a writer opened and closed here
+    gives the reader an empty track
+    """
+    while reader.is_alive():
+        try:
+            os.close(os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            # ENXIO - the reader hasn't opened the pipe yet or has already closed it
+            pass
+        reader.join(0.1)
+
+
+def extract_mkv_tracks_to_memory(mkv_file_path: str, track_ids: List[int],
+                                 timeout: Optional[float] = None) -> Dict[int, bytes]:
+    """
+    Extract tracks through named pipes, nothing is written to disk
+    :param timeout: seconds, None - wait forever
+    :return: track id -> content mkvextract would write to the track file, empty if extraction failed
+    :raise subprocess.TimeoutExpired: mkvextract didn't finish in time
+    """
+    logging.info(f"Extracting embedded subtitles from file {mkv_file_path} into memory")
+    if not track_ids:
+        return {}
+    contents: Dict[int, bytes] = {}
+    with tempfile.TemporaryDirectory(prefix='extract-subs-') as fifo_dir:
+        fifo_paths = {track_id: os.path.join(fifo_dir, f"{track_id}.fifo") for track_id in track_ids}
+        readers = {}
+        for track_id, fifo_path in fifo_paths.items():
+            os.mkfifo(fifo_path)
+            # mkvextract writes all tracks in one pass, every pipe is drained at once
+            readers[track_id] = threading.Thread(target=_read_fifo, args=(fifo_path, track_id, contents),
+                                                 name=f"fifo-reader-{track_id}", daemon=True)
+            readers[track_id].start()
+        command = ["mkvextract", "tracks", mkv_file_path,
+                   *[f"{track_id}:{fifo_path}" for track_id, fifo_path in fifo_paths.items()], '--ui-language', 'en_US']
+        try:
+            result = _run(command, timeout)
+        finally:
+            for track_id, reader in readers.items():
+                _release_fifo_reader(fifo_paths[track_id], reader)
+    return contents if _is_extracted(mkv_file_path, result) else {}
@@ -18,43 +18,75 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
+import json
 import logging
 import os
 import re
+import socket
 import sys
-from collections import namedtuple
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Set
+from typing import List, Set, Tuple, Callable, Iterable, Iterator, Dict, Optional, Union
 
-from babelfish import Language
-from iso639 import languages as iso639, Iso639
-from subliminal import save_subtitles, scan_video, region, download_best_subtitles, subtitle
+from iso639 import Iso639
 
-import mergesubs
 import util
-from extract_mkv_info import parse_mkv_subtitles_info_from_file, extract_mkv_tracks
-from storage import Storage
+import walker
+from extract_mkv_info import parse_mkv_subtitles_info_from_file, extract_mkv_tracks, is_text_subtitle_codec, \
+    subtitle_file_extension, mkvextract_timeout, MKVMERGE_TIMEOUT, extract_mkv_tracks_to_memory
+from metrics import Metrics, NullMetrics
+from scheduler import DeviceScheduler
+from storage import Storage, VideoFileScanRecord, VideoSubtitleRecord
+from util import FileFingerprint
+from watcher import InotifyWatcher
 
+# tracks_to_extract: None - extract all subtitles
 ScannedFile = namedtuple('ScanFile', ['filename', 'basename', 'extension', 'dir', 'full_path', 'subtitles',
-                                      'merged_subtitles'])
-FileToScan = namedtuple('FileToScan', ['root', 'filename'])
+                                      'merged_subtitles', 'fingerprint', 'scan_config', 'tracks_to_extract'],
+                         defaults=(None, None, None))
+# scanned_subtitles: subtitle rows of a file which was scanned with another configuration, None - scan from scratch
+# changed: the file was scanned before and its content has changed since, its subtitles are extracted again
+FileToScan = namedtuple('FileToScan', ['root', 'filename', 'scanned_subtitles', 'scan_config', 'changed'],
+                        defaults=(None, None, False))
 AppRunConfig = namedtuple('AppRunConfig', ['target_path', 'target_languages', 'merge_languages_pairs',
-                                           'validation_regex', 'opensubtitles_auth', 'download_online'])
+                                           'validation_regex', 'opensubtitles_auth', 'download_online', 'jobs',
+                                           'fingerprint_hash_mb', 'commit_every', 'download_batch_size',
+                                           'subtitle_providers', 'online_miss_recheck_days',
+                                           'demux_jobs_per_device', 'exclude_dirs', 'walk_jobs', 'job_queue',
+                                           'worker_id', 'job_lease_seconds', 'job_max_attempts',
+                                           'subprocess_timeout_scale', 'retry_failed_after_hours',
+                                           'write_extracted_subtitles'],
+                          defaults=(1, 0, 100, 20, None, 1, 1, walker.DEFAULT_EXCLUDE_DIRS, 1, False, None, 600, 3, 1,
+                                    24, True))
 
 CACHE_FILE_NAME = '.extractsubs'
 # dictionary, saving in root_path/CACHE_FILE_NAME
 _SUPPORTED_FILE_EXTENSIONS = ['.mkv', '.mp4', '.avi', '.mpg', '.mpeg']
+_ONLINE_MISS_MAX_RECHECK_INTERVAL = timedelta(days=64)
+# iso639-3 code saved for a track of an unknown language, e.g. qaa of the private use range
+_UNDETERMINED_LANGUAGE = 'und'
 
 logging.basicConfig(level='INFO', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
 class ExtractSubs:
     SUBLIMINAL_CACHE_DIR = os.path.join(os.getenv('HOME'), '.subliminal')
+    _subliminal_lock = threading.Lock()
 
-    def __init__(self, app_config: AppRunConfig, storage: Storage):
+    def __init__(self, app_config: AppRunConfig, storage: Storage, metrics: Metrics = None):
         self.app_config = app_config
         self._storage = storage
+        self._metrics = metrics or NullMetrics()
         self._validation = re.compile(app_config.validation_regex)
+        # merged subtitle path -> inputs it was merged from, loaded at the start of a scan
+        self._merge_inputs: Dict[str, list] = {}
+        self._worker_id = app_config.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        # (dir, filename, error) of files failed in pipeline workers, recorded by the storage thread
+        self._failed_files = deque()
 
     def _check(self):
         if not self.app_config.target_path:
@@ -64,180 +96,870 @@ class ExtractSubs:
             sys.exit(f"Error, {self.app_config.target_path} is not a directory or file")
 
     def _prepare_subliminal(self):
-        if not os.path.exists(ExtractSubs.SUBLIMINAL_CACHE_DIR):
-            os.makedirs(ExtractSubs.SUBLIMINAL_CACHE_DIR)
-        cache_file = os.path.join(ExtractSubs.SUBLIMINAL_CACHE_DIR, 'subliminal.cachefile.dbm')
-        # configure the cache
-        region.configure('dogpile.cache.dbm', arguments={'filename': cache_file})
+        # subliminal takes seconds to import on a Raspberry Pi, it's imported only when a file needs a download
+        from subliminal import region
+        with ExtractSubs._subliminal_lock:
+            if region.is_configured:
+                return
+            if not os.path.exists(ExtractSubs.SUBLIMINAL_CACHE_DIR):
+                os.makedirs(ExtractSubs.SUBLIMINAL_CACHE_DIR)
+            cache_file = os.path.join(ExtractSubs.SUBLIMINAL_CACHE_DIR, 'subliminal.cachefile.dbm')
+            # configure the cache
+            region.configure('dogpile.cache.dbm', arguments={'filename': cache_file})
 
     def _is_file_valid(self, name, root):
         (basename, ext) = os.path.splitext(name)
-        is_not_system_folder = '/@Recycle' not in root and '/@Recently-Snapshot' not in root
-        return ext in _SUPPORTED_FILE_EXTENSIONS and self._validation.match(name) is not None and is_not_system_folder
+        return ext in _SUPPORTED_FILE_EXTENSIONS and self._validation.match(name) is not None and \
+            not walker.is_in_excluded_dir(os.path.join(root, name), self.app_config.exclude_dirs)
 
-    def _is_file_already_scanned(self, name, root):
+    def _load_scanned_fingerprints(self) -> Dict[Tuple[str, str], FileFingerprint]:
         try:
-            return self._storage.is_file_scanned(os.path.join(root, name))
+            return self._storage.get_scanned_fingerprints()
         except Exception as e:
-            logging.error(f"Download error {e}")
+            logging.error(f"Load scanned files error {e}")
+            return {}
+
+    def _load_failed_files(self) -> Dict[Tuple[str, str], dict]:
+        try:
+            return self._storage.get_failed_files()
+        except Exception as e:
+            logging.error(f"Load failed files error {e}")
+            return {}
+
+    def _is_failure_postponed(self, name, root, failed_files: Dict[Tuple[str, str], dict]) -> bool:
+        """
+        A file which failed isn't scanned again before its retry time, unless it has changed since the failure
+        """
+        full_path = os.path.join(root, name)
+        (file_dir, file_name) = os.path.split(full_path)
+        failed_file = failed_files.get((file_dir.rstrip('/'), file_name))
+        if failed_file is None or not failed_file['retry_after'] or \
+                failed_file['retry_after'] <= datetime.utcnow().isoformat():
+            return False
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return True
+        return (failed_file['size'], failed_file['mtime_ns']) == (stat.st_size, stat.st_mtime_ns)
+
+    def _subprocess_timeout(self, seconds: float) -> Optional[float]:
+        scale = self.app_config.subprocess_timeout_scale
+        return seconds * scale if scale and scale > 0 else None
+
+    def _load_due_online_misses(self) -> Dict[str, List[str]]:
+        if not self.app_config.download_online:
+            return {}
+        try:
+            return self._storage.get_due_online_subtitle_misses(datetime.utcnow())
+        except Exception as e:
+            logging.error(f"Load online subtitle misses error {e}")
+            return {}
+
+    def _load_scan_configs(self) -> Dict[Tuple[str, str], dict]:
+        try:
+            return self._storage.get_scan_configs()
+        except Exception as e:
+            logging.error(f"Load scan configurations error {e}")
+            return {}
+
+    def _scan_config(self) -> dict:
+        """
+        Configuration files are processed with, it's saved with a file to find work missed after it changes
+        """
+        return {
+            'languages': sorted({lang.part3 for lang in self.app_config.target_languages or []}),
+            'merge_languages': sorted({f"{top.part3},{bot.part3}"
+                                       for top, bot in self.app_config.merge_languages_pairs or []}),
+            'download_online': bool(self.app_config.download_online),
+        }
+
+    @staticmethod
+    def _missing_scan_config(scan_config: dict, current_scan_config: dict) -> dict:
+        """
+        :return: parts of current_scan_config a file processed with scan_config missed, empty if nothing
+        """
+        missing = {key: sorted(set(current_scan_config[key]) - set(scan_config.get(key, [])))
+                   for key in ['languages', 'merge_languages']}
+        missing = {key: value for key, value in missing.items() if value}
+        if current_scan_config['download_online'] and not scan_config.get('download_online'):
+            missing['download_online'] = True
+        return missing
+
+    @staticmethod
+    def _union_scan_config(scan_config: dict, current_scan_config: dict) -> dict:
+        return {
+            'languages': sorted(set(scan_config.get('languages', [])) | set(current_scan_config['languages'])),
+            'merge_languages': sorted(set(scan_config.get('merge_languages', [])) |
+                                      set(current_scan_config['merge_languages'])),
+            'download_online': bool(scan_config.get('download_online')) or current_scan_config['download_online'],
+        }
+
+    def _incremental_file_to_scan(self, name, root, scan_configs: Dict[Tuple[str, str], dict],
+                                  scan_configs_to_update: List[Tuple[str, str, dict]],
+                                  due_online_misses: Dict[str, List[str]]) -> Optional[FileToScan]:
+        """
+        Plan the work an already scanned file missed because the configuration changed since its scan
+        or because subtitles not found online before should be looked up again.
+        Subtitle rows of the scan are reused, so the file isn't probed again
+        :param scan_configs_to_update: collects configurations which should be saved to the storage
+        :param due_online_misses: video path -> languages whose next online check time has come
+        :return: None if nothing is missed
+        """
+        full_path = os.path.join(root, name)
+        (file_dir, file_name) = os.path.split(full_path)
+        key = (file_dir.rstrip('/'), file_name)
+        current_scan_config = self._scan_config()
+        scan_config = scan_configs.get(key)
+        if scan_config is None:
+            # scanned by an old version which didn't save the configuration, consider it's the current one
+            scan_configs_to_update.append((*key, current_scan_config))
+            scan_config = current_scan_config
+        missing_scan_config = self._missing_scan_config(scan_config, current_scan_config)
+        due_languages = sorted(set(due_online_misses.get(full_path, [])) & set(current_scan_config['languages'])) \
+            if current_scan_config['download_online'] else []
+        if not missing_scan_config and not due_languages:
+            return None
+        video_file = self._storage.get_video_file_by_full_path(full_path)
+        if video_file is None:
+            return None
+        if missing_scan_config:
+            logging.info(f"File {full_path} was scanned without {missing_scan_config}, completing the scan")
+        if due_languages:
+            logging.info(f"Subtitles {due_languages} of {full_path} weren't found online, looking them up again")
+        scanned_subtitles = self._storage.get_all_subtitles_by_video_file_id(video_file['id'])
+        return FileToScan(root, name, scanned_subtitles, self._union_scan_config(scan_config, current_scan_config))
+
+    def _is_file_already_scanned(self, name, root, scanned_fingerprints: Dict[Tuple[str, str], FileFingerprint],
+                                 fingerprints_to_update: List[Tuple[str, str, FileFingerprint]]) -> bool:
+        """
+        File is scanned and its content hasn't changed since the scan.
+        Size and mtime are compared first, the partial hash (if enabled) is compared only if they differ
+        :param fingerprints_to_update: collects fingerprints which should be refreshed in the storage
+        """
+        full_path = os.path.join(root, name)
+        (file_dir, file_name) = os.path.split(full_path)
+        key = (file_dir.rstrip('/'), file_name)
+        stored_fingerprint = scanned_fingerprints.get(key)
+        if stored_fingerprint is None:
             return False
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return True
+        hash_size_mb = self.app_config.fingerprint_hash_mb
+        if stored_fingerprint.size is None:
+            # scanned by an old version which didn't save fingerprints
+            fingerprints_to_update.append((*key, util.file_fingerprint(full_path, hash_size_mb, stat)))
+            return True
+        if stored_fingerprint.size == stat.st_size and stored_fingerprint.mtime_ns == stat.st_mtime_ns:
+            return True
+        if hash_size_mb > 0 and stored_fingerprint.partial_hash and stored_fingerprint.size == stat.st_size:
+            fingerprint = util.file_fingerprint(full_path, hash_size_mb, stat)
+            if fingerprint.partial_hash == stored_fingerprint.partial_hash:
+                fingerprints_to_update.append((*key, fingerprint))
+                return True
+        logging.info(f"File {full_path} has changed since the last scan")
+        return False
+
+    @staticmethod
+    def _merge_input(subtitle_path: str) -> dict:
+        stat = os.stat(subtitle_path)
+        return {'path': subtitle_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    @staticmethod
+    def _in_memory_merge_input(file: ScannedFile, subtitle: dict) -> dict:
+        """
+        A track extracted into memory changes only with its video file
+        """
+        stat = os.stat(file.full_path)
+        return {'path': file.full_path, 'track_id': subtitle['srt_track_id'], 'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns}
+
+    def _is_merge_up_to_date(self, merged_srt_path: str, merge_inputs: List[dict]) -> bool:
+        """
+        Merged subtitle exists, is newer than its inputs and was merged from inputs of the same size and mtime
+        """
+        if self._merge_inputs.get(merged_srt_path) != merge_inputs:
+            return False
+        try:
+            merged_mtime_ns = os.stat(merged_srt_path).st_mtime_ns
+        except OSError:
+            return False
+        return all(merged_mtime_ns >= merge_input['mtime_ns'] for merge_input in merge_inputs)
+
+    @staticmethod
+    def _text_subtitle_paths(subtitles: list, iso639_language: Iso639) -> Set[str]:
+        # bitmap subtitles can't be merged
+        return {x['srt_full_path'] for x in subtitles
+                if x.get('srt_lang_code') is iso639_language and is_text_subtitle_codec(x.get('srt_codec_id'))}
+
+    @staticmethod
+    def _merged_subtitle_path(file: ScannedFile, lang_top: Iso639, lang_bot: Iso639, top_subtitle_paths: Set[str],
+                              bot_subtitle_paths: Set[str], index: int) -> str:
+        index_suffix = f"_{index}" if len(top_subtitle_paths) == 1 and len(bot_subtitle_paths) == 1 else ""
+        return f"{os.path.join(file.dir, file.basename)}.{lang_top.part1}_{lang_bot.part1}{index_suffix}.ass"
 
     def _merge_subs(self, file: ScannedFile):
         if not self.app_config.merge_languages_pairs or not file:
             return
 
-        def file_path_by_lang(file_subtitles: list, iso639_language: iso639) -> Set[str]:
-            return {x['srt_full_path'] for x in file_subtitles if x['srt_lang_code'] is iso639_language}
-
         subtitles = file.subtitles if file.subtitles else []
+        # tracks extracted into memory by path of their subtitle file which isn't written,
+        # a track of merges which are up to date isn't extracted
+        in_memory_subtitles = {x['srt_full_path']: x for x in subtitles
+                               if x.get('srt_content') is not None or x.get('srt_merge_up_to_date')}
+        # a subtitle used in several language pairs is decoded and parsed once per movie
+        loaded_subtitles = {}
+
+        def load_subtitle(subtitle_path: str):
+            import mergesubs
+            if subtitle_path not in loaded_subtitles:
+                in_memory_subtitle = in_memory_subtitles.get(subtitle_path)
+                with self._metrics.stage('subtitle_load'):
+                    loaded_subtitles[subtitle_path] = mergesubs.load(subtitle_path) if in_memory_subtitle is None \
+                        else mergesubs.loads(in_memory_subtitle['srt_content'])
+                self._metrics.add_bytes('subtitle_load', os.path.getsize(subtitle_path) if in_memory_subtitle is None
+                                        else len(in_memory_subtitle['srt_content']))
+            return loaded_subtitles[subtitle_path]
+
+        def merge_input(subtitle_path: str) -> dict:
+            if subtitle_path in in_memory_subtitles:
+                return self._in_memory_merge_input(file, in_memory_subtitles[subtitle_path])
+            return self._merge_input(subtitle_path)
 
         for merge_lang_pair in self.app_config.merge_languages_pairs:
             lang_top = merge_lang_pair[0]
             lang_bot = merge_lang_pair[1]
-            top_subtitle_paths = file_path_by_lang(subtitles, lang_top)
-            bot_subtitle_paths = file_path_by_lang(subtitles, lang_bot)
+            top_subtitle_paths = self._text_subtitle_paths(subtitles, lang_top)
+            bot_subtitle_paths = self._text_subtitle_paths(subtitles, lang_bot)
 
             def _subtitle_path_exists(subtitle_path: str) -> bool:
-                return subtitle_path is not None and Path(subtitle_path).exists()
+                return subtitle_path is not None and (subtitle_path in in_memory_subtitles or
+                                                      Path(subtitle_path).exists())
 
             index = 1
 
             for top_subtitle_path in top_subtitle_paths:
                 for bot_subtitle_path in bot_subtitle_paths:
                     if _subtitle_path_exists(top_subtitle_path) and _subtitle_path_exists(bot_subtitle_path):
-                        index_suffix = f"_{index}" if len(top_subtitle_paths) == 1 and len(bot_subtitle_paths) == 1 \
-                            else ""
-                        merged_srt_path = f"{os.path.join(file.dir, file.basename)}" \
-                                          f".{lang_top.part1}_{lang_bot.part1}{index_suffix}.ass"
+                        merged_srt_path = self._merged_subtitle_path(file, lang_top, lang_bot, top_subtitle_paths,
+                                                                     bot_subtitle_paths, index)
                         try:
-                            mergesubs.merge(top_subtitle_path,
-                                            bot_subtitle_path,
-                                            merged_srt_path)
+                            merge_inputs = [merge_input(top_subtitle_path), merge_input(bot_subtitle_path)]
+                            if self._is_merge_up_to_date(merged_srt_path, merge_inputs):
+                                logging.info(f"Merged subtitle {merged_srt_path} is up to date")
+                            else:
+                                import mergesubs
+                                mergesubs.merge_loaded(load_subtitle(top_subtitle_path),
+                                                       load_subtitle(bot_subtitle_path)).save(merged_srt_path)
                             file.merged_subtitles.append({
                                 'lang_top': lang_top,
                                 'lang_bot': lang_bot,
-                                'srt_full_path': merged_srt_path
+                                'srt_full_path': merged_srt_path,
+                                'merge_inputs': merge_inputs
                             })
                             index = index + 1
                         except Exception as e:
-                            import traceback, sys
-                            traceback.print_exc(file=sys.stdout)
-                            logging.error(f"Merge error {str(e)}")
+                            logging.exception(f"Merge error {merged_srt_path}: {e}")
+
+    def _needed_languages(self) -> Set[Iso639]:
+        # subtitles extracted into memory are only merged
+        languages = set(self.app_config.target_languages or []) if self.app_config.write_extracted_subtitles else set()
+        for lang_top, lang_bot in self.app_config.merge_languages_pairs or []:
+            languages.update((lang_top, lang_bot))
+        return languages
+
+    def _select_tracks_to_extract(self, file: ScannedFile) -> List[dict]:
+        """
+        Embedded text subtitles of needed languages which aren't extracted yet, all languages are needed if none is set.
+        Every extracted track makes mkvextract slower and a bitmap track can't be merged
+        """
+        if not self.app_config.write_extracted_subtitles and not self.app_config.merge_languages_pairs:
+            return []
+        needed_languages = self._needed_languages()
+        tracks = [s for s in file.subtitles
+                  if s['srt_track_id'] is not None and not s['srt_exists']
+                  and is_text_subtitle_codec(s.get('srt_codec_id'))
+                  and (not needed_languages or s.get('srt_lang_code') in needed_languages)]
+        if self.app_config.write_extracted_subtitles:
+            return tracks
+        return self._select_tracks_of_outdated_merges(file, tracks)
+
+    def _select_tracks_of_outdated_merges(self, file: ScannedFile, tracks: List[dict]) -> List[dict]:
+        """
+        Tracks extracted into memory are only merged, a track isn't extracted when all merges using it are up to date.
+        Such a track is marked with srt_merge_up_to_date, so its merged subtitles are kept
+        """
+        tracks_by_path = {track['srt_full_path']: track for track in tracks}
+
+        def merge_input(subtitle_path: str) -> dict:
+            if subtitle_path in tracks_by_path:
+                return self._in_memory_merge_input(file, tracks_by_path[subtitle_path])
+            return self._merge_input(subtitle_path)
+
+        needed_paths = set()
+        for lang_top, lang_bot in self.app_config.merge_languages_pairs:
+            top_subtitle_paths = self._text_subtitle_paths(file.subtitles, lang_top)
+            bot_subtitle_paths = self._text_subtitle_paths(file.subtitles, lang_bot)
+            for top_subtitle_path in top_subtitle_paths:
+                for bot_subtitle_path in bot_subtitle_paths:
+                    pair_tracks = {top_subtitle_path, bot_subtitle_path} & tracks_by_path.keys()
+                    if not pair_tracks or pair_tracks <= needed_paths:
+                        continue
+                    merged_srt_path = self._merged_subtitle_path(file, lang_top, lang_bot, top_subtitle_paths,
+                                                                 bot_subtitle_paths, 1)
+                    try:
+                        merge_inputs = [merge_input(top_subtitle_path), merge_input(bot_subtitle_path)]
+                    except OSError:
+                        # a subtitle file is missing, the pair isn't merged
+                        continue
+                    if not self._is_merge_up_to_date(merged_srt_path, merge_inputs):
+                        needed_paths.update(pair_tracks)
+        for track in tracks:
+            if track['srt_full_path'] not in needed_paths:
+                track['srt_merge_up_to_date'] = True
+        return [track for track in tracks if track['srt_full_path'] in needed_paths]
+
+    def _read_scanned_subtitles(self, file_to_scan: FileToScan) -> ScannedFile:
+        """
+        Rebuild a scanned file from its subtitle rows, only needed tracks whose subtitles are missing are extracted.
+        Merged subtitles of pairs which aren't configured anymore are kept, they are still in the scan configuration
+        """
+        name = file_to_scan.filename
+        root = file_to_scan.root
+        (basename, ext) = os.path.splitext(name)
+        fingerprint = util.file_fingerprint(os.path.join(root, name), self.app_config.fingerprint_hash_mb)
+        merge_languages = set(self._scan_config()['merge_languages'])
+        subtitles = []
+        merged_subtitles = []
+        for scanned_subtitle in file_to_scan.scanned_subtitles:
+            srt_full_path = scanned_subtitle['full_path']
+            if scanned_subtitle['source'] == 'Merge':
+                if scanned_subtitle['language_iso639_3'] not in merge_languages:
+                    (lang_top, lang_bot) = scanned_subtitle['language_iso639_3'].split(',')
+                    merged_subtitles.append({
+                        'lang_top': util.iso639_from_str(lang_top),
+                        'lang_bot': util.iso639_from_str(lang_bot),
+                        'srt_full_path': srt_full_path,
+                        'merge_inputs': json.loads(scanned_subtitle['merge_inputs'])
+                        if scanned_subtitle['merge_inputs'] else None
+                    })
+                continue
+            subtitles.append({
+                'srt_track_id': scanned_subtitle['track_id'],
+                'srt_full_path': srt_full_path,
+                'srt_exists': os.path.isfile(srt_full_path),
+                'srt_codec_id': scanned_subtitle['codec_id'],
+                'srt_lang_code': util.iso639_from_str(scanned_subtitle['language_iso639_3'])
+            })
+        movie = ScannedFile(name, basename, ext, root, os.path.join(root, name), subtitles, merged_subtitles,
+                            fingerprint, file_to_scan.scan_config)
+        return movie._replace(tracks_to_extract=self._select_tracks_to_extract(movie))
+
+    @staticmethod
+    def _is_extracted_after(subtitle_path: str, fingerprint: FileFingerprint) -> bool:
+        """
+        Subtitle exists and isn't older than the video, an older one can be left from a previous release of the video
+        """
+        try:
+            return os.stat(subtitle_path).st_mtime_ns >= fingerprint.mtime_ns
+        except OSError:
+            return False
 
     def _read_subtitles(self, file_to_scan: FileToScan) -> ScannedFile:
+        if file_to_scan.scanned_subtitles is not None:
+            return self._read_scanned_subtitles(file_to_scan)
         name = file_to_scan.filename
         root = file_to_scan.root
         (basename, ext) = os.path.splitext(name)
+        fingerprint = util.file_fingerprint(os.path.join(root, name), self.app_config.fingerprint_hash_mb)
+        scan_config = self._scan_config()
         if ext == '.mkv':
             subtitles = []
             # todo find existed merged subtitles
-            movie = ScannedFile(name, basename, ext, root, os.path.join(root, name), subtitles, [])
+            movie = ScannedFile(name, basename, ext, root, os.path.join(root, name), subtitles, [], fingerprint,
+                                scan_config)
 
-            for mkv_subtitle_info in parse_mkv_subtitles_info_from_file(os.path.join(root, name)):
+            for mkv_subtitle_info in parse_mkv_subtitles_info_from_file(
+                    os.path.join(root, name), timeout=self._subprocess_timeout(MKVMERGE_TIMEOUT)):
                 track_iso639_lang_code = util.bcp47_language_code_to_iso_639(mkv_subtitle_info.language_ietf,
                                                                              default=mkv_subtitle_info.language)
                 name_suffix = f"_{mkv_subtitle_info.name}" if mkv_subtitle_info.name else ""
-                srt_full_path = os.path.join(root, f"{basename}_{track_iso639_lang_code}{name_suffix}.srt")
-                srt_exists = os.path.isfile(srt_full_path)
+                extension = subtitle_file_extension(mkv_subtitle_info.codec_id)
+                srt_full_path = os.path.join(root, f"{basename}_{track_iso639_lang_code}{name_suffix}{extension}")
                 s = {
                     'srt_track_id': mkv_subtitle_info.track_number,
                     'srt_full_path': srt_full_path,
-                    'srt_exists': srt_exists
+                    'srt_exists': not file_to_scan.changed and self._is_extracted_after(srt_full_path, fingerprint),
+                    'srt_codec_id': mkv_subtitle_info.codec_id
                 }
                 if track_iso639_lang_code:
-                    s['srt_lang_code'] = util.iso639_from_str(track_iso639_lang_code)
+                    s['srt_lang_code'] = util.iso639_from_bcp47(mkv_subtitle_info.language_ietf,
+                                                                default=mkv_subtitle_info.language)
 
                 subtitles.append(s)
-            return movie
+            return movie._replace(tracks_to_extract=self._select_tracks_to_extract(movie))
         else:
-            empty_movie = ScannedFile(name, basename, ext, root, os.path.join(root, name), [], [])
+            empty_movie = ScannedFile(name, basename, ext, root, os.path.join(root, name), [], [], fingerprint,
+                                      scan_config, [])
             return empty_movie
 
-    def _scrap_files_to_scan(self) -> List[FileToScan]:
-        files_to_scan = []
+    def _iter_files_to_scan(self) -> Iterator[FileToScan]:
+        """
+        Walk the target path lazily, a file is yielded as soon as it's found
+        """
         extr_path = self.app_config.target_path
+        scanned_fingerprints = self._load_scanned_fingerprints()
+        scan_configs = self._load_scan_configs()
+        failed_files = self._load_failed_files()
+        due_online_misses = self._load_due_online_misses()
+        fingerprints_to_update = []
+        scan_configs_to_update = []
+
+        def _file_to_scan(name, dirpath, walked: bool = False) -> Optional[FileToScan]:
+            # the walker has already checked the extension and pruned excluded directories
+            is_valid = self._validation.match(name) is not None if walked else self._is_file_valid(name, dirpath)
+            if not is_valid:
+                return None
+            if not self._is_file_already_scanned(name, dirpath, scanned_fingerprints, fingerprints_to_update):
+                if self._is_failure_postponed(name, dirpath, failed_files):
+                    return None
+                (file_dir, file_name) = os.path.split(os.path.join(dirpath, name))
+                return FileToScan(dirpath, name, changed=(file_dir.rstrip('/'), file_name) in scanned_fingerprints)
+            return self._incremental_file_to_scan(name, dirpath, scan_configs, scan_configs_to_update,
+                                                  due_online_misses)
+
         if os.path.isdir(extr_path):
-            for dirpath, dirs, files in os.walk(extr_path):
-                for name in files:
-                    if self._is_file_valid(name, dirpath) and not self._is_file_already_scanned(name, dirpath):
-                        files_to_scan.append(FileToScan(dirpath, name))
+            for dirpath, name in walker.iter_files([extr_path], _SUPPORTED_FILE_EXTENSIONS, self.app_config.exclude_dirs,
+                                                   self.app_config.walk_jobs):
+                file_to_scan = _file_to_scan(name, dirpath, walked=True)
+                if file_to_scan is not None:
+                    yield file_to_scan
         elif os.path.isfile(extr_path):
             dirpath = os.path.dirname(extr_path)
             name = os.path.basename(extr_path)
-            if self._is_file_valid(name, dirpath) and not self._is_file_already_scanned(name, dirpath):
-                files_to_scan.append(FileToScan(dirpath, name))
-        return files_to_scan
+            file_to_scan = _file_to_scan(name, dirpath)
+            if file_to_scan is not None:
+                yield file_to_scan
+        if fingerprints_to_update:
+            self._storage.update_video_file_fingerprints(fingerprints_to_update)
+        if scan_configs_to_update:
+            self._storage.update_video_file_scan_configs(scan_configs_to_update)
 
-    def _save_scanned_files(self, file: ScannedFile):
-        saved_video_file = self._storage.create_video_file(file.dir, file.filename)
-        for file_subtitle in file.subtitles:
-            self._storage.create_video_subtitle(saved_video_file['id'], file_subtitle['srt_full_path'],
-                                                file_subtitle['srt_lang_code'].part3, file_subtitle['srt_track_id'],
-                                                source='FILE')
-        for merged_subtitles in file.merged_subtitles:
-            lang_bot = merged_subtitles['lang_bot']
-            lang_top = merged_subtitles['lang_top']
-            self._storage.create_video_subtitle(saved_video_file['id'], merged_subtitles['srt_full_path'],
-                                                f"{lang_top.part3},{lang_bot.part3}", None, 'Merge')
+    def _scrap_files_to_scan(self) -> List[FileToScan]:
+        return list(self._iter_files_to_scan())
+
+    def _save_scanned_files(self, files: List[ScannedFile]):
+        def _scan_record(file: ScannedFile) -> VideoFileScanRecord:
+            subtitles = [VideoSubtitleRecord(file_subtitle['srt_full_path'],
+                                             file_subtitle['srt_lang_code'].part3
+                                             if file_subtitle.get('srt_lang_code') else _UNDETERMINED_LANGUAGE,
+                                             file_subtitle['srt_track_id'], 'FILE',
+                                             codec_id=file_subtitle.get('srt_codec_id'))
+                         for file_subtitle in file.subtitles]
+            for merged_subtitles in file.merged_subtitles:
+                lang_bot = merged_subtitles['lang_bot']
+                lang_top = merged_subtitles['lang_top']
+                subtitles.append(VideoSubtitleRecord(merged_subtitles['srt_full_path'],
+                                                     f"{lang_top.part3},{lang_bot.part3}", None, 'Merge',
+                                                     merged_subtitles.get('merge_inputs')))
+            return VideoFileScanRecord(file.dir, file.filename, file.fingerprint, subtitles, file.scan_config)
+
+        # a changed file is rescanned, its previous scan is replaced
+        self._storage.save_scan_results([_scan_record(file) for file in files])
 
     def _extract_subs(self, file: ScannedFile):
         logging.info("*****************************")
         logging.info(f"Directory: {file.dir}")
         logging.info(f"File: {file.filename}")
+        if file.tracks_to_extract is not None and not file.tracks_to_extract:
+            logging.info("No embedded subtitles to extract.")
+            return
         logging.info("Embedded subtitles found.")
-        extract_mkv_tracks(file.full_path, file.subtitles)
-        extracted_languages = [subtitle for subtitle in file.subtitles if subtitle['srt_lang_code'] is not None]
-        languages_to_download = [x for x in self.app_config.target_languages if x not in extracted_languages]
+        # mkvextract reads the whole file
+        file_size = file.fingerprint.size if file.fingerprint else os.path.getsize(file.full_path)
+        self._metrics.add_bytes('extract', file_size)
+        tracks = file.subtitles if file.tracks_to_extract is None else file.tracks_to_extract
+        timeout = self._subprocess_timeout(mkvextract_timeout(file_size))
+        if self.app_config.write_extracted_subtitles:
+            extract_mkv_tracks(file.full_path, tracks, timeout=timeout)
+            return
+        # only merged subtitles are written, extracted tracks are kept with the file until it's merged
+        contents = extract_mkv_tracks_to_memory(file.full_path, [track['srt_track_id'] for track in tracks], timeout)
+        for track in tracks:
+            track['srt_content'] = contents.get(track['srt_track_id'])
 
-        if self.app_config.download_online:
-            self._download_subs(file, languages_to_download)
+    def _languages_to_download(self, file: ScannedFile) -> List[Iso639]:
+        if not self.app_config.download_online:
+            return []
+        extracted_languages = {subtitle.get('srt_lang_code') for subtitle in file.subtitles
+                               if is_text_subtitle_codec(subtitle.get('srt_codec_id'))}
+        return [x for x in self.app_config.target_languages if x not in extracted_languages]
+
+    def _provider_pool(self):
+        from subliminal.core import ProviderPool
+        return ProviderPool(providers=self.app_config.subtitle_providers,
+                            provider_configs={'opensubtitles': self.app_config.opensubtitles_auth})
 
-    def _download_subs(self, file: ScannedFile, download_subtitle_langs=None):
-        if download_subtitle_langs is None:
-            download_subtitle_langs = [iso639.get(part3='eng')]
-        logging.info("Analyzing video file...")
+    @staticmethod
+    def _video_hash(file: ScannedFile) -> Optional[str]:
+        from subliminal.utils import hash_opensubtitles
         try:
-            video = scan_video(file.full_path)
-        except ValueError as ex:
-            logging.info("Failed to analyze video. ", ex)
+            # opensubtitles hash isn't defined for files smaller than 128 KB
+            return hash_opensubtitles(file.full_path) or f"sha1:{util.partial_hash(file.full_path, 1)}"
+        except OSError as e:
+            logging.error(f"Can't hash video {file.full_path}: {e}")
             return None
-        logging.info("Choosing subtitle from online providers...")
-        languages_to_download = set(map(lambda lang: Language(lang.part3), download_subtitle_langs))
-        best_subtitles = download_best_subtitles({video}, languages_to_download, only_one=True,
-                                                 provider_configs={'opensubtitles': (
-                                                     self.app_config.opensubtitles_auth)})
-        if best_subtitles[video]:
-            logging.info("Downloading subtitles...")
+
+    def _skip_recent_misses(self, video_hash: Optional[str], languages: List[Iso639]) -> List[Iso639]:
+        """
+        Languages not found online for the video are skipped until their next check time
+        """
+        if video_hash is None:
+            return languages
+        now = datetime.utcnow().isoformat()
+        postponed_languages = {miss['language_iso639_3']
+                               for miss in self._storage.get_online_subtitle_misses(video_hash)
+                               if miss['next_check_time'] > now}
+        return [lang for lang in languages if lang.part3 not in postponed_languages]
+
+    def _record_download_result(self, file: ScannedFile, video_hash: Optional[str], languages: List[Iso639],
+                                downloaded_subtitles: list):
+        if video_hash is None:
+            return
+        if downloaded_subtitles:
+            self._storage.delete_online_subtitle_misses(video_hash, [s.language.alpha3 for s in downloaded_subtitles])
+            return
+        base_interval = timedelta(days=self.app_config.online_miss_recheck_days)
+        for lang in languages:
+            self._storage.record_online_subtitle_miss(video_hash, lang.part3, file.full_path, base_interval,
+                                                      _ONLINE_MISS_MAX_RECHECK_INTERVAL)
+
+    def _download_subs(self, files: List[Tuple[ScannedFile, List[Iso639], Optional[str]]]):
+        """
+        Look up online subtitles for a batch of files with one provider pool,
+        so every provider logs in once per batch and not once per file
+        :param files: files with languages to download for them and video hashes
+        """
+        from babelfish import Language
+        from subliminal import scan_video
+        from subliminal.core import check_video
+        self._prepare_subliminal()
+
+        videos = []
+        for file, download_subtitle_langs, video_hash in files:
+            logging.info(f"Analyzing video file {file.full_path}")
             try:
-                saved_subtitles = save_subtitles(video, best_subtitles[video])
-                for saved_subtitle in saved_subtitles:
-                    subtitle_path = subtitle.get_subtitle_path(video.name, saved_subtitle.language)
-                    file_exist = os.path.isfile(subtitle_path)
-                    file.subtitles = file.subtitles if file.subtitles else []
-                    file.subtitles.append({
-                        'srt_track_id': None,
-                        'srt_full_path': subtitle_path,
-                        'srt_exists': file_exist,
-                        'srt_lang_code': iso639.get(part3=saved_subtitle.language.alpha3),
-                    })
+                video = scan_video(file.full_path)
+            except ValueError as ex:
+                logging.info(f"Failed to analyze video {file.full_path}. {ex}")
+                continue
+            languages_to_download = set(map(lambda lang: Language(lang.part3), download_subtitle_langs))
+            if check_video(video, languages=languages_to_download, undefined=True):
+                videos.append((file, video, languages_to_download, download_subtitle_langs, video_hash))
+        if not videos:
+            return
+
+        logging.info(f"Choosing subtitles from online providers for {len(videos)} files...")
+        with self._provider_pool() as pool:
+            for file, video, languages_to_download, download_subtitle_langs, video_hash in videos:
+                found_subtitles = pool.list_subtitles(video, languages_to_download - video.subtitle_languages)
+                best_subtitles = pool.download_best_subtitles(found_subtitles, video, languages_to_download,
+                                                              only_one=True)
+                self._save_downloaded_subs(file, video, best_subtitles)
+                self._record_download_result(file, video_hash, download_subtitle_langs, best_subtitles)
+
+    def _save_downloaded_subs(self, file: ScannedFile, video, best_subtitles: list):
+        from subliminal import save_subtitles, subtitle
+
+        if not best_subtitles:
+            logging.error(f"No subtitles found online for {file.full_path}.")
+            return
+        logging.info("Downloading subtitles...")
+        try:
+            saved_subtitles = save_subtitles(video, best_subtitles)
+            for saved_subtitle in saved_subtitles:
+                subtitle_path = subtitle.get_subtitle_path(video.name, saved_subtitle.language)
+                file_exist = os.path.isfile(subtitle_path)
+                file.subtitles.append({
+                    'srt_track_id': None,
+                    'srt_full_path': subtitle_path,
+                    'srt_exists': file_exist,
+                    'srt_lang_code': util.iso639_from_str(saved_subtitle.language.alpha3),
+                })
+        except Exception as e:
+            logging.error(f"Download error {e}")
+
+    def _download_stage(self, files: Iterable[ScannedFile]) -> Iterator[ScannedFile]:
+        """
+        Files without missing languages pass through at once,
+        the others are held until a batch of app_config.download_batch_size files is collected
+        """
+        batch = []
+        for file in files:
+            languages_to_download = self._languages_to_download(file)
+            video_hash = None
+            if languages_to_download:
+                video_hash = self._video_hash(file)
+                languages_to_download = self._skip_recent_misses(video_hash, languages_to_download)
+            if not languages_to_download:
+                yield file
+                continue
+            batch.append((file, languages_to_download, video_hash))
+            if len(batch) >= self.app_config.download_batch_size:
+                with self._metrics.stage('download'):
+                    self._download_subs(batch)
+                yield from (batch_file for batch_file, _, _ in batch)
+                batch = []
+        if batch:
+            with self._metrics.stage('download'):
+                self._download_subs(batch)
+            yield from (batch_file for batch_file, _, _ in batch)
+
+    def _save_file(self, file: ScannedFile, job_queue: bool) -> ScannedFile:
+        self._save_scanned_files([file])
+        if job_queue:
+            self._storage.finish_job(file.dir, file.filename, self._worker_id)
+        return file
+
+    def _extract_file(self, file: ScannedFile) -> ScannedFile:
+        self._extract_subs(file)
+        return file
+
+    def _merge_file(self, file: ScannedFile) -> ScannedFile:
+        self._merge_subs(file)
+        return file
+
+    def _timed(self, stage: str, fn: Callable) -> Callable:
+        if not self._metrics.enabled:
+            return fn
+
+        def timed_fn(file):
+            with self._metrics.stage(stage):
+                return fn(file)
+
+        return timed_fn
 
+    def _map_files(self, fn: Callable, files: Iterable,
+                   executor: Optional[Union[ThreadPoolExecutor, DeviceScheduler]]) -> Iterator:
+        """
+        Lazily apply fn to every file, on the executor if it's given.
+        At most 2 * jobs files are in flight, results are yielded in the order of files
+        """
+        if executor is None:
+            yield from map(fn, files)
+            return
+
+        in_flight = deque()
+        for file in files:
+            in_flight.append(executor.submit(fn, file))
+            if len(in_flight) >= 2 * self.app_config.jobs:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def _guarded(self, fn: Callable) -> Callable:
+        """
+        A file which fails is dropped from the pipeline and recorded as failed instead of stopping the scan
+        """
+        def guarded_fn(file):
+            try:
+                return fn(file)
             except Exception as e:
-                logging.error(f"Download error {e}")
-        else:
-            logging.error("No subtitles found online.")
+                dir = file.root if isinstance(file, FileToScan) else file.dir
+                logging.exception(f"Processing {os.path.join(dir, file.filename)} failed")
+                self._failed_files.append((dir, file.filename, f"{type(e).__name__}: {e}"))
+                return None
 
-    def scan_files(self):
-        self._check()
-        self._prepare_subliminal()
+        return guarded_fn
 
-        files_to_scan = self._scrap_files_to_scan()
+    def _record_failed_files(self, job_queue: bool):
+        """
+        :param job_queue: failed files are claimed jobs, they return to the queue until they fail job_max_attempts times
+        """
+        while self._failed_files:
+            (dir, filename, error) = self._failed_files.popleft()
+            retry_after = datetime.utcnow() + timedelta(hours=self.app_config.retry_failed_after_hours)
+            try:
+                fingerprint = util.file_fingerprint(os.path.join(dir, filename))
+            except OSError:
+                fingerprint = None
+            if job_queue:
+                self._storage.fail_job(dir, filename, self._worker_id, error, self.app_config.job_max_attempts,
+                                       retry_after, fingerprint)
+            else:
+                self._storage.record_failed_file(dir, filename, error, retry_after, fingerprint)
+
+    def _scan(self, files_to_scan: Iterable[FileToScan], job_queue: bool = False):
+        """
+        walk -> probe -> extract -> download -> merge -> save pipeline of generators: a file goes to the next stage
+        as soon as it's done, so extraction starts with the first found file and only files in flight are kept in memory.
+        Stages run on a pool of app_config.jobs workers, extraction reads whole files and runs on
+        app_config.demux_jobs_per_device workers per disk instead. Only this thread writes to the storage
+        A file which fails in any stage but download is recorded as failed, the others go on
+        :param job_queue: files are claimed jobs, every file is committed at once to not hold the db lock
+        which other workers need
+        """
+        jobs = self.app_config.jobs or 1
+        if self.app_config.merge_languages_pairs:
+            self._merge_inputs = self._storage.get_merge_inputs()
+        executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        extract_scheduler = DeviceScheduler(self.app_config.demux_jobs_per_device,
+                                            path_of=lambda file: file.full_path) if jobs > 1 else None
+        # a saved file is committed within a second, an interrupted run keeps its progress
+        session = nullcontext() if job_queue else \
+            self._storage.bulk_session(commit_every=self.app_config.commit_every, commit_interval=1.0)
+        try:
+            with session:
+                probed_files = self._map_files(self._guarded(self._timed('probe', self._read_subtitles)),
+                                               files_to_scan, executor)
+                extracted_files = self._map_files(self._guarded(self._timed('extract', self._extract_file)),
+                                                  (file for file in probed_files if file is not None),
+                                                  extract_scheduler)
+                downloaded_files = self._download_stage(file for file in extracted_files if file is not None)
+                merged_files = self._map_files(self._guarded(self._timed('merge', self._merge_file)),
+                                               downloaded_files, executor)
+                save_file = self._guarded(lambda file: self._save_file(file, job_queue))
+                for scanned_file in (file for file in merged_files if file is not None):
+                    with self._metrics.stage('db_write'):
+                        save_file(scanned_file)
+                    self._record_failed_files(job_queue)
+                self._record_failed_files(job_queue)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            if extract_scheduler is not None:
+                extract_scheduler.shutdown(wait=True)
+
+    def _files_to_scan_from_paths(self, paths: Iterable[str]) -> List[FileToScan]:
+        files_to_scan = []
+        fingerprints_to_update = []
+        scan_configs_to_update = []
+        due_online_misses = self._load_due_online_misses()
+        for path in paths:
+            (dirpath, name) = os.path.split(path)
+            if not self._is_file_valid(name, dirpath):
+                continue
+            video_file = self._storage.get_video_file_by_full_path(path)
+            scanned_fingerprints = {} if video_file is None else {
+                (video_file['dir'], video_file['filename']):
+                    FileFingerprint(video_file['size'], video_file['mtime_ns'], video_file['partial_hash'])
+            }
+            if not self._is_file_already_scanned(name, dirpath, scanned_fingerprints, fingerprints_to_update):
+                files_to_scan.append(FileToScan(dirpath, name, changed=video_file is not None))
+                continue
+            scan_configs = {(video_file['dir'], video_file['filename']):
+                            json.loads(video_file['scan_config']) if video_file['scan_config'] else None}
+            file_to_scan = self._incremental_file_to_scan(name, dirpath, scan_configs, scan_configs_to_update,
+                                                          due_online_misses)
+            if file_to_scan is not None:
+                files_to_scan.append(file_to_scan)
+        if fingerprints_to_update:
+            self._storage.update_video_file_fingerprints(fingerprints_to_update)
+        if scan_configs_to_update:
+            self._storage.update_video_file_scan_configs(scan_configs_to_update)
+        return files_to_scan
 
-        scanned_files = [self._read_subtitles(file_to_scan) for file_to_scan in files_to_scan]
+    def _enqueue_jobs(self, files_to_scan: Iterable[FileToScan]):
+        """
+        Add files to the job queue shared by all workers of the db, in chunks, so other workers start
+        while the library is still walked
+        """
+        chunk = []
+        for file_to_scan in files_to_scan:
+            chunk.append((file_to_scan.root, file_to_scan.filename))
+            if len(chunk) >= self.app_config.commit_every:
+                self._storage.enqueue_jobs(chunk)
+                chunk = []
+        if chunk:
+            self._storage.enqueue_jobs(chunk)
 
-        for scanned_file in scanned_files:
-            self._extract_subs(scanned_file)
-            self._merge_subs(scanned_file)
-            self._save_scanned_files(scanned_file)
+    def _iter_claimed_files(self, lease: timedelta) -> Iterator[FileToScan]:
+        """
+        Claim jobs as the pipeline needs them until no job is left to claim.
+        A job of a file scanned by another worker since it was queued is done at once
+        """
+        while True:
+            jobs = self._storage.claim_jobs(self._worker_id, self.app_config.jobs or 1, lease,
+                                            self.app_config.job_max_attempts)
+            if not jobs:
+                return
+            files_to_scan = self._files_to_scan_from_paths([os.path.join(dir, filename) for dir, filename in jobs])
+            files_to_scan_keys = {(file_to_scan.root.rstrip('/'), file_to_scan.filename)
+                                  for file_to_scan in files_to_scan}
+            for dir, filename in jobs:
+                if (dir, filename) not in files_to_scan_keys:
+                    self._storage.finish_job(dir, filename, self._worker_id)
+            yield from files_to_scan
+
+    @contextmanager
+    def _lease_heartbeat(self, lease: timedelta):
+        """
+        Renew leases of claimed jobs every third of the lease from a thread with its own db connection,
+        so a long extraction keeps its lease while jobs of a crashed worker return to the queue
+        """
+        stop = threading.Event()
+
+        def renew_leases():
+            with Storage(self._storage.db_file, self._storage.wal) as storage:
+                while not stop.wait(lease.total_seconds() / 3):
+                    try:
+                        storage.renew_job_leases(self._worker_id, lease)
+                    except Exception as e:
+                        logging.error(f"Renew job leases error {e}")
+
+        heartbeat = threading.Thread(target=renew_leases, name='lease-heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def _scan_job_queue(self):
+        """
+        Process jobs of the queue shared by all workers of the db until no job can be claimed
+        """
+        lease = timedelta(seconds=self.app_config.job_lease_seconds)
+        logging.info(f"Worker {self._worker_id} processes the job queue")
+        with self._lease_heartbeat(lease):
+            self._scan(self._iter_claimed_files(lease), job_queue=True)
+        job_counts = self._storage.count_jobs()
+        logging.info(f"Job queue: {', '.join(f'{count} {state}' for state, count in sorted(job_counts.items()))}")
+
+    def scan_files(self):
+        self._check()
+        files_to_scan = self._metrics.timed_iter('walk', self._iter_files_to_scan())
+        if self.app_config.job_queue:
+            self._enqueue_jobs(files_to_scan)
+            self._scan_job_queue()
+        else:
+            self._scan(files_to_scan)
+
+    def watch(self, settle_seconds: float = 10, stop: threading.Event = None):
+        """
+        Scan the whole target directory once, then stay resident and scan only files
+        which are created, rewritten or moved into it
+        :param settle_seconds: a file is scanned when its size and mtime haven't changed for this time
+        :param stop: watching ends when the event is set
+        """
+        self._check()
+        if not os.path.isdir(self.app_config.target_path):
+            sys.exit(f"Error, {self.app_config.target_path} is not a directory, only a directory can be watched")
+        # the watcher starts first, so files written during the initial scan aren't missed
+        with InotifyWatcher(self.app_config.target_path, _SUPPORTED_FILE_EXTENSIONS, settle_seconds,
+                            self.app_config.exclude_dirs) as watcher:
+            self.scan_files()
+            logging.info(f"Watching {self.app_config.target_path} for new files")
+            while stop is None or not stop.is_set():
+                paths = watcher.wait_for_files(timeout=None if stop is None else 1)
+                if paths:
+                    logging.info(f"Files written: {paths}")
+                    if self.app_config.job_queue:
+                        self._storage.enqueue_jobs([os.path.split(path) for path in paths])
+                        self._scan_job_queue()
+                    else:
+                        self._scan(self._files_to_scan_from_paths(paths))
 
 
 if __name__ == '__main__':
@@ -257,13 +979,20 @@ if __name__ == '__main__':
         }
 
 
+    def parse_language(code: str) -> Iso639:
+        language = util.iso639_from_str(code.strip())
+        if language is None:
+            sys.exit(f"Error, unknown language {code}")
+        return language
+
+
     def parse_merge_langs(parameter: str) -> List[List[Iso639]]:
         if parameter is None:
             return []
         languages_pairs = {pair.strip() for pair in parameter.split(',')}
 
         def parse_languages_pair_to_iso639_pair(languages_pair_str):
-            return [iso639.get(part1=x) for x in (languages_pair_str.split('-'))]
+            return [parse_language(x) for x in (languages_pair_str.split('-'))]
 
         iso639_pairs = [parse_languages_pair_to_iso639_pair(pair_str) for pair_str in languages_pairs]
         return [pair for pair in iso639_pairs if len(pair) == 2]
@@ -272,7 +1001,7 @@ if __name__ == '__main__':
     def parse_languages(parameter: str) -> List[Iso639]:
         if parameter is None:
             return []
-        return [iso639.get(part1=lang) for lang in {x.strip() for x in (parameter.split(','))}]
+        return [parse_language(lang) for lang in {x.strip() for x in (parameter.split(','))}]
 
 
     def get_root_dir(path: str) -> str:
@@ -283,7 +1012,7 @@ if __name__ == '__main__':
 
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('path', help='extracting path to a folder or to a file', type=str)
+    parser.add_argument('path', help='extracting path to a folder or to a file', type=str, nargs='?')
     parser.add_argument('--validation-regex', help='validation folders/files regex', type=str)
     parser.add_argument('--opensubtitles',
                         help='auth for opensubtitles, example value--: username=myusername,password=mypassword',
@@ -292,13 +1021,95 @@ if __name__ == '__main__':
                         help='two languages for merge 2-letter code, example: ru-fr,ru-en. It\'ll generate subtitle xxx.ru_fr.ass with ru on top and fr on bot',
                         type=str)
     parser.add_argument('--languages',
-                        help='languages to extract and download in format iso639-1 separated by \',\', example: en,ru,fr',
+                        help='languages to extract and download in format iso639-1 or iso639-2/3 separated by \',\', '
+                             'example: en,ru,fre',
                         type=str)
     parser.add_argument('--db-file', help='Full path to sqlite file', type=str, default='.extract-subs.sqlite3')
     parser.add_argument('--no-download-subtitles-online', dest='download_online',
                         action='store_false', help='do not try to download missed subtitles online')
+    parser.add_argument('--jobs', help='number of files processed in parallel', type=int, default=1)
+    parser.add_argument('--demux-jobs-per-device', type=int, default=1,
+                        help='number of mkvextract running in parallel per disk, mkvextract reads the whole file '
+                             'and parallel reads of one spinning disk are slower than serial ones')
+    parser.add_argument('--exclude-dirs', type=str, default=','.join(walker.DEFAULT_EXCLUDE_DIRS),
+                        help='globs of directories which aren\'t scanned separated by \',\', matched against a directory '
+                             'name or the whole path if a glob contains /, default: %(default)s')
+    parser.add_argument('--walk-jobs', type=int, default=1,
+                        help='number of top level directories walked in parallel, e.g. on different disks')
+    parser.add_argument('--fingerprint-hash-mb',
+                        help='hash first and last N megabytes of a video to detect a replaced file with the same size, '
+                             '0 - compare only size and modification time',
+                        type=int, default=0)
+    parser.add_argument('--commit-every', help='commit scan results to the db once per N files', type=int,
+                        default=100)
+    parser.add_argument('--subtitle-providers', type=str,
+                        help='subliminal providers to download subtitles from separated by \',\', default: all')
+    parser.add_argument('--download-batch-size', type=int, default=20,
+                        help='number of files looked up online with one login to the subtitle providers')
+    parser.add_argument('--watch', action='store_true',
+                        help='after the scan stay running and scan new files as soon as they are written')
+    parser.add_argument('--watch-settle-seconds', type=float, default=10,
+                        help='in watch mode a file is scanned after it hasn\'t changed for N seconds')
+    parser.add_argument('--online-miss-recheck-days', type=float, default=1,
+                        help='a subtitle not found online is looked up again after N days, the interval doubles after '
+                             'every next miss')
+    parser.add_argument('--list-online-misses', action='store_true',
+                        help='print subtitles which weren\'t found online with the next check time and exit')
+    parser.add_argument('--clear-online-misses', action='store_true',
+                        help='forget subtitles which weren\'t found online, so they are looked up on the next scan')
+    parser.add_argument('--metrics', action='store_true',
+                        help='print counts and timings of the walk, probe, extract, download, merge and db stages '
+                             'at exit')
+    parser.add_argument('--metrics-json', type=str, help='write the metrics to a JSON file at exit')
+    parser.add_argument('--metrics-prometheus', type=str,
+                        help='write the metrics to a file for the node_exporter textfile collector at exit, '
+                             'example: /var/lib/node_exporter/textfile/extract_subs.prom')
+    parser.add_argument('--job-queue', action='store_true',
+                        help='share the work with other workers using the same db file: files to scan are queued '
+                             'in the db and every worker claims them, a file of a crashed worker is queued again '
+                             'when its lease expires')
+    parser.add_argument('--worker-id', type=str, help='name of the worker in the job queue, default: host:pid')
+    parser.add_argument('--job-lease-seconds', type=float, default=600,
+                        help='a claimed file is returned to the job queue if its worker doesn\'t renew the lease '
+                             'for N seconds')
+    parser.add_argument('--job-max-attempts', type=int, default=3,
+                        help='a file of the job queue fails after N unsuccessful attempts, a failed attempt is '
+                             'retried after --retry-failed-after-hours')
+    parser.add_argument('--no-wal', dest='wal', action='store_false',
+                        help='use a rollback journal instead of WAL, needed when workers on several hosts share '
+                             'the db file over a network filesystem')
+    parser.add_argument('--subprocess-timeout-scale', type=float, default=1,
+                        help='multiplier of mkvmerge and mkvextract timeouts, mkvextract may run 60 seconds plus '
+                             '1 second per 5 MB of the file, 0 - no timeouts')
+    parser.add_argument('--retry-failed-after-hours', type=float, default=24,
+                        help='a file which failed or timed out is scanned again after N hours or when it changes')
+    parser.add_argument('--no-extracted-subtitle-files', dest='write_extracted_subtitles', action='store_false',
+                        help='extract embedded subtitles into memory only to merge them, no .srt file is written '
+                             'next to a movie')
+    parser.add_argument('--list-failed-files', action='store_true',
+                        help='print files which failed with the error and the retry time and exit')
     parser.set_defaults(download_online=True)
     args = parser.parse_args()
+    if args.list_online_misses:
+        with Storage(args.db_file) as storage:
+            for miss in storage.get_all_online_subtitle_misses():
+                print(f"{miss['video_path']}\t{miss['language_iso639_3']}\tattempts: {miss['attempts']}\t"
+                      f"next check: {miss['next_check_time']}")
+        sys.exit(0)
+    if args.list_failed_files:
+        with Storage(args.db_file) as storage:
+            for failed_file in storage.get_failed_files().values():
+                print(f"{os.path.join(failed_file['dir'], failed_file['filename'])}\t"
+                      f"attempts: {failed_file['attempts']}\tretry after: {failed_file['retry_after']}\t"
+                      f"{failed_file['error']}")
+        sys.exit(0)
+    if args.clear_online_misses:
+        with Storage(args.db_file) as storage:
+            storage.delete_online_subtitle_misses()
+        if args.path is None:
+            sys.exit(0)
+    if args.path is None:
+        parser.error('the following arguments are required: path')
     path = args.path
     validation_regex = args.validation_regex or '.*'
     opensubtitles = args.opensubtitles or ''
@@ -306,13 +1117,39 @@ if __name__ == '__main__':
     merge_languages_pairs = parse_merge_langs(args.merge_languages)
     target_languages = parse_languages(args.languages)
 
-    with Storage(args.db_file) as storage:
+    with Storage(args.db_file, args.wal) as storage:
         storage._migrate_from_cache_file(os.path.join(get_root_dir(path), CACHE_FILE_NAME))
 
         app_run_config = AppRunConfig(target_path=path, target_languages=target_languages,
                                       merge_languages_pairs=merge_languages_pairs,
                                       validation_regex=validation_regex, opensubtitles_auth=opensubtitles_auth,
-                                      download_online=args.download_online)
+                                      download_online=args.download_online, jobs=args.jobs,
+                                      fingerprint_hash_mb=args.fingerprint_hash_mb, commit_every=args.commit_every,
+                                      download_batch_size=args.download_batch_size,
+                                      subtitle_providers=args.subtitle_providers.split(',')
+                                      if args.subtitle_providers else None,
+                                      online_miss_recheck_days=args.online_miss_recheck_days,
+                                      demux_jobs_per_device=args.demux_jobs_per_device,
+                                      exclude_dirs=[x.strip() for x in args.exclude_dirs.split(',') if x.strip()],
+                                      walk_jobs=args.walk_jobs, job_queue=args.job_queue, worker_id=args.worker_id,
+                                      job_lease_seconds=args.job_lease_seconds,
+                                      job_max_attempts=args.job_max_attempts,
+                                      subprocess_timeout_scale=args.subprocess_timeout_scale,
+                                      retry_failed_after_hours=args.retry_failed_after_hours,
+                                      write_extracted_subtitles=args.write_extracted_subtitles)
 
-        sub_extract = ExtractSubs(app_run_config, storage)
-        sub_extract.scan_files()
+        metrics = Metrics() if args.metrics or args.metrics_json or args.metrics_prometheus else None
+        sub_extract = ExtractSubs(app_run_config, storage, metrics)
+        try:
+            if args.watch:
+                sub_extract.watch(args.watch_settle_seconds)
+            else:
+                sub_extract.scan_files()
+        finally:
+            if metrics is not None:
+                if args.metrics:
+                    print(metrics.summary())
+                if args.metrics_json:
+                    metrics.write_json(args.metrics_json)
+                if args.metrics_prometheus:
+                    metrics.write_prometheus(args.metrics_prometheus)
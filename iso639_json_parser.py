@@ -2,12 +2,13 @@ import json
 
 from iso639 import languages
 
+import util
 
-class Iso639Encoder(json.JSONEncoder):
-    _iso639_type = type(list(languages)[0])
 
+class Iso639Encoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, self._iso639_type):
+        # type of languages items, resolved on use to not load all languages on import
+        if isinstance(obj, type(next(iter(languages)))):
             return {
                 "_type": "iso639_3_lang",
                 "value": obj.part3
@@ -23,5 +24,5 @@ class Iso639Decoder(json.JSONDecoder):
         if '_type' not in obj:
             return obj
         if obj['_type'] == 'iso639_3_lang' and 'value' in obj:
-            return languages.get(part3=obj['value'])
+            return util.iso639_from_str(obj['value'])
         return obj
@@ -1,19 +1,89 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
+import copy
+import os
+from functools import lru_cache
+
 import chardet
 import pysubs2
-from pysubs2 import SSAStyle, Color
+from chardet.universaldetector import UniversalDetector
+from pysubs2 import SSAFile, SSAStyle, Color
 
+_DETECT_CHUNK_SIZE = 64 * 1024
+# subtitle text is at the start of a file, the end of a big ASS file is usually embedded fonts
+_DETECT_MAX_BYTES = 1024 * 1024
+_DETECT_MIN_CONFIDENCE = 0.9
 
-def charset_detect(filename):
+
+def _detect_whole_file_encoding(filename):
     with open(filename, 'rb') as fi:
         return chardet.detect(fi.read())['encoding']
 
 
+@lru_cache(maxsize=1024)
+def _detect_encoding(filename, size, mtime_ns):
+    detector = UniversalDetector()
+    read_bytes = 0
+    with open(filename, 'rb') as fi:
+        while not detector.done and read_bytes < _DETECT_MAX_BYTES:
+            chunk = fi.read(_DETECT_CHUNK_SIZE)
+            if not chunk:
+                break
+            detector.feed(chunk)
+            read_bytes += len(chunk)
+    result = detector.close()
+    if result['encoding'] == 'ascii':
+        # utf-8 is a superset of ascii, e.g. an English ASS file with uuencoded fonts is ascii to its end
+        return 'utf-8'
+    if read_bytes < size and result['confidence'] < _DETECT_MIN_CONFIDENCE:
+        # the prefix isn't enough
+        return _detect_whole_file_encoding(filename)
+    return result['encoding']
+
+
+def charset_detect(filename):
+    """
+    Detect an encoding by the first chunks of a file until chardet is confident,
+    a result is cached until the file is changed
+    """
+    stat = os.stat(filename)
+    return _detect_encoding(filename, stat.st_size, stat.st_mtime_ns)
+
+
+def load(filename) -> SSAFile:
+    try:
+        return pysubs2.load(filename, encoding=charset_detect(filename))
+    except UnicodeDecodeError:
+        # an ascii prefix is decoded as utf-8, though the rest of the file can be in another encoding
+        return pysubs2.load(filename, encoding=_detect_whole_file_encoding(filename))
+
+
+def loads(content: bytes) -> SSAFile:
+    """
+    Load subtitles extracted into memory, mkvextract writes text subtitles in UTF-8
+    """
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = content.decode(chardet.detect(content)['encoding'] or 'utf-8', errors='replace')
+    return SSAFile.from_string(text)
+
+
 def merge(file1, file2, outfile):
-    subs1 = pysubs2.load(file1, encoding=charset_detect(file1))
-    subs2 = pysubs2.load(file2, encoding=charset_detect(file2))
+    merge_loaded(load(file1), load(file2)).save(outfile)
+
+
+def merge_loaded(subs_top: SSAFile, subs_bot: SSAFile) -> SSAFile:
+    """
+    Merge already loaded subtitles: subs_top on top of the screen and subs_bot on the bottom.
+    Loaded subtitles aren't changed, so one loaded file can be merged into several language pairs
+    """
+    subs1 = subs_top
+    subs2 = copy.copy(subs_bot)
+    subs2.info = dict(subs_bot.info)
+    subs2.styles = {name: style.copy() for name, style in subs_bot.styles.items()}
+    subs2.events = [line.copy() for line in subs_bot.events]
 
     '''[V4+ Styles]
 Format: Name,Fontname,Fontsize,PrimaryColour,SecondaryColour,OutlineColour,BackColour,Bold,Italic,Underline,StrikeOut,ScaleX,ScaleY,Spacing,Angle,BorderStyle,Outline,Shadow,Alignment,MarginL,MarginR,MarginV,Encoding
@@ -42,10 +112,11 @@ Style:  Bot ,Arial   ,16      ,&H00F9FFF9   ,&H00FFFFFF     ,&H00000000   ,&H000
         line.style = 'bot'
 
     for line in subs1:
+        line = line.copy()
         line.style = 'top'
         subs2.append(line)
 
     subs2.styles["Default"].fontsize = 14.0
     subs2.styles["Default"].shadow = 0.5
     subs2.styles["Default"].outline = 1.0
-    subs2.save(outfile)
+    return subs2
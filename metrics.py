@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Iterator
+
+# seconds, a file is probed in milliseconds and extracted from a remux in minutes
+_LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+_PROMETHEUS_PREFIX = 'extract_subs'
+
+
+class _StageMetrics:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # the last bucket is +Inf
+        self.buckets = [0] * (len(_LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect_left(_LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'buckets': dict(zip([*map(str, _LATENCY_BUCKETS), '+Inf'], self.buckets)),
+        }
+
+
+class Metrics:
+    """
+    Counts, bytes read and latency histograms of the scan pipeline stages, safe to update from several threads
+    """
+    enabled = True
+
+    def __init__(self):
+        self._stages: Dict[str, _StageMetrics] = {}
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._start = time.monotonic()
+
+    def _stage(self, name: str) -> _StageMetrics:
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages.setdefault(name, _StageMetrics())
+        return stage
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a block as one operation of the stage, an exception is counted as an error of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self._stage(name).errors += 1
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._stage(name).observe(seconds)
+
+    def add_bytes(self, name: str, count: int):
+        with self._lock:
+            self._stage(name).bytes += count
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        Time producing every item of a lazy iterable, e.g. walking a directory tree
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'start_time': self._start_time,
+                'run_seconds': time.monotonic() - self._start,
+                'stages': {name: stage.to_dict() for name, stage in self._stages.items()},
+            }
+
+    def summary(self) -> str:
+        metrics = self.to_dict()
+        lines = [f"Run took {metrics['run_seconds']:.1f}s",
+                 f"{'stage':<14}{'count':>8}{'errors':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'MB read':>10}"]
+        for name, stage in metrics['stages'].items():
+            mean_ms = stage['seconds'] / stage['count'] * 1000 if stage['count'] else 0
+            lines.append(f"{name:<14}{stage['count']:>8}{stage['errors']:>8}{stage['seconds']:>10.2f}"
+                         f"{mean_ms:>10.1f}{stage['max_seconds'] * 1000:>10.1f}{stage['bytes'] / 1024 / 1024:>10.1f}")
+        return '\n'.join(lines)
+
+    def to_prometheus(self) -> str:
+        metrics = self.to_dict()
+        stages = metrics['stages']
+        name = f"{_PROMETHEUS_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Latency of one operation of a scan stage", f"# TYPE {name} histogram"]
+        for stage_name, stage in stages.items():
+            cumulative = 0
+            for le, count in stage['buckets'].items():
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage_name}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage_name}"}} {stage["seconds"]}')
+            lines.append(f'{name}_count{{stage="{stage_name}"}} {stage["count"]}')
+        for metric, help_text in [('errors', 'Failed operations of a scan stage'),
+                                  ('bytes', 'Bytes read by a scan stage')]:
+            name = f"{_PROMETHEUS_PREFIX}_stage_{metric}_total"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f'{name}{{stage="{stage_name}"}} {stage[metric]}' for stage_name, stage in stages.items()]
+        for metric, help_text, value in [('run_seconds', 'Duration of the last run', metrics['run_seconds']),
+                                         ('last_run_timestamp_seconds', 'Start time of the last run',
+                                          metrics['start_time'])]:
+            name = f"{_PROMETHEUS_PREFIX}_{metric}"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path: str):
+        _write_atomically(path, json.dumps(self.to_dict(), indent=4))
+
+    def write_prometheus(self, path: str):
+        """
+        Write a textfile for the node_exporter textfile collector
+        """
+        _write_atomically(path, self.to_prometheus())
+
+
+class NullMetrics(Metrics):
+    """
+    Metrics which record nothing, used when metrics are disabled
+    """
+    enabled = False
+    _NULL_CONTEXT = nullcontext()
+
+    def stage(self, name: str):
+        return NullMetrics._NULL_CONTEXT
+
+    def add_bytes(self, name: str, count: int):
+        pass
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterable:
+        return iterable
+
+
+def _write_atomically(path: str, content: str):
+    # node_exporter may read the file at any moment, it has to see the whole file or the previous one
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
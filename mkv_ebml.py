@@ -0,0 +1,192 @@
+from io import BytesIO
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+# https://www.matroska.org/technical/elements.html
+_EBML_HEADER_ID = 0x1A45DFA3
+_EBML_DOC_TYPE_ID = 0x4282
+_SEGMENT_ID = 0x18538067
+_SEEK_HEAD_ID = 0x114D9B74
+_SEEK_ID = 0x4DBB
+_SEEK_ELEMENT_ID = 0x53AB
+_SEEK_POSITION_ID = 0x53AC
+_TRACKS_ID = 0x1654AE6B
+_CLUSTER_ID = 0x1F43B675
+_TRACK_ENTRY_ID = 0xAE
+
+_TRACK_NUMBER_ID = 0xD7
+_TRACK_UID_ID = 0x73C5
+_TRACK_TYPE_ID = 0x83
+_FLAG_ENABLED_ID = 0xB9
+_FLAG_DEFAULT_ID = 0x88
+_FLAG_FORCED_ID = 0x55AA
+_NAME_ID = 0x536E
+_LANGUAGE_ID = 0x22B59C
+_LANGUAGE_IETF_ID = 0x22B59D
+_CODEC_ID_ID = 0x86
+_CODEC_PRIVATE_ID = 0x63A2
+
+_MATROSKA_DOC_TYPES = {'matroska', 'webm'}
+# track types as reported by mkvmerge -J
+_TRACK_TYPES = {
+    1: 'video',
+    2: 'audio',
+    0x11: 'subtitles',
+    0x12: 'buttons',
+}
+_UNKNOWN_SIZE = -1
+# a Tracks element of a real file is a few KB, anything bigger is a broken file
+_MAX_TRACKS_SIZE = 16 * 1024 * 1024
+
+
+class EBMLError(ValueError):
+    pass
+
+
+def _read_vint(stream: BinaryIO, keep_marker: bool) -> Tuple[int, int]:
+    """
+    Read an EBML variable size integer
+    :return: value and count of read bytes, value is _UNKNOWN_SIZE for a reserved "unknown" size
+    """
+    first = stream.read(1)
+    if not first:
+        raise EOFError()
+    first_byte = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first_byte & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise EBMLError(f"Invalid EBML variable size integer at {stream.tell() - 1}")
+    rest = stream.read(length - 1)
+    if len(rest) != length - 1:
+        raise EOFError()
+    value = first_byte if keep_marker else first_byte & (mask - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return _UNKNOWN_SIZE, length
+    return value, length
+
+
+def _read_element_header(stream: BinaryIO) -> Tuple[int, int]:
+    element_id, _ = _read_vint(stream, keep_marker=True)
+    size, _ = _read_vint(stream, keep_marker=False)
+    return element_id, size
+
+
+def _iter_children(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    stream = BytesIO(data)
+    while stream.tell() < len(data):
+        element_id, size = _read_element_header(stream)
+        if size == _UNKNOWN_SIZE:
+            raise EBMLError(f"Unknown size of element {element_id:X} inside a master element")
+        value = stream.read(size)
+        if len(value) != size:
+            raise EBMLError(f"Truncated element {element_id:X}")
+        yield element_id, value
+
+
+def _uint(data: bytes) -> int:
+    return int.from_bytes(data, 'big') if data else 0
+
+
+def _string(data: bytes) -> str:
+    return data.split(b'\0', 1)[0].decode('utf-8', errors='replace')
+
+
+def _read_element(stream: BinaryIO, size: int) -> bytes:
+    if size == _UNKNOWN_SIZE or size > _MAX_TRACKS_SIZE:
+        raise EBMLError(f"Unexpected element size {size}")
+    data = stream.read(size)
+    if len(data) != size:
+        raise EBMLError("Truncated element")
+    return data
+
+
+def _seek_positions(seek_head: bytes) -> dict:
+    positions = {}
+    for element_id, value in _iter_children(seek_head):
+        if element_id != _SEEK_ID:
+            continue
+        seek = dict(_iter_children(value))
+        if _SEEK_ELEMENT_ID in seek and _SEEK_POSITION_ID in seek:
+            positions[_uint(seek[_SEEK_ELEMENT_ID])] = _uint(seek[_SEEK_POSITION_ID])
+    return positions
+
+
+def _find_tracks(stream: BinaryIO) -> bytes:
+    element_id, size = _read_element_header(stream)
+    if element_id != _EBML_HEADER_ID:
+        raise EBMLError("Not an EBML file")
+    doc_type = dict(_iter_children(_read_element(stream, size))).get(_EBML_DOC_TYPE_ID)
+    if doc_type is None or _string(doc_type) not in _MATROSKA_DOC_TYPES:
+        raise EBMLError(f"Unsupported EBML doc type {doc_type}")
+
+    element_id, _ = _read_element_header(stream)
+    if element_id != _SEGMENT_ID:
+        raise EBMLError("No Segment element")
+    segment_start = stream.tell()
+
+    tracks_position: Optional[int] = None
+    while True:
+        try:
+            element_id, size = _read_element_header(stream)
+        except EOFError:
+            break
+        if element_id == _TRACKS_ID:
+            return _read_element(stream, size)
+        if element_id == _SEEK_HEAD_ID and tracks_position is None:
+            tracks_position = _seek_positions(_read_element(stream, size)).get(_TRACKS_ID)
+            if tracks_position is not None:
+                stream.seek(segment_start + tracks_position)
+                element_id, size = _read_element_header(stream)
+                if element_id != _TRACKS_ID:
+                    raise EBMLError("SeekHead doesn't point to the Tracks element")
+                return _read_element(stream, size)
+            continue
+        if element_id == _CLUSTER_ID or size == _UNKNOWN_SIZE:
+            # media data starts, a file without Tracks before the first Cluster isn't supported
+            break
+        stream.seek(size, 1)
+    raise EBMLError("No Tracks element")
+
+
+def _parse_track_entry(track_id: int, track_entry: bytes) -> dict:
+    elements = dict(_iter_children(track_entry))
+    properties = {
+        'codec_id': _string(elements.get(_CODEC_ID_ID, b'')),
+        'codec_private_length': len(elements.get(_CODEC_PRIVATE_ID, b'')),
+        'default_track': _uint(elements.get(_FLAG_DEFAULT_ID, b'\1')) == 1,
+        'enabled_track': _uint(elements.get(_FLAG_ENABLED_ID, b'\1')) == 1,
+        'forced_track': _uint(elements.get(_FLAG_FORCED_ID, b'\0')) == 1,
+        # Matroska default value of Language is "eng"
+        'language': _string(elements.get(_LANGUAGE_ID, b'eng')),
+        'number': _uint(elements.get(_TRACK_NUMBER_ID)),
+        'uid': _uint(elements.get(_TRACK_UID_ID)),
+    }
+    if _LANGUAGE_IETF_ID in elements:
+        properties['language_ietf'] = _string(elements[_LANGUAGE_IETF_ID])
+    if _NAME_ID in elements:
+        properties['track_name'] = _string(elements[_NAME_ID])
+    return {
+        'id': track_id,
+        'type': _TRACK_TYPES.get(_uint(elements.get(_TRACK_TYPE_ID)), 'unknown'),
+        'properties': properties,
+    }
+
+
+def read_tracks(file_path: str) -> List[dict]:
+    """
+    Read track headers of a Matroska file without spawning mkvmerge.
+    Only the EBML header, the SeekHead and the Tracks element are read.
+    :return: tracks in the same format as "tracks" of `mkvmerge -J` output
+    :raise EBMLError: the file can't be parsed
+    """
+    try:
+        with open(file_path, 'rb') as stream:
+            tracks = _find_tracks(stream)
+        track_entries = [value for element_id, value in _iter_children(tracks) if element_id == _TRACK_ENTRY_ID]
+        return [_parse_track_entry(track_id, track_entry) for track_id, track_entry in enumerate(track_entries)]
+    except EOFError as e:
+        raise EBMLError(f"Unexpected end of file {file_path}") from e
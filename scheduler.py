@@ -0,0 +1,56 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+
+class DeviceScheduler:
+    """
+    Run I/O heavy jobs on a separate pool of workers per device (st_dev) of the file a job reads:
+    jobs reading the same disk are limited to jobs_per_device, so a spinning disk doesn't seek between
+    several streams, while files on other disks are read in parallel.
+    Has the submit(fn, item) interface of an executor, so it can replace one for a pipeline stage
+    """
+
+    def __init__(self, jobs_per_device: int = 1, path_of: Callable[[Any], str] = lambda item: item):
+        """
+        :param path_of: path of the file a job item reads
+        """
+        self._jobs_per_device = max(jobs_per_device, 1)
+        self._path_of = path_of
+        self._executors: Dict[Optional[int], ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+
+    @staticmethod
+    def _device(path: str) -> Optional[int]:
+        try:
+            return os.stat(path).st_dev
+        except OSError as e:
+            logging.error(f"Can't stat {path}: {e}")
+            return None
+
+    def _executor(self, device: Optional[int]) -> ThreadPoolExecutor:
+        with self._lock:
+            executor = self._executors.get(device)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=self._jobs_per_device,
+                                              thread_name_prefix=f"device-{device}")
+                self._executors[device] = executor
+            return executor
+
+    def submit(self, fn: Callable, item: Any) -> Future:
+        return self._executor(self._device(self._path_of(item))).submit(fn, item)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors.clear()
+        for executor in executors:
+            executor.shutdown(wait=wait)
@@ -2,18 +2,46 @@ import json
 import logging
 import os
 import sqlite3
-from datetime import datetime
-from typing import List
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import List, Tuple, Dict
 
 from iso639_json_parser import Iso639Decoder, Iso639Encoder
+from util import FileFingerprint
+
+VideoSubtitleRecord = namedtuple('VideoSubtitleRecord', ['full_path', 'language_iso639_3', 'track_id', 'source',
+                                                         'merge_inputs', 'codec_id'], defaults=(None, None))
+VideoFileScanRecord = namedtuple('VideoFileScanRecord', ['dir', 'filename', 'fingerprint', 'subtitles', 'scan_config'],
+                                 defaults=(None,))
+
+# states of a job of the queue shared by workers of one db
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
 
 
 class Storage:
     _VIDEO_SUBTITLE_FILE_TABLE = 'video_subtitle'
     _VIDEO_FILE_TABLE = 'video_file'
+    _ONLINE_SUBTITLE_MISS_TABLE = 'online_subtitle_miss'
+    _JOB_TABLE = 'job'
 
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+    def __init__(self, db_file, wal: bool = True):
+        """
+        :param wal: WAL needs shared memory of processes using the db, so it doesn't work
+        for processes on several hosts sharing the db file over a network filesystem
+        """
+        self.db_file = db_file
+        self.wal = wal
+        # several workers can share the db, a writer waits for the lock instead of failing at once
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self._bulk_commit_every = None
+        self._bulk_commit_interval = None
+        self._bulk_pending_files = 0
+        self._bulk_last_commit = 0.0
 
         def dict_factory(cursor, row):
             d = {}
@@ -22,6 +50,12 @@ class Storage:
             return d
 
         self.conn.row_factory = dict_factory  # sqlite3.Row
+        if wal:
+            # readers don't block the writer, a commit doesn't fsync the db file
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        else:
+            self.conn.execute("PRAGMA journal_mode=DELETE")
         self.__ini_db()
 
     def __ini_db(self):
@@ -30,7 +64,11 @@ class Storage:
         id INTEGER PRIMARY KEY,
         dir TEXT NOT NULL,
         filename TEXT NOT NULL,
-        scan_time TEXT NOT NULL)
+        scan_time TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        partial_hash TEXT,
+        scan_config TEXT)
         """
         sql_create_file_subtitle_table = f"""
         CREATE TABLE IF NOT EXISTS {Storage._VIDEO_SUBTITLE_FILE_TABLE} (
@@ -40,32 +78,236 @@ class Storage:
           language_iso639_3 TEXT NOT NULL,
           track_id INTEGER,
           source TEXT NOT NULL,
+          merge_inputs TEXT,
+          codec_id TEXT,
           FOREIGN KEY(video_file_id) REFERENCES video_file(id))
         """
 
         for sql in [sql_create_file_table, sql_create_file_subtitle_table]:
             self.conn.execute(sql)
+        self.__migrate_schema()
+
+    def __migrate_schema(self):
+        """
+        Apply schema migrations newer than the db version stored in PRAGMA user_version,
+        every migration runs in its own transaction together with the version bump
+        """
+        migrations = [self.__migration_fingerprint_columns, self.__migration_unique_video_file_and_indexes,
+                      self.__migration_online_subtitle_miss_table, self.__migration_merge_inputs_column,
+                      self.__migration_scan_config_column, self.__migration_codec_id_column,
+                      self.__migration_job_table, self.__migration_job_retry_columns]
+        version = self.conn.execute("PRAGMA user_version").fetchone()['user_version']
+        for target_version, migration in enumerate(migrations, start=1):
+            if version >= target_version:
+                continue
+            # workers sharing the db can start together, the version is read again under the write lock
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = self.conn.execute("PRAGMA user_version").fetchone()['user_version']
+                if version < target_version:
+                    logging.info(f"Migrating db schema to version {target_version}")
+                    migration()
+                    self.conn.execute(f"PRAGMA user_version = {target_version}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def __migration_fingerprint_columns(self):
+        self.__add_missing_columns(Storage._VIDEO_FILE_TABLE,
+                                   {'size': 'INTEGER', 'mtime_ns': 'INTEGER', 'partial_hash': 'TEXT'})
+
+    def __migration_unique_video_file_and_indexes(self):
+        # plain INSERTs could have saved the same file several times, keep the latest scan
+        latest_video_files = f"SELECT max(id) FROM {Storage._VIDEO_FILE_TABLE} GROUP BY dir, filename"
+        self.conn.execute(f"DELETE FROM {Storage._VIDEO_SUBTITLE_FILE_TABLE} "
+                          f"WHERE video_file_id NOT IN ({latest_video_files})")
+        self.conn.execute(f"DELETE FROM {Storage._VIDEO_FILE_TABLE} WHERE id NOT IN ({latest_video_files})")
+        self.conn.execute(f"DELETE FROM {Storage._VIDEO_SUBTITLE_FILE_TABLE} WHERE id NOT IN "
+                          f"(SELECT max(id) FROM {Storage._VIDEO_SUBTITLE_FILE_TABLE} "
+                          f"GROUP BY video_file_id, full_path, language_iso639_3, source)")
+        self.conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {Storage._VIDEO_FILE_TABLE}_dir_filename "
+                          f"ON {Storage._VIDEO_FILE_TABLE} (dir, filename)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {Storage._VIDEO_SUBTITLE_FILE_TABLE}_video_file_id "
+                          f"ON {Storage._VIDEO_SUBTITLE_FILE_TABLE} (video_file_id)")
+
+    def __migration_online_subtitle_miss_table(self):
+        self.conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Storage._ONLINE_SUBTITLE_MISS_TABLE} (
+          video_hash TEXT NOT NULL,
+          language_iso639_3 TEXT NOT NULL,
+          video_path TEXT NOT NULL,
+          attempts INTEGER NOT NULL,
+          last_check_time TEXT NOT NULL,
+          next_check_time TEXT NOT NULL,
+          PRIMARY KEY (video_hash, language_iso639_3))
+        """)
+
+    def __migration_merge_inputs_column(self):
+        self.__add_missing_columns(Storage._VIDEO_SUBTITLE_FILE_TABLE, {'merge_inputs': 'TEXT'})
+
+    def __migration_scan_config_column(self):
+        self.__add_missing_columns(Storage._VIDEO_FILE_TABLE, {'scan_config': 'TEXT'})
+
+    def __migration_codec_id_column(self):
+        self.__add_missing_columns(Storage._VIDEO_SUBTITLE_FILE_TABLE, {'codec_id': 'TEXT'})
+
+    def __migration_job_table(self):
+        self.conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Storage._JOB_TABLE} (
+          dir TEXT NOT NULL,
+          filename TEXT NOT NULL,
+          state TEXT NOT NULL,
+          worker TEXT,
+          lease_expire_time TEXT,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          error TEXT,
+          update_time TEXT NOT NULL,
+          PRIMARY KEY (dir, filename))
+        """)
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {Storage._JOB_TABLE}_state ON {Storage._JOB_TABLE} (state)")
+
+    def __migration_job_retry_columns(self):
+        self.__add_missing_columns(Storage._JOB_TABLE,
+                                   {'retry_after': 'TEXT', 'size': 'INTEGER', 'mtime_ns': 'INTEGER'})
+
+    def __add_missing_columns(self, table: str, columns: Dict[str, str]):
+        existing_columns = {row['name'] for row in self.conn.execute(f"PRAGMA table_info({table})").fetchall()}
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
 
     def __enter__(self):
         return self
 
+    @contextmanager
+    def _transaction(self):
+        """
+        Commit on exit, inside of a bulk session commit is postponed until the session commits
+        """
+        if self._bulk_commit_every is not None:
+            yield
+        else:
+            with self.conn:
+                yield
+
+    @contextmanager
+    def bulk_session(self, commit_every: int = 100, commit_interval: float = None):
+        """
+        Group writes into one transaction committed once per commit_every files
+        saved by save_scan_results and at the end of the session
+        :param commit_interval: seconds, files saved later than this after the last commit are committed at once
+        """
+        if self._bulk_commit_every is not None:
+            yield self
+            return
+        self._bulk_commit_every = max(commit_every, 1)
+        self._bulk_commit_interval = commit_interval
+        self._bulk_pending_files = 0
+        self._bulk_last_commit = time.monotonic()
+        try:
+            with self.conn:
+                yield self
+        finally:
+            self._bulk_commit_every = None
+            self._bulk_commit_interval = None
+            self._bulk_pending_files = 0
+
+    def save_scan_results(self, scans: List[VideoFileScanRecord]):
+        """
+        Save scanned video files with their subtitles, a previous scan of the same file is replaced
+        """
+        with self._transaction():
+            subtitles = []
+            for scan in scans:
+                self.__delete_video_file(scan.dir, scan.filename)
+                fingerprint = scan.fingerprint or FileFingerprint(None, None, None)
+                scan_config = json.dumps(scan.scan_config) if scan.scan_config is not None else None
+                exec_r = self.conn.execute(
+                    f"INSERT INTO {self._VIDEO_FILE_TABLE} "
+                    f"(dir, filename, scan_time, size, mtime_ns, partial_hash, scan_config) VALUES (?,?,?,?,?,?,?)",
+                    (scan.dir.rstrip('/'), scan.filename, datetime.utcnow().isoformat(), *fingerprint, scan_config))
+                subtitles.extend((exec_r.lastrowid, subtitle.full_path, subtitle.language_iso639_3, subtitle.track_id,
+                                  subtitle.source,
+                                  json.dumps(subtitle.merge_inputs) if subtitle.merge_inputs is not None else None,
+                                  subtitle.codec_id)
+                                 for subtitle in scan.subtitles)
+            self.conn.executemany(
+                f"INSERT INTO {self._VIDEO_SUBTITLE_FILE_TABLE} "
+                f"(video_file_id, full_path, language_iso639_3, track_id, source, merge_inputs, codec_id) "
+                f"VALUES (?,?,?,?,?,?,?)",
+                subtitles)
+            # a file which failed before is scanned now
+            self.conn.executemany(f"DELETE FROM {self._JOB_TABLE} WHERE dir = ? AND filename = ? "
+                                  f"AND state = '{JOB_FAILED}'",
+                                  [(scan.dir.rstrip('/'), scan.filename) for scan in scans])
+
+        if self._bulk_commit_every is not None:
+            self._bulk_pending_files += len(scans)
+            interval_passed = self._bulk_commit_interval is not None and \
+                time.monotonic() - self._bulk_last_commit >= self._bulk_commit_interval
+            if self._bulk_pending_files >= self._bulk_commit_every or interval_passed:
+                self.conn.commit()
+                self._bulk_pending_files = 0
+                self._bulk_last_commit = time.monotonic()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn:
             self.conn.close()
 
-    def create_video_file(self, dir: str, filename: str, override_on_exist: bool = False) -> sqlite3.Row:
-        x = (dir.rstrip('/'), filename, datetime.utcnow().isoformat())
-        with self.conn as c:
-            exec_r = self.conn.execute(
-                f"INSERT {'OR REPLACE' if override_on_exist else ''} INTO {self._VIDEO_FILE_TABLE} "
-                f"(dir, filename, scan_time) VALUES (?,?,?)",
+    def create_video_file(self, dir: str, filename: str, override_on_exist: bool = False,
+                          fingerprint: FileFingerprint = None) -> sqlite3.Row:
+        fingerprint = fingerprint or FileFingerprint(None, None, None)
+        x = (dir.rstrip('/'), filename, datetime.utcnow().isoformat(), *fingerprint)
+        # on conflict the existing row is updated in place, so its subtitles stay attached to the same id
+        on_conflict = "ON CONFLICT(dir, filename) DO UPDATE SET scan_time = excluded.scan_time, " \
+                      "size = excluded.size, mtime_ns = excluded.mtime_ns, partial_hash = excluded.partial_hash"
+        with self._transaction():
+            self.conn.execute(
+                f"INSERT INTO {self._VIDEO_FILE_TABLE} "
+                f"(dir, filename, scan_time, size, mtime_ns, partial_hash) VALUES (?,?,?,?,?,?) "
+                f"{on_conflict if override_on_exist else ''}",
                 x)
-        return self.get_video_file_by_id(exec_r.lastrowid)
+        return self.get_video_file_by_full_path(os.path.join(dir, filename))
+
+    def update_video_file_fingerprints(self, fingerprints: List[Tuple[str, str, FileFingerprint]]):
+        """
+        :param fingerprints: list of (dir, filename, fingerprint)
+        """
+        with self._transaction():
+            self.conn.executemany(
+                f"UPDATE {self._VIDEO_FILE_TABLE} SET size = ?, mtime_ns = ?, partial_hash = ? "
+                f"WHERE dir = ? AND filename = ?",
+                [(*fingerprint, dir.rstrip('/'), filename) for (dir, filename, fingerprint) in fingerprints])
+
+    def update_video_file_scan_configs(self, scan_configs: List[Tuple[str, str, dict]]):
+        """
+        :param scan_configs: list of (dir, filename, scan_config)
+        """
+        with self._transaction():
+            self.conn.executemany(
+                f"UPDATE {self._VIDEO_FILE_TABLE} SET scan_config = ? WHERE dir = ? AND filename = ?",
+                [(json.dumps(scan_config), dir.rstrip('/'), filename) for (dir, filename, scan_config) in scan_configs])
+
+    def delete_video_file_by_full_path(self, full_path):
+        """
+        Delete a video file with all its subtitles
+        """
+        (dir, file_name) = os.path.split(full_path)
+        with self._transaction():
+            self.__delete_video_file(dir, file_name)
+
+    def __delete_video_file(self, dir: str, filename: str):
+        ids = [(row['id'],) for row in self.conn.execute(
+            f"SELECT id FROM {self._VIDEO_FILE_TABLE} WHERE dir = ? AND filename = ?", (dir.rstrip('/'), filename))]
+        if ids:
+            self.conn.executemany(f"DELETE FROM {self._VIDEO_SUBTITLE_FILE_TABLE} WHERE video_file_id = ?", ids)
+            self.conn.executemany(f"DELETE FROM {self._VIDEO_FILE_TABLE} WHERE id = ?", ids)
 
     def create_video_subtitle(self, video_file_id: int, full_path: str, language_iso639_3: str, track_id: int,
                               source='FILE', override_on_exist: bool = False) -> sqlite3.Row:
         x = (video_file_id, full_path, language_iso639_3, track_id, source)
-        with self.conn:
+        with self._transaction():
             exec_r = self.conn.execute(
                 f"INSERT {'OR REPLACE' if override_on_exist else ''} INTO {self._VIDEO_SUBTITLE_FILE_TABLE} "
                 f"(video_file_id, full_path, language_iso639_3, track_id, source) VALUES (?,?,?,?,?)",
@@ -103,6 +345,16 @@ class Storage:
                       f"instr(language_iso639_3, ',') and source = 'Merge'")
         return c.fetchall()
 
+    def get_merge_inputs(self) -> Dict[str, list]:
+        """
+        Inputs of all merged subtitles with a single query
+        :return: merged subtitle path -> inputs saved with it by save_scan_results
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT full_path, merge_inputs FROM {Storage._VIDEO_SUBTITLE_FILE_TABLE} "
+                  f"WHERE source = 'Merge' AND merge_inputs IS NOT NULL")
+        return {row['full_path']: json.loads(row['merge_inputs']) for row in c.fetchall()}
+
     def get_video_file_by_full_path(self, full_path) -> sqlite3.Row:
         (dir, file_name) = os.path.split(full_path)
         c = self.conn.cursor()
@@ -120,6 +372,208 @@ class Storage:
         x = c.fetchone()
         return x['count'] > 0
 
+    def get_online_subtitle_misses(self, video_hash: str) -> List[sqlite3.Row]:
+        c = self.conn.cursor()
+        c.execute(f"SELECT * FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE} WHERE video_hash = ?", (video_hash,))
+        return c.fetchall()
+
+    def get_all_online_subtitle_misses(self) -> List[sqlite3.Row]:
+        c = self.conn.cursor()
+        c.execute(f"SELECT * FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE} ORDER BY next_check_time")
+        return c.fetchall()
+
+    def get_due_online_subtitle_misses(self, now: datetime) -> Dict[str, List[str]]:
+        """
+        Load languages whose next check time has come with a single query, so the walk finds already scanned
+        videos which should be looked up online again without hitting the db per file
+        :return: video path -> languages in iso639-3
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT video_path, language_iso639_3 FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE} "
+                  f"WHERE next_check_time <= ?", (now.isoformat(),))
+        due_misses = {}
+        for row in c.fetchall():
+            due_misses.setdefault(row['video_path'], []).append(row['language_iso639_3'])
+        return due_misses
+
+    def record_online_subtitle_miss(self, video_hash: str, language_iso639_3: str, video_path: str,
+                                    base_interval: timedelta, max_interval: timedelta):
+        """
+        Remember that no subtitle was found online, the next check is postponed exponentially:
+        base_interval after the first miss, doubled after every next miss, up to max_interval
+        """
+        previous_miss = self.conn.execute(
+            f"SELECT attempts FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE} "
+            f"WHERE video_hash = ? AND language_iso639_3 = ?",
+            (video_hash, language_iso639_3)).fetchone()
+        attempts = previous_miss['attempts'] + 1 if previous_miss else 1
+        now = datetime.utcnow()
+        interval = min(base_interval * (2 ** min(attempts - 1, 32)), max_interval)
+        with self._transaction():
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {Storage._ONLINE_SUBTITLE_MISS_TABLE} "
+                f"(video_hash, language_iso639_3, video_path, attempts, last_check_time, next_check_time) "
+                f"VALUES (?,?,?,?,?,?)",
+                (video_hash, language_iso639_3, video_path, attempts, now.isoformat(), (now + interval).isoformat()))
+
+    def delete_online_subtitle_misses(self, video_hash: str = None, languages_iso639_3: List[str] = None):
+        """
+        Forget misses of a video (of the given languages only if they are set), of all videos if video_hash is None
+        """
+        with self._transaction():
+            if video_hash is None:
+                self.conn.execute(f"DELETE FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE}")
+            elif languages_iso639_3 is None:
+                self.conn.execute(f"DELETE FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE} WHERE video_hash = ?",
+                                  (video_hash,))
+            else:
+                self.conn.executemany(f"DELETE FROM {Storage._ONLINE_SUBTITLE_MISS_TABLE} "
+                                      f"WHERE video_hash = ? AND language_iso639_3 = ?",
+                                      [(video_hash, language) for language in languages_iso639_3])
+
+    def enqueue_jobs(self, files: List[Tuple[str, str]]):
+        """
+        Add files to the job queue as pending, done and failed jobs of the same files are queued again,
+        pending and running jobs are left as they are
+        :param files: list of (dir, filename)
+        """
+        now = datetime.utcnow().isoformat()
+        with self._transaction():
+            self.conn.executemany(
+                f"INSERT INTO {Storage._JOB_TABLE} (dir, filename, state, attempts, update_time) "
+                f"VALUES (?, ?, '{JOB_PENDING}', 0, ?) "
+                f"ON CONFLICT(dir, filename) DO UPDATE SET state = '{JOB_PENDING}', worker = NULL, "
+                f"lease_expire_time = NULL, attempts = 0, error = NULL, retry_after = NULL, "
+                f"update_time = excluded.update_time "
+                f"WHERE state IN ('{JOB_DONE}', '{JOB_FAILED}')",
+                [(dir.rstrip('/'), filename, now) for (dir, filename) in files])
+
+    def claim_jobs(self, worker: str, limit: int, lease: timedelta, max_attempts: int) -> List[Tuple[str, str]]:
+        """
+        Atomically lease up to limit jobs to the worker: pending jobs whose retry time has come and running jobs
+        whose lease expired, because their worker crashed. A job with an expired lease which was claimed
+        max_attempts times fails.
+        Safe between processes and hosts sharing the db file, must not be called inside of a bulk session
+        :return: list of (dir, filename) of claimed jobs
+        """
+        now = datetime.utcnow()
+        with self.conn:
+            # the write lock is taken before reading, so two workers can't claim the same job
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                f"UPDATE {Storage._JOB_TABLE} SET state = '{JOB_FAILED}', worker = NULL, lease_expire_time = NULL, "
+                f"error = 'lease expired', update_time = ? "
+                f"WHERE state = '{JOB_RUNNING}' AND lease_expire_time < ? AND attempts >= ?",
+                (now.isoformat(), now.isoformat(), max_attempts))
+            jobs = [(row['dir'], row['filename']) for row in self.conn.execute(
+                f"SELECT dir, filename FROM {Storage._JOB_TABLE} "
+                f"WHERE (state = '{JOB_PENDING}' AND (retry_after IS NULL OR retry_after <= ?)) "
+                f"OR (state = '{JOB_RUNNING}' AND lease_expire_time < ?) "
+                f"ORDER BY update_time LIMIT ?",
+                (now.isoformat(), now.isoformat(), limit))]
+            self.conn.executemany(
+                f"UPDATE {Storage._JOB_TABLE} SET state = '{JOB_RUNNING}', worker = ?, lease_expire_time = ?, "
+                f"attempts = attempts + 1, update_time = ? WHERE dir = ? AND filename = ?",
+                [(worker, (now + lease).isoformat(), now.isoformat(), dir, filename) for (dir, filename) in jobs])
+        return jobs
+
+    def renew_job_leases(self, worker: str, lease: timedelta):
+        """
+        Extend leases of all running jobs of the worker
+        """
+        now = datetime.utcnow()
+        with self._transaction():
+            self.conn.execute(
+                f"UPDATE {Storage._JOB_TABLE} SET lease_expire_time = ? WHERE state = '{JOB_RUNNING}' AND worker = ?",
+                ((now + lease).isoformat(), worker))
+
+    def finish_job(self, dir: str, filename: str, worker: str):
+        """
+        Mark a job done, nothing changes if its lease expired and another worker claimed it
+        """
+        with self._transaction():
+            self.conn.execute(
+                f"UPDATE {Storage._JOB_TABLE} SET state = '{JOB_DONE}', worker = NULL, lease_expire_time = NULL, "
+                f"error = NULL, update_time = ? WHERE dir = ? AND filename = ? AND worker = ?",
+                (datetime.utcnow().isoformat(), dir.rstrip('/'), filename, worker))
+
+    def fail_job(self, dir: str, filename: str, worker: str, error: str, max_attempts: int,
+                 retry_after: datetime = None, fingerprint: FileFingerprint = None):
+        """
+        Return a job to the queue after an error, it fails when it was claimed max_attempts times
+        :param retry_after: a failed file isn't queued again before this time unless it changes
+        :param fingerprint: of the failed file, only size and mtime are saved
+        """
+        fingerprint = fingerprint or FileFingerprint(None, None, None)
+        with self._transaction():
+            self.conn.execute(
+                f"UPDATE {Storage._JOB_TABLE} "
+                f"SET state = CASE WHEN attempts >= ? THEN '{JOB_FAILED}' ELSE '{JOB_PENDING}' END, worker = NULL, "
+                f"lease_expire_time = NULL, error = ?, retry_after = ?, size = ?, mtime_ns = ?, update_time = ? "
+                f"WHERE dir = ? AND filename = ? AND worker = ?",
+                (max_attempts, error, retry_after and retry_after.isoformat(), fingerprint.size, fingerprint.mtime_ns,
+                 datetime.utcnow().isoformat(), dir.rstrip('/'), filename, worker))
+
+    def record_failed_file(self, dir: str, filename: str, error: str, retry_after: datetime,
+                           fingerprint: FileFingerprint = None):
+        """
+        Remember a file which failed outside of the job queue
+        :param retry_after: the file isn't scanned again before this time unless it changes
+        :param fingerprint: of the failed file, only size and mtime are saved
+        """
+        fingerprint = fingerprint or FileFingerprint(None, None, None)
+        with self._transaction():
+            self.conn.execute(
+                f"INSERT INTO {Storage._JOB_TABLE} "
+                f"(dir, filename, state, attempts, error, retry_after, size, mtime_ns, update_time) "
+                f"VALUES (?, ?, '{JOB_FAILED}', 1, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT(dir, filename) DO UPDATE SET state = '{JOB_FAILED}', worker = NULL, "
+                f"lease_expire_time = NULL, attempts = attempts + 1, error = excluded.error, "
+                f"retry_after = excluded.retry_after, size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                f"update_time = excluded.update_time",
+                (dir.rstrip('/'), filename, error, retry_after.isoformat(), fingerprint.size, fingerprint.mtime_ns,
+                 datetime.utcnow().isoformat()))
+
+    def get_failed_files(self) -> Dict[Tuple[str, str], sqlite3.Row]:
+        """
+        Load (dir, filename) with the failure of all failed files with a single query
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT * FROM {Storage._JOB_TABLE} WHERE state = '{JOB_FAILED}'")
+        return {(row['dir'], row['filename']): row for row in c.fetchall()}
+
+    def get_all_jobs(self) -> List[sqlite3.Row]:
+        c = self.conn.cursor()
+        c.execute(f"SELECT * FROM {Storage._JOB_TABLE} ORDER BY update_time")
+        return c.fetchall()
+
+    def count_jobs(self) -> Dict[str, int]:
+        """
+        :return: job state -> count of jobs
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT state, count(*) AS count FROM {Storage._JOB_TABLE} GROUP BY state")
+        return {row['state']: row['count'] for row in c.fetchall()}
+
+    def get_scanned_fingerprints(self) -> Dict[Tuple[str, str], FileFingerprint]:
+        """
+        Load (dir, filename) with the fingerprint of all scanned video files with a single query,
+        so checks while walking a library don't hit the db per file
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT dir, filename, size, mtime_ns, partial_hash FROM {Storage._VIDEO_FILE_TABLE}")
+        return {(row['dir'], row['filename']): FileFingerprint(row['size'], row['mtime_ns'], row['partial_hash'])
+                for row in c.fetchall()}
+
+    def get_scan_configs(self) -> Dict[Tuple[str, str], dict]:
+        """
+        Load (dir, filename) with the configuration the file was processed with, None if it's unknown
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT dir, filename, scan_config FROM {Storage._VIDEO_FILE_TABLE}")
+        return {(row['dir'], row['filename']): json.loads(row['scan_config']) if row['scan_config'] else None
+                for row in c.fetchall()}
+
     def _migrate_from_cache_file(self, cache_file_path):
         def read_cache(file_path):
             cache_file_path = file_path
@@ -142,13 +596,22 @@ class Storage:
         cache = read_cache(cache_file_path)
         is_migration_complete = cache.get('migration_complete', False)
 
-        if is_migration_complete:
+        if is_migration_complete or not cache:
             # skipping
             return
 
-        for file in cache['files']:
+        with self.bulk_session():
+            self.__migrate_cache_files(cache['files'])
+
+        cache['migration_complete'] = True
+        save_cache(cache_file_path, cache)
+
+    def __migrate_cache_files(self, files: list):
+        for file in files:
             file_dir = file['dir']
             file_name = file['filename']
+            # a cache can list a file several times, its last entry is kept like duplicated scans are by migrations
+            self.__delete_video_file(file_dir, file_name)
             x = self.create_video_file(file_dir, file_name)
 
             print(f"Migration from cache file {x['filename']}, id: {x['id']}")
@@ -164,6 +627,3 @@ class Storage:
                 srt_full_path = merged_subtitles['srt_full_path']
                 self.create_video_subtitle(x['id'], srt_full_path, f"{lang_top.part3},{lang_bot.part3}", None,
                                            source='Merge')
-
-        cache['migration_complete'] = True
-        save_cache(cache_file_path, cache)
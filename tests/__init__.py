@@ -3,10 +3,17 @@ from unittest import TestSuite
 
 from tests.test_extract_info import TestExtractInfo
 from tests.test_extract_subs import TestExtractSubs
+from tests.test_mergesubs import TestMergeSubs
+from tests.test_metrics import TestMetrics
+from tests.test_mkv_ebml import TestMkvEbml
+from tests.test_scheduler import TestDeviceScheduler
 from tests.test_storage import TestStorage
 from tests.test_util import TestUtils
+from tests.test_walker import TestWalker
+from tests.test_watcher import TestWatcher
 
-test_cases = (TestExtractInfo, TestExtractSubs, TestStorage, TestUtils)
+test_cases = (TestExtractInfo, TestExtractSubs, TestMergeSubs, TestMetrics, TestMkvEbml, TestDeviceScheduler,
+              TestStorage, TestUtils, TestWalker, TestWatcher)
 
 if not os.getcwd().endswith('/tests'):
     os.chdir('./tests')
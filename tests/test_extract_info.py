@@ -1,6 +1,41 @@
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
 import unittest
+from unittest import mock
 
-from extract_mkv_info import parse_mkvinfo, parse_mkvinfo_from_file, parse_mkv_subtitles_info_from_str
+from extract_mkv_info import parse_mkvinfo, parse_mkvinfo_from_file, parse_mkv_subtitles_info_from_str, \
+    is_text_subtitle_codec, subtitle_file_extension, extract_mkv_tracks, extract_mkv_tracks_to_memory
+
+
+def write_fake_executable(bin_dir: str, name: str, script: str):
+    path = os.path.join(bin_dir, name)
+    with open(path, 'w') as f:
+        f.write(f"#!/bin/sh\n{script}")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+# writes "Track <id>" subtitles to every <id>:<path> argument except of the ones of skipped tracks
+FAKE_MKVEXTRACT = """
+for arg in "$@"; do
+  case "$arg" in
+    {skip}) ;;
+    [0-9]*:*) printf '1\\n00:00:01,000 --> 00:00:02,000\\nTrack %s\\n\\n' "${{arg%%:*}}" > "${{arg#*:}}" ;;
+  esac
+done
+"""
+
+
+def is_process_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the state follows the parenthesized command name, Z - zombie
+            return f.read().rsplit(')', 1)[1].split()[0] not in ('Z', 'X')
+    except FileNotFoundError:
+        return False
 
 
 class TestExtractInfo(unittest.TestCase):
@@ -28,6 +63,66 @@ class TestExtractInfo(unittest.TestCase):
             for mkv_subtitle_info in mkv_subtitles_info:
                 self.assertIsNotNone(mkv_subtitle_info.language)
 
+    def test_text_subtitle_codec(self):
+        with open('example_mkvinfo_output_2', 'r') as info_file:
+            mkv_subtitles_info = parse_mkv_subtitles_info_from_str(info_file.read())
+            self.assertTrue(all(is_text_subtitle_codec(i.codec_id) for i in mkv_subtitles_info))
+        self.assertTrue(is_text_subtitle_codec('S_TEXT/ASS'))
+        self.assertFalse(is_text_subtitle_codec('S_HDMV/PGS'))
+        self.assertFalse(is_text_subtitle_codec('S_VOBSUB'))
+
+    def test_subtitle_file_extension(self):
+        self.assertEqual('.srt', subtitle_file_extension('S_TEXT/UTF8'))
+        self.assertEqual('.ass', subtitle_file_extension('S_TEXT/ASS'))
+        self.assertEqual('.sup', subtitle_file_extension('S_HDMV/PGS'))
+        self.assertEqual('.srt', subtitle_file_extension(None))
+
+    def test_extract_timeout_terminates_process_group(self):
+        scripts = {
+            'terminated': "",
+            # ignored SIGTERM is inherited by the child, both are killed after the grace period
+            'killed': "trap '' TERM\n",
+        }
+        for case, script_start in scripts.items():
+            with self.subTest(case):
+                tmp_dir = tempfile.mkdtemp()
+                pid_file = os.path.join(tmp_dir, 'child.pid')
+                write_fake_executable(tmp_dir, 'mkvextract', f"{script_start}sleep 60 &\necho $! > {pid_file}\nwait\n")
+                path = f"{tmp_dir}{os.pathsep}{os.environ['PATH']}"
+                try:
+                    with mock.patch.dict(os.environ, {'PATH': path}), \
+                            mock.patch('extract_mkv_info._TERMINATE_GRACE_SECONDS', 0.5):
+                        start = time.monotonic()
+                        with self.assertRaises(subprocess.TimeoutExpired):
+                            extract_mkv_tracks('fragment.mkv', [{'srt_track_id': 2,
+                                                                 'srt_full_path': os.path.join(tmp_dir, 'a.srt')}],
+                                               timeout=0.5)
+                        self.assertLess(time.monotonic() - start, 5)
+                    with open(pid_file) as f:
+                        child_pid = int(f.read())
+                    deadline = time.monotonic() + 2
+                    while is_process_running(child_pid) and time.monotonic() < deadline:
+                        time.sleep(0.05)
+                    self.assertFalse(is_process_running(child_pid))
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_extract_tracks_to_memory(self):
+        bin_dir = tempfile.mkdtemp()
+        write_fake_executable(bin_dir, 'mkvextract', FAKE_MKVEXTRACT.format(skip='4:*'))
+        try:
+            with mock.patch.dict(os.environ, {'PATH': f"{bin_dir}{os.pathsep}{os.environ['PATH']}"}), \
+                    mock.patch('tempfile.tempdir', bin_dir):
+                contents = extract_mkv_tracks_to_memory('fragment.mkv', [3, 4, 5], timeout=10)
+            self.assertEqual(b"1\n00:00:01,000 --> 00:00:02,000\nTrack 3\n\n", contents[3])
+            self.assertEqual(b"1\n00:00:01,000 --> 00:00:02,000\nTrack 5\n\n", contents[5])
+            # a pipe mkvextract didn't open doesn't block
+            self.assertEqual(b"", contents[4])
+            # pipes are removed
+            self.assertEqual(['mkvextract'], os.listdir(bin_dir))
+        finally:
+            shutil.rmtree(bin_dir, ignore_errors=True)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,86 @@
+import json
 import os
 import shutil
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
 
+from babelfish import Language
 from iso639 import languages
+from subliminal.core import ProviderPool
+from subliminal.providers import Provider
+from subliminal.subtitle import Subtitle
+from subliminal.video import Episode, Movie
 
-from extract_subs import ExtractSubs, AppRunConfig
+import mergesubs
+from extract_mkv_info import MKVTrackInfo
+from extract_subs import ExtractSubs, AppRunConfig, ScannedFile, FileToScan
+from metrics import Metrics
 from storage import Storage
+from tests.test_extract_info import write_fake_executable, FAKE_MKVEXTRACT
+
+
+class StubSubtitle(Subtitle):
+    provider_name = 'stub'
+
+    def __init__(self, language, video_name):
+        super().__init__(language)
+        self.video_name = video_name
+
+    @property
+    def id(self):
+        return f"{self.video_name}-{self.language}"
+
+    def get_matches(self, video):
+        return set()
+
+
+class StubProvider(Provider):
+    """
+    Local subtitle provider recording how many sessions and requests were made
+    """
+    languages = {Language('eng'), Language('fra')}
+    video_types = (Episode, Movie)
+    sessions = 0
+    requests = 0
+    subtitles_available = True
+
+    def initialize(self):
+        StubProvider.sessions += 1
+
+    def terminate(self):
+        pass
+
+    def list_subtitles(self, video, languages):
+        StubProvider.requests += 1
+        if not StubProvider.subtitles_available:
+            return []
+        return [StubSubtitle(language, video.name) for language in languages]
+
+    def download_subtitle(self, subtitle):
+        StubProvider.requests += 1
+        subtitle.content = b"1\n00:00:01,000 --> 00:00:02,000\nHello\n\n"
+
+
+class StubProviderPool(ProviderPool):
+    def __init__(self):
+        super().__init__(providers=['stub'])
+
+    def __getitem__(self, name):
+        if name not in self.initialized_providers:
+            provider = StubProvider()
+            provider.initialize()
+            self.initialized_providers[name] = provider
+        return self.initialized_providers[name]
+
+    def list_subtitles_provider(self, provider, video, languages):
+        return self[provider].list_subtitles(video, StubProvider.check_languages(languages))
 
 
 class TestExtractSubs(unittest.TestCase):
@@ -31,6 +105,686 @@ class TestExtractSubs(unittest.TestCase):
 
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
+    def test_scrap_files_constant_queries(self):
+        tmp_dir = tempfile.mkdtemp()
+        file_names = [f"movie_{i}.mkv" for i in range(20)]
+        for file_name in file_names:
+            open(os.path.join(tmp_dir, file_name), 'w').close()
+
+        with Storage(':memory:') as storage:
+            def _row(file_dir, file_name):
+                path = os.path.join(file_dir, file_name)
+                stat = os.stat(path) if os.path.exists(path) else None
+                return file_dir, file_name, stat and stat.st_size, stat and stat.st_mtime_ns, scan_config
+
+            app_run_config = AppRunConfig(tmp_dir, [], [], ".*", {}, False)
+            scan_config = json.dumps(ExtractSubs(app_run_config, storage)._scan_config())
+            scanned = [_row(tmp_dir, f"movie_{i}.mkv") for i in range(0, 50000, 2)]
+            not_scanned = [(f"/library/dir_{i}", f"movie_{i}.mkv", 0, 0, scan_config) for i in range(25000)]
+            with storage.conn:
+                storage.conn.executemany("INSERT INTO video_file (dir, filename, scan_time, size, mtime_ns, "
+                                         "scan_config) VALUES (?, ?, '', ?, ?, ?)", scanned + not_scanned)
+
+            queries = []
+            storage.conn.set_trace_callback(queries.append)
+            files_to_scan = ExtractSubs(app_run_config, storage)._scrap_files_to_scan()
+            storage.conn.set_trace_callback(None)
+
+            # fingerprints, scan configurations and failed files are loaded once, not per file
+            self.assertEqual(3, len(queries))
+            self.assertEqual({f"movie_{i}.mkv" for i in range(1, 20, 2)}, {f.filename for f in files_to_scan})
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_scan_files_jobs(self):
+        tmp_dir = tempfile.mkdtemp()
+        for i in range(8):
+            open(os.path.join(tmp_dir, f"movie_{i}.avi"), 'w').close()
+
+        class _RecordingExtractSubs(ExtractSubs):
+            lock = threading.Lock()
+            running = 0
+            max_running = 0
+            extracting = 0
+            max_extracting = 0
+            save_threads = set()
+
+            def _read_subtitles(self, file_to_scan):
+                with self.lock:
+                    _RecordingExtractSubs.running += 1
+                    _RecordingExtractSubs.max_running = max(self.max_running, self.running)
+                time.sleep(0.05)
+                with self.lock:
+                    _RecordingExtractSubs.running -= 1
+                return super()._read_subtitles(file_to_scan)
+
+            def _extract_file(self, file):
+                with self.lock:
+                    _RecordingExtractSubs.extracting += 1
+                    _RecordingExtractSubs.max_extracting = max(self.max_extracting, self.extracting)
+                time.sleep(0.02)
+                with self.lock:
+                    _RecordingExtractSubs.extracting -= 1
+                return super()._extract_file(file)
+
+            def _save_scanned_files(self, files):
+                self.save_threads.add(threading.current_thread())
+                super()._save_scanned_files(files)
+
+        with Storage(':memory:') as storage:
+            app_run_config = AppRunConfig(tmp_dir, [], [], ".*", {}, False, jobs=4)
+            _RecordingExtractSubs(app_run_config, storage).scan_files()
+
+            self.assertEqual(8, len(storage.get_all_video_files()))
+            self.assertGreater(_RecordingExtractSubs.max_running, 1)
+            # all files are on one disk
+            self.assertEqual(1, _RecordingExtractSubs.max_extracting)
+            self.assertEqual({threading.main_thread()}, _RecordingExtractSubs.save_threads)
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_scan_streams_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        for i in range(5):
+            open(os.path.join(tmp_dir, f"movie_{i}.avi"), 'w').close()
+        events = []
+
+        class _RecordingExtractSubs(ExtractSubs):
+            def _iter_files_to_scan(self):
+                for file_to_scan in super()._iter_files_to_scan():
+                    events.append(('walk', file_to_scan.filename))
+                    yield file_to_scan
+
+            def _save_scanned_files(self, files):
+                events.extend(('save', file.filename) for file in files)
+                super()._save_scanned_files(files)
+
+        with Storage(':memory:') as storage:
+            _RecordingExtractSubs(AppRunConfig(tmp_dir, [], [], ".*", {}, False), storage).scan_files()
+
+        walked = [name for event, name in events if event == 'walk']
+        self.assertEqual(5, len(walked))
+        # every file is saved before the next one is found
+        self.assertEqual([event for name in walked for event in (('walk', name), ('save', name))], events)
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_changed_file_rescanned(self):
+        tmp_dir = tempfile.mkdtemp()
+        file = os.path.join(tmp_dir, 'movie.avi')
+        with open(file, 'w') as f:
+            f.write('first release')
+
+        with Storage(':memory:') as storage:
+            app_run_config = AppRunConfig(tmp_dir, [], [], ".*", {}, False, fingerprint_hash_mb=1)
+            extract_subs = ExtractSubs(app_run_config, storage)
+            extract_subs.scan_files()
+            self.assertEqual(1, len(storage.get_all_video_files()))
+            self.assertEqual([], extract_subs._scrap_files_to_scan())
+
+            # same content, only mtime changed - the partial hash matches, no rescan
+            os.utime(file, ns=(0, 1_000_000_000))
+            self.assertEqual([], extract_subs._scrap_files_to_scan())
+            self.assertEqual(1_000_000_000, storage.get_all_video_files()[0]['mtime_ns'])
+
+            with open(file, 'w') as f:
+                f.write('better remux')
+            self.assertEqual(['movie.avi'], [f.filename for f in extract_subs._scrap_files_to_scan()])
+            extract_subs.scan_files()
+            video_files = storage.get_all_video_files()
+            self.assertEqual(1, len(video_files))
+            self.assertEqual(os.stat(file).st_mtime_ns, video_files[0]['mtime_ns'])
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_fingerprint_backfilled_for_old_scans(self):
+        tmp_dir = tempfile.mkdtemp()
+        open(os.path.join(tmp_dir, 'movie.avi'), 'w').close()
+
+        with Storage(':memory:') as storage:
+            storage.create_video_file(tmp_dir, 'movie.avi')
+            extract_subs = ExtractSubs(AppRunConfig(tmp_dir, [], [], ".*", {}, False), storage)
+
+            self.assertEqual([], extract_subs._scrap_files_to_scan())
+            self.assertEqual(0, storage.get_all_video_files()[0]['size'])
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_watch_scans_new_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        open(os.path.join(tmp_dir, 'old.avi'), 'w').close()
+
+        with Storage(':memory:') as storage:
+            extract_subs = ExtractSubs(AppRunConfig(tmp_dir, [], [], ".*", {}, False), storage)
+            stop = threading.Event()
+            watch_thread = threading.Thread(target=extract_subs.watch, args=(0.1, stop))
+            watch_thread.start()
+            try:
+                for _ in range(50):
+                    if len(storage.get_all_video_files()) == 1:
+                        break
+                    time.sleep(0.05)
+                with open(os.path.join(tmp_dir, 'new.avi'), 'w') as f:
+                    f.write('data')
+                for _ in range(50):
+                    if len(storage.get_all_video_files()) == 2:
+                        break
+                    time.sleep(0.05)
+            finally:
+                stop.set()
+                watch_thread.join()
+
+            self.assertEqual({'old.avi', 'new.avi'}, {f['filename'] for f in storage.get_all_video_files()})
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_heavy_modules_not_imported_on_start(self):
+        heavy_modules = ['subliminal', 'babelfish', 'pysubs2', 'chardet', 'mergesubs']
+        code = f"import sys, extract_subs; print([m for m in {heavy_modules} if m in sys.modules])"
+        result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual('[]', result.stdout.decode('utf-8').strip())
+
+    def test_download_subtitles_in_batches(self):
+        tmp_dir = tempfile.mkdtemp()
+        for i in range(5):
+            open(os.path.join(tmp_dir, f"Movie.Number.{i}.2010.avi"), 'w').close()
+        StubProvider.sessions = 0
+        StubProvider.requests = 0
+
+        class _StubExtractSubs(ExtractSubs):
+            def _provider_pool(self):
+                return StubProviderPool()
+
+        try:
+            with Storage(':memory:') as storage:
+                app_run_config = AppRunConfig(tmp_dir, [languages.get(part1='en')], [], ".*", {}, True,
+                                              download_batch_size=3)
+                _StubExtractSubs(app_run_config, storage).scan_files()
+
+                # 5 files in batches of 3: one session per batch, one search and one download per file
+                self.assertEqual(2, StubProvider.sessions)
+                self.assertEqual(10, StubProvider.requests)
+                video_files = storage.get_all_video_files()
+                self.assertEqual(5, len(video_files))
+                for video_file in video_files:
+                    subtitles = storage.get_all_subtitles_by_video_file_id(video_file['id'])
+                    self.assertEqual(['eng'], [s['language_iso639_3'] for s in subtitles])
+                    self.assertTrue(os.path.isfile(subtitles[0]['full_path']))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_online_miss_is_not_looked_up_again(self):
+        tmp_dir = tempfile.mkdtemp()
+        video_path = os.path.join(tmp_dir, "Movie.Without.Subtitles.2010.avi")
+        open(video_path, 'w').close()
+        StubProvider.requests = 0
+        StubProvider.subtitles_available = False
+
+        class _StubExtractSubs(ExtractSubs):
+            def _provider_pool(self):
+                return StubProviderPool()
+
+        try:
+            with Storage(':memory:') as storage:
+                app_run_config = AppRunConfig(tmp_dir, [languages.get(part1='en')], [], ".*", {}, True)
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(1, StubProvider.requests)
+                misses = storage.get_all_online_subtitle_misses()
+                self.assertEqual([('eng', video_path, 1)],
+                                 [(m['language_iso639_3'], m['video_path'], m['attempts']) for m in misses])
+
+                # the file is scanned again, e.g. it was replaced, but the miss is still fresh
+                storage.delete_video_file_by_full_path(video_path)
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(1, StubProvider.requests)
+
+                StubProvider.subtitles_available = True
+                storage.delete_online_subtitle_misses()
+                storage.delete_video_file_by_full_path(video_path)
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(3, StubProvider.requests)
+                self.assertEqual([], storage.get_all_online_subtitle_misses())
+        finally:
+            StubProvider.subtitles_available = True
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_online_miss_looked_up_again_when_due(self):
+        tmp_dir = tempfile.mkdtemp()
+        video_path = os.path.join(tmp_dir, "Movie.Found.Later.2010.avi")
+        open(video_path, 'w').close()
+        StubProvider.requests = 0
+        StubProvider.subtitles_available = False
+
+        class _StubExtractSubs(ExtractSubs):
+            def _provider_pool(self):
+                return StubProviderPool()
+
+        try:
+            with Storage(':memory:') as storage:
+                app_run_config = AppRunConfig(tmp_dir, [languages.get(part1='en')], [], ".*", {}, True)
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(1, StubProvider.requests)
+
+                # the file is scanned and the miss isn't due yet
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(1, StubProvider.requests)
+
+                StubProvider.subtitles_available = True
+                with storage.conn:
+                    storage.conn.execute("UPDATE online_subtitle_miss SET next_check_time = '2000-01-01T00:00:00'")
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(3, StubProvider.requests)
+                self.assertEqual([], storage.get_all_online_subtitle_misses())
+                video_file = storage.get_video_file_by_full_path(video_path)
+                self.assertEqual(['eng'], [s['language_iso639_3']
+                                           for s in storage.get_all_subtitles_by_video_file_id(video_file['id'])])
+
+                _StubExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(3, StubProvider.requests)
+        finally:
+            StubProvider.subtitles_available = True
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_merge_parses_every_subtitle_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        subtitles = []
+        for lang, text in [('ru', 'Привет'), ('en', 'Hello'), ('fr', 'Bonjour')]:
+            path = os.path.join(tmp_dir, f"movie_{lang}.srt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f"1\n00:00:01,000 --> 00:00:02,000\n{text}\n\n")
+            subtitles.append({'srt_full_path': path, 'srt_lang_code': languages.get(part1=lang)})
+        # a bitmap subtitle isn't merged
+        bitmap_path = os.path.join(tmp_dir, 'movie_en.sup')
+        with open(bitmap_path, 'wb') as f:
+            f.write(b'PG\x00\x01')
+        subtitles.append({'srt_full_path': bitmap_path, 'srt_lang_code': languages.get(part1='en'),
+                          'srt_codec_id': 'S_HDMV/PGS'})
+        movie = ScannedFile('movie.mkv', 'movie', '.mkv', tmp_dir, os.path.join(tmp_dir, 'movie.mkv'), subtitles, [])
+        ru, en, fr = (languages.get(part1=lang) for lang in ['ru', 'en', 'fr'])
+
+        try:
+            with Storage(':memory:') as storage, mock.patch('mergesubs.load', wraps=mergesubs.load) as load:
+                app_run_config = AppRunConfig(tmp_dir, [ru, en, fr], [(ru, en), (ru, fr), (en, fr)], ".*", {}, False)
+                ExtractSubs(app_run_config, storage)._merge_subs(movie)
+
+                self.assertEqual(3, load.call_count)
+                self.assertEqual(3, len(movie.merged_subtitles))
+                for merged_subtitle in movie.merged_subtitles:
+                    self.assertTrue(os.path.isfile(merged_subtitle['srt_full_path']))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_merge_skipped_when_up_to_date(self):
+        tmp_dir = tempfile.mkdtemp()
+        ru, en, fr = (languages.get(part1=lang) for lang in ['ru', 'en', 'fr'])
+
+        def write_subtitle(lang, text):
+            path = os.path.join(tmp_dir, f"movie_{lang}.srt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f"1\n00:00:01,000 --> 00:00:02,000\n{text}\n\n")
+            return {'srt_full_path': path, 'srt_lang_code': languages.get(part1=lang), 'srt_track_id': None}
+
+        subtitles = [write_subtitle('ru', 'Привет'), write_subtitle('en', 'Hello'), write_subtitle('fr', 'Bonjour')]
+
+        def movie():
+            return ScannedFile('movie.mkv', 'movie', '.mkv', tmp_dir, os.path.join(tmp_dir, 'movie.mkv'), subtitles,
+                               [])
+
+        try:
+            with Storage(':memory:') as storage, mock.patch('mergesubs.load', wraps=mergesubs.load) as load:
+                app_run_config = AppRunConfig(tmp_dir, [ru, en, fr], [(ru, en), (ru, fr)], ".*", {}, False)
+                extract_subs = ExtractSubs(app_run_config, storage)
+                extract_subs._merge_subs(movie())
+                self.assertEqual(3, load.call_count)
+
+                def rescan():
+                    first_movie = movie()
+                    extract_subs._merge_subs(first_movie)
+                    extract_subs._save_scanned_files([first_movie])
+                    extract_subs._merge_inputs = storage.get_merge_inputs()
+                    rescanned_movie = movie()
+                    extract_subs._merge_subs(rescanned_movie)
+                    return rescanned_movie
+
+                load.reset_mock()
+                rescanned_movie = rescan()
+                self.assertEqual(3, load.call_count)
+                self.assertEqual(2, len(rescanned_movie.merged_subtitles))
+
+                # only the pair with the changed track is merged again
+                load.reset_mock()
+                extract_subs._merge_inputs = storage.get_merge_inputs()
+                fr_subtitle = write_subtitle('fr', 'Salut')
+                os.utime(fr_subtitle['srt_full_path'], ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+                changed_movie = movie()
+                extract_subs._merge_subs(changed_movie)
+                self.assertEqual(sorted([subtitles[0]['srt_full_path'], fr_subtitle['srt_full_path']]),
+                                 sorted(call.args[0] for call in load.call_args_list))
+                self.assertEqual(2, len(changed_movie.merged_subtitles))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_incremental_scan_after_configuration_change(self):
+        tmp_dir = tempfile.mkdtemp()
+        open(os.path.join(tmp_dir, "Movie.Incremental.2010.avi"), 'w').close()
+        StubProvider.requests = 0
+        en, fr = languages.get(part1='en'), languages.get(part1='fr')
+
+        class _StubExtractSubs(ExtractSubs):
+            files_to_scan = []
+
+            def _provider_pool(self):
+                return StubProviderPool()
+
+            def _read_subtitles(self, file_to_scan):
+                _StubExtractSubs.files_to_scan.append(file_to_scan)
+                return super()._read_subtitles(file_to_scan)
+
+        def scan(target_languages, merge_languages_pairs):
+            _StubExtractSubs.files_to_scan = []
+            _StubExtractSubs(AppRunConfig(tmp_dir, target_languages, merge_languages_pairs, ".*", {}, True),
+                             storage).scan_files()
+            return _StubExtractSubs.files_to_scan
+
+        def subtitle_languages():
+            video_file = storage.get_all_video_files()[0]
+            return sorted(s['language_iso639_3'] for s in storage.get_all_subtitles_by_video_file_id(video_file['id']))
+
+        try:
+            with Storage(':memory:') as storage:
+                self.assertEqual(1, len(scan([en], [])))
+                self.assertEqual(2, StubProvider.requests)
+                self.assertEqual([], scan([en], []))
+
+                # only the new language is downloaded, the saved subtitle rows are reused
+                files_to_scan = scan([en, fr], [])
+                self.assertEqual(1, len(files_to_scan))
+                self.assertEqual(['eng'], [s['language_iso639_3'] for s in files_to_scan[0].scanned_subtitles])
+                self.assertEqual(4, StubProvider.requests)
+                self.assertEqual(['eng', 'fra'], subtitle_languages())
+
+                # a removed language isn't missed work
+                self.assertEqual([], scan([fr], []))
+
+                self.assertEqual(1, len(scan([en, fr], [(en, fr)])))
+                self.assertEqual(4, StubProvider.requests)
+                self.assertEqual(['eng', 'eng,fra', 'fra'], subtitle_languages())
+                self.assertEqual([], scan([en, fr], [(en, fr)]))
+                self.assertEqual({'languages': ['eng', 'fra'], 'merge_languages': ['eng,fra'], 'download_online': True},
+                                 list(storage.get_scan_configs().values())[0])
+
+                # a merged subtitle of a pair which isn't configured anymore is kept with the scan configuration
+                merge_inputs = storage.get_merge_inputs()
+                self.assertEqual(1, len(scan([en, fr, languages.get(part1='de')], [])))
+                self.assertEqual(['eng', 'eng,fra', 'fra'], subtitle_languages())
+                self.assertEqual(merge_inputs, storage.get_merge_inputs())
+                self.assertEqual(['eng,fra'], list(storage.get_scan_configs().values())[0]['merge_languages'])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_extract_only_needed_text_tracks(self):
+        tmp_dir = tempfile.mkdtemp()
+        open(os.path.join(tmp_dir, 'movie.mkv'), 'w').close()
+        open(os.path.join(tmp_dir, 'movie_rus.srt'), 'w').close()
+
+        def track(track_number, language, codec_id):
+            return MKVTrackInfo(None, 'subtitles', track_number, language, None, {'codec_id': codec_id})
+
+        tracks = [track(2, 'eng', 'S_TEXT/UTF8'), track(3, 'eng', 'S_HDMV/PGS'), track(4, 'ger', 'S_TEXT/ASS'),
+                  track(5, 'rus', 'S_TEXT/UTF8'), track(6, 'fre', 'S_VOBSUB')]
+        en, ru = languages.get(part1='en'), languages.get(part1='ru')
+        try:
+            with Storage(':memory:') as storage, \
+                    mock.patch('extract_subs.parse_mkv_subtitles_info_from_file', return_value=tracks), \
+                    mock.patch('extract_subs.extract_mkv_tracks') as extract_mkv_tracks:
+                extract_subs = ExtractSubs(AppRunConfig(tmp_dir, [en], [(en, ru)], ".*", {}, False), storage)
+                movie = extract_subs._extract_file(extract_subs._read_subtitles(FileToScan(tmp_dir, 'movie.mkv')))
+
+                extract_mkv_tracks.assert_called_once()
+                self.assertEqual([2], [s['srt_track_id'] for s in extract_mkv_tracks.call_args.args[1]])
+                self.assertEqual(5, len(movie.subtitles))
+
+                self.assertEqual(['movie_eng.srt', 'movie_eng.sup', 'movie_ger.ass', 'movie_rus.srt', 'movie_fre.sub'],
+                                 [os.path.basename(s['srt_full_path']) for s in movie.subtitles])
+                extract_subs._save_scanned_files([movie])
+                video_file = storage.get_all_video_files()[0]
+                self.assertEqual(['S_TEXT/UTF8', 'S_HDMV/PGS', 'S_TEXT/ASS', 'S_TEXT/UTF8', 'S_VOBSUB'],
+                                 [s['codec_id'] for s in storage.get_all_subtitles_by_video_file_id(video_file['id'])])
+
+                open(os.path.join(tmp_dir, 'movie_eng.srt'), 'w').close()
+                extract_mkv_tracks.reset_mock()
+                extract_subs._extract_file(extract_subs._read_subtitles(FileToScan(tmp_dir, 'movie.mkv')))
+                extract_mkv_tracks.assert_not_called()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_changed_file_subtitles_extracted_again(self):
+        tmp_dir = tempfile.mkdtemp()
+        video_path = os.path.join(tmp_dir, 'movie.mkv')
+        with open(video_path, 'w') as f:
+            f.write('old release')
+        tracks = [MKVTrackInfo(None, 'subtitles', 2, 'eng', None, {'codec_id': 'S_TEXT/UTF8'})]
+        release = ['old release']
+
+        def extract(full_path, subtitles, timeout=None):
+            for subtitle in subtitles:
+                with open(subtitle['srt_full_path'], 'w') as f:
+                    f.write(f"subs of {release[0]}")
+
+        def subtitle_text():
+            with open(os.path.join(tmp_dir, 'movie_eng.srt')) as f:
+                return f.read()
+
+        try:
+            with Storage(':memory:') as storage, \
+                    mock.patch('extract_subs.parse_mkv_subtitles_info_from_file', return_value=tracks), \
+                    mock.patch('extract_subs.extract_mkv_tracks', side_effect=extract) as extract_mkv_tracks:
+                app_run_config = AppRunConfig(tmp_dir, [languages.get(part1='en')], [], ".*", {}, False)
+                ExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(1, extract_mkv_tracks.call_count)
+
+                # the new release keeps the mtime of its download, it's older than the extracted subtitle
+                release[0] = 'new release'
+                with open(video_path, 'w') as f:
+                    f.write('new release with a new size')
+                os.utime(video_path, ns=(0, 0))
+                ExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(2, extract_mkv_tracks.call_count)
+                self.assertEqual('subs of new release', subtitle_text())
+
+                ExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(2, extract_mkv_tracks.call_count)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_scan_metrics(self):
+        tmp_dir = tempfile.mkdtemp()
+        for i in range(3):
+            open(os.path.join(tmp_dir, f"movie_{i}.avi"), 'w').close()
+        try:
+            with Storage(':memory:') as storage:
+                metrics = Metrics()
+                ExtractSubs(AppRunConfig(tmp_dir, [], [], ".*", {}, False), storage, metrics).scan_files()
+
+                stages = metrics.to_dict()['stages']
+                self.assertEqual(['walk', 'probe', 'extract', 'merge', 'db_write'], list(stages))
+                for stage in ['probe', 'extract', 'merge', 'db_write']:
+                    self.assertEqual(3, stages[stage]['count'])
+                    self.assertEqual(0, stages[stage]['errors'])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_workers_share_job_queue(self):
+        tmp_dir = tempfile.mkdtemp()
+        for i in range(12):
+            open(os.path.join(tmp_dir, f"movie_{i}.avi"), 'w').close()
+        db_file = os.path.join(tmp_dir, '.extract-subs.sqlite3')
+        processed = []
+        # both workers hold a claimed file at the same time
+        first_claims = threading.Barrier(2, timeout=10)
+
+        class _QueueWorker(ExtractSubs):
+            def _read_subtitles(self, file_to_scan):
+                if file_to_scan.filename == 'movie_0.avi':
+                    raise OSError("broken file")
+                if self.app_config.worker_id not in {worker_id for worker_id, _ in processed}:
+                    first_claims.wait()
+                processed.append((self.app_config.worker_id, file_to_scan.filename))
+                time.sleep(0.01)
+                return super()._read_subtitles(file_to_scan)
+
+        def work(worker_id):
+            with Storage(db_file) as storage:
+                # the broken file is retried at once
+                app_run_config = AppRunConfig(tmp_dir, [], [], ".*", {}, False, job_queue=True, worker_id=worker_id,
+                                              job_max_attempts=2, retry_failed_after_hours=0)
+                _QueueWorker(app_run_config, storage).scan_files()
+
+        try:
+            workers = [threading.Thread(target=work, args=(f"worker_{i}",)) for i in range(2)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            # every file is processed once, the broken one doesn't stop the workers
+            self.assertEqual(sorted(f"movie_{i}.avi" for i in range(1, 12)), sorted(name for _, name in processed))
+            self.assertEqual({'worker_0', 'worker_1'}, {worker_id for worker_id, _ in processed})
+            with Storage(db_file) as storage:
+                self.assertEqual(11, len(storage.get_all_video_files()))
+                jobs = {job['filename']: job for job in storage.get_all_jobs()}
+                self.assertEqual(('failed', 2), (jobs['movie_0.avi']['state'], jobs['movie_0.avi']['attempts']))
+                self.assertIn('broken file', jobs['movie_0.avi']['error'])
+                self.assertEqual({'done': 11, 'failed': 1}, storage.count_jobs())
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_hanging_extraction_recorded_as_failed(self):
+        tmp_dir = tempfile.mkdtemp()
+        bin_dir = tempfile.mkdtemp()
+        shutil.copyfile('fragment.mkv', os.path.join(tmp_dir, 'fragment.mkv'))
+        open(os.path.join(tmp_dir, 'movie.avi'), 'w').close()
+        calls_file = os.path.join(bin_dir, 'calls')
+        write_fake_executable(bin_dir, 'mkvextract', f"echo called >> {calls_file}\nexec sleep 60\n")
+
+        def calls():
+            with open(calls_file) as f:
+                return len(f.readlines())
+
+        try:
+            with Storage(':memory:') as storage, \
+                    mock.patch.dict(os.environ, {'PATH': f"{bin_dir}{os.pathsep}{os.environ['PATH']}"}):
+                app_run_config = AppRunConfig(tmp_dir, [languages.get(part1=x) for x in ['ru', 'en']], [], ".*", {},
+                                              False, subprocess_timeout_scale=0.01)
+                ExtractSubs(app_run_config, storage).scan_files()
+
+                # the hanging file doesn't stop the others
+                self.assertEqual(['movie.avi'], [f['filename'] for f in storage.get_all_video_files()])
+                failed_file = storage.get_failed_files()[(tmp_dir, 'fragment.mkv')]
+                self.assertIn('TimeoutExpired', failed_file['error'])
+                self.assertGreater(datetime.fromisoformat(failed_file['retry_after']),
+                                   datetime.utcnow() + timedelta(hours=23))
+                self.assertEqual(1, calls())
+
+                # not retried before the retry time
+                ExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(1, calls())
+
+                # retried at once when the file changes
+                os.utime(os.path.join(tmp_dir, 'fragment.mkv'), ns=(0, 0))
+                ExtractSubs(app_run_config, storage).scan_files()
+                self.assertEqual(2, calls())
+                self.assertEqual(2, storage.get_failed_files()[(tmp_dir, 'fragment.mkv')]['attempts'])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(bin_dir, ignore_errors=True)
+
+    def test_unknown_language_track_and_failed_save(self):
+        tmp_dir = tempfile.mkdtemp()
+        for name in ['movie.mkv', 'broken.avi', 'other.avi']:
+            open(os.path.join(tmp_dir, name), 'w').close()
+        # qaa - original language from the private use range
+        tracks = [MKVTrackInfo(None, 'subtitles', 2, 'eng', None, {'codec_id': 'S_TEXT/UTF8'}),
+                  MKVTrackInfo(None, 'subtitles', 3, 'qaa', 'qaa', {'codec_id': 'S_TEXT/UTF8'})]
+
+        class _BrokenSaveExtractSubs(ExtractSubs):
+            def _save_scanned_files(self, files):
+                if files[0].filename == 'broken.avi':
+                    raise sqlite3.OperationalError("disk I/O error")
+                super()._save_scanned_files(files)
+
+        try:
+            with Storage(':memory:') as storage, \
+                    mock.patch('extract_subs.parse_mkv_subtitles_info_from_file', return_value=tracks), \
+                    mock.patch('extract_subs.extract_mkv_tracks'):
+                app_run_config = AppRunConfig(tmp_dir, [], [], ".*", {}, False)
+                _BrokenSaveExtractSubs(app_run_config, storage).scan_files()
+
+                self.assertEqual(['movie.mkv', 'other.avi'],
+                                 sorted(f['filename'] for f in storage.get_all_video_files()))
+                video_file = storage.get_video_file_by_full_path(os.path.join(tmp_dir, 'movie.mkv'))
+                self.assertEqual([('movie_eng.srt', 'eng'), ('movie_qaa.srt', 'und')],
+                                 [(os.path.basename(s['full_path']), s['language_iso639_3'])
+                                  for s in storage.get_all_subtitles_by_video_file_id(video_file['id'])])
+                self.assertIn('disk I/O error', storage.get_failed_files()[(tmp_dir, 'broken.avi')]['error'])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_merge_tracks_extracted_into_memory(self):
+        tmp_dir = tempfile.mkdtemp()
+        bin_dir = tempfile.mkdtemp()
+        shutil.copyfile('fragment.mkv', os.path.join(tmp_dir, 'fragment.mkv'))
+        args_file = os.path.join(bin_dir, 'args')
+        write_fake_executable(bin_dir, 'mkvextract', f"echo \"$@\" >> {args_file}\n" + FAKE_MKVEXTRACT.format(skip='-'))
+        try:
+            with Storage(':memory:') as storage, \
+                    mock.patch.dict(os.environ, {'PATH': f"{bin_dir}{os.pathsep}{os.environ['PATH']}"}):
+                app_run_config = AppRunConfig(tmp_dir, [languages.get(part1=x) for x in ['ru', 'en', 'fr']],
+                                              [(languages.get(part1='fr'), languages.get(part1='en'))], ".*", {},
+                                              False, write_extracted_subtitles=False)
+                ExtractSubs(app_run_config, storage).scan_files()
+
+                # only tracks of merged languages are extracted, without the mkvextract log file
+                with open(args_file) as f:
+                    args = f.read().split()
+                self.assertEqual(['5', '8'], sorted(arg.split(':')[0] for arg in args if ':' in arg))
+                self.assertNotIn('-r', args)
+                # no extracted subtitle is written
+                self.assertEqual(['fragment.fr_en_1.ass', 'fragment.mkv'], sorted(os.listdir(tmp_dir)))
+                merged = mergesubs.load(os.path.join(tmp_dir, 'fragment.fr_en_1.ass'))
+                self.assertEqual({'Track 8'}, {line.text for line in merged if line.style == 'top'})
+                self.assertEqual({'Track 5'}, {line.text for line in merged if line.style == 'bot'})
+
+                video_file = storage.get_all_video_files()[0]
+                merged_subtitles = storage.get_all_merged_subtitles_by_video_file_id(video_file['id'])
+                self.assertEqual(1, len(merged_subtitles))
+                merge_inputs = json.loads(merged_subtitles[0]['merge_inputs'])
+                self.assertEqual([os.path.join(tmp_dir, 'fragment.mkv')] * 2, [x['path'] for x in merge_inputs])
+                self.assertEqual(5, merge_inputs[1]['track_id'])
+
+                # the merge is up to date, the new language doesn't need its tracks
+                os.remove(args_file)
+                ExtractSubs(app_run_config._replace(target_languages=app_run_config.target_languages +
+                                                    [languages.get(part1='de')]), storage).scan_files()
+                self.assertFalse(os.path.exists(args_file))
+                video_file = storage.get_all_video_files()[0]
+                self.assertEqual(merged_subtitles, storage.get_all_merged_subtitles_by_video_file_id(video_file['id']))
+
+                # only tracks of the pair which isn't merged yet are extracted
+                ExtractSubs(app_run_config._replace(
+                    merge_languages_pairs=app_run_config.merge_languages_pairs +
+                    [(languages.get(part1='de'), languages.get(part1='en'))]), storage).scan_files()
+                with open(args_file) as f:
+                    args = f.read().split()
+                self.assertEqual(['5', '6'], sorted(arg.split(':')[0] for arg in args if ':' in arg))
+                video_file = storage.get_all_video_files()[0]
+                self.assertEqual(['deu,eng', 'fra,eng'], sorted(
+                    s['language_iso639_3'] for s in storage.get_all_merged_subtitles_by_video_file_id(video_file['id'])))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(bin_dir, ignore_errors=True)
+
 
 if __name__ == '__main__':
     unittest.main()
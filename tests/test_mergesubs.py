@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import mergesubs
+
+_SRT = "1\n00:00:01,000 --> 00:00:02,000\n{}\n\n"
+
+
+class TestMergeSubs(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _write(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    @mock.patch('mergesubs._DETECT_CHUNK_SIZE', 4 * 1024)
+    @mock.patch('mergesubs._DETECT_MAX_BYTES', 16 * 1024)
+    def test_charset_detect_reads_prefix_of_big_file(self):
+        text = _SRT.format("Привет, как дела? Всё хорошо, спасибо.") * 400
+        # binary garbage after the prefix limit, e.g. embedded fonts, doesn't change the result
+        path = self._write('big.srt', text.encode('cp1251') + bytes(range(256)) * 400)
+        self.assertEqual('windows-1251', mergesubs.charset_detect(path).lower())
+
+    @mock.patch('mergesubs._DETECT_CHUNK_SIZE', 4 * 1024)
+    @mock.patch('mergesubs._DETECT_MAX_BYTES', 16 * 1024)
+    def test_charset_detect_ascii_prefix_is_utf8(self):
+        text = _SRT.format("hello") * 1000 + _SRT.format("Привет, как дела? Всё хорошо, спасибо.") * 50
+        path = self._write('ascii_prefix.srt', text.encode('utf-8'))
+        with mock.patch('chardet.detect', wraps=mergesubs.chardet.detect) as detect:
+            self.assertEqual('utf-8', mergesubs.charset_detect(path).lower())
+            detect.assert_not_called()
+
+    @mock.patch('mergesubs._DETECT_CHUNK_SIZE', 4 * 1024)
+    @mock.patch('mergesubs._DETECT_MAX_BYTES', 16 * 1024)
+    def test_load_ascii_prefix_in_other_encoding(self):
+        text = _SRT.format("hello") * 1000 + _SRT.format("Привет, как дела? Всё хорошо, спасибо.") * 50
+        path = self._write('ascii_prefix_cp1251.srt', text.encode('cp1251'))
+        self.assertEqual("Привет, как дела? Всё хорошо, спасибо.", mergesubs.load(path).events[-1].text)
+
+    def test_charset_detect_is_cached_until_file_changes(self):
+        path = self._write('cached.srt', _SRT.format("Привет, как дела?").encode('utf-8'))
+        mergesubs.charset_detect(path)
+        hits = mergesubs._detect_encoding.cache_info().hits
+        self.assertEqual('utf-8', mergesubs.charset_detect(path).lower())
+        self.assertEqual(hits + 1, mergesubs._detect_encoding.cache_info().hits)
+
+        self._write('cached.srt', _SRT.format("Привет, как дела? Всё хорошо, спасибо.").encode('cp1251'))
+        os.utime(path, ns=(0, 0))
+        self.assertEqual('windows-1251', mergesubs.charset_detect(path).lower())
+
+    def test_merge_loaded_keeps_loaded_subtitles(self):
+        top = mergesubs.load(self._write('movie.ru.srt', _SRT.format("Привет").encode('utf-8')))
+        bot_en = mergesubs.load(self._write('movie.en.srt', _SRT.format("Hello").encode('utf-8')))
+        bot_fr = mergesubs.load(self._write('movie.fr.srt', _SRT.format("Bonjour").encode('utf-8')))
+
+        merged_en = mergesubs.merge_loaded(top, bot_en)
+        merged_fr = mergesubs.merge_loaded(top, bot_fr)
+
+        self.assertEqual([('bot', 'Hello'), ('top', 'Привет')], [(e.style, e.text) for e in merged_en])
+        self.assertEqual([('bot', 'Bonjour'), ('top', 'Привет')], [(e.style, e.text) for e in merged_fr])
+        self.assertEqual(['Default'], [e.style for e in top])
+        self.assertEqual(['Default'], [e.style for e in bot_en])
+        self.assertEqual({'Default'}, set(bot_en.styles))
+
+        merged_path = os.path.join(self.tmp_dir, 'movie.ru_en.ass')
+        mergesubs.merge(os.path.join(self.tmp_dir, 'movie.ru.srt'), os.path.join(self.tmp_dir, 'movie.en.srt'),
+                        merged_path)
+        with open(merged_path, encoding='utf-8') as f:
+            self.assertEqual(merged_en.to_string('ass'), f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from metrics import Metrics, NullMetrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stage_counts_latency_bytes_and_errors(self):
+        metrics = Metrics()
+        for _ in range(3):
+            with metrics.stage('probe'):
+                pass
+        with self.assertRaises(ValueError):
+            with metrics.stage('probe'):
+                raise ValueError()
+        metrics.add_bytes('extract', 1024)
+
+        stages = metrics.to_dict()['stages']
+        self.assertEqual(4, stages['probe']['count'])
+        self.assertEqual(1, stages['probe']['errors'])
+        self.assertEqual(4, sum(stages['probe']['buckets'].values()))
+        self.assertEqual(4, stages['probe']['buckets']['0.001'])
+        self.assertEqual(1024, stages['extract']['bytes'])
+        self.assertIn('probe', metrics.summary())
+
+    def test_timed_iter(self):
+        metrics = Metrics()
+        self.assertEqual([1, 2, 3], list(metrics.timed_iter('walk', [1, 2, 3])))
+        # the last call finds the end of the iterable
+        self.assertEqual(4, metrics.to_dict()['stages']['walk']['count'])
+
+    def test_prometheus_and_json_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            metrics = Metrics()
+            with metrics.stage('merge'):
+                pass
+            prometheus_path = os.path.join(tmp_dir, 'extract_subs.prom')
+            json_path = os.path.join(tmp_dir, 'metrics.json')
+            metrics.write_prometheus(prometheus_path)
+            metrics.write_json(json_path)
+
+            with open(prometheus_path) as f:
+                lines = f.read().splitlines()
+            self.assertIn('# TYPE extract_subs_stage_seconds histogram', lines)
+            self.assertIn('extract_subs_stage_seconds_bucket{stage="merge",le="+Inf"} 1', lines)
+            self.assertIn('extract_subs_stage_seconds_count{stage="merge"} 1', lines)
+            self.assertIn('extract_subs_stage_errors_total{stage="merge"} 0', lines)
+            with open(json_path) as f:
+                self.assertEqual(1, json.load(f)['stages']['merge']['count'])
+            self.assertEqual(['extract_subs.prom', 'metrics.json'], sorted(os.listdir(tmp_dir)))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_null_metrics_record_nothing(self):
+        metrics = NullMetrics()
+        items = [1, 2]
+        with metrics.stage('probe'):
+            metrics.add_bytes('probe', 10)
+        self.assertIs(items, metrics.timed_iter('walk', items))
+        self.assertEqual({}, metrics.to_dict()['stages'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mkv_ebml import read_tracks, EBMLError
+
+
+class TestMkvEbml(unittest.TestCase):
+    def test_read_tracks_same_as_mkvmerge(self):
+        with open('example_mkvinfo_output_2', 'r') as info_file:
+            mkvmerge_tracks = {track['id']: track for track in json.load(info_file)['tracks']}
+
+        tracks = read_tracks('fragment.mkv')
+        self.assertTrue(len(tracks) > 0)
+        for track in tracks:
+            mkvmerge_track = mkvmerge_tracks[track['id']]
+            self.assertEqual(mkvmerge_track['type'], track['type'])
+            for key, value in track['properties'].items():
+                self.assertEqual(mkvmerge_track['properties'][key], value, f"Track {track['id']}, property {key}")
+
+    def test_not_matroska_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        file = os.path.join(tmp_dir, 'not_matroska.mkv')
+        with open(file, 'wb') as f:
+            f.write(b'RIFF' + bytes(1024))
+
+        with self.assertRaises(EBMLError):
+            read_tracks(file)
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_truncated_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        file = os.path.join(tmp_dir, 'truncated.mkv')
+        with open('fragment.mkv', 'rb') as source, open(file, 'wb') as f:
+            f.write(source.read(100))
+
+        with self.assertRaises(EBMLError):
+            read_tracks(file)
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
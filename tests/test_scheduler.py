@@ -0,0 +1,57 @@
+import threading
+import time
+import unittest
+
+from scheduler import DeviceScheduler
+
+
+class _RecordingDeviceScheduler(DeviceScheduler):
+    """
+    Paths are "<device>/<file>", the device is taken from the path instead of stat
+    """
+
+    @staticmethod
+    def _device(path: str):
+        return int(path.split('/')[0])
+
+
+class TestDeviceScheduler(unittest.TestCase):
+    def _run(self, paths, jobs_per_device):
+        lock = threading.Lock()
+        running = {}
+        max_running = {}
+
+        def job(path):
+            device = path.split('/')[0]
+            with lock:
+                running[device] = running.get(device, 0) + 1
+                max_running[device] = max(max_running.get(device, 0), running[device])
+            time.sleep(0.05)
+            with lock:
+                running[device] -= 1
+            return path
+
+        with _RecordingDeviceScheduler(jobs_per_device) as scheduler:
+            futures = [scheduler.submit(job, path) for path in paths]
+            self.assertEqual(paths, [future.result() for future in futures])
+        return max_running
+
+    def test_one_job_per_device(self):
+        paths = [f"{device}/movie_{i}.mkv" for i in range(4) for device in (1, 2)]
+        start = time.monotonic()
+        self.assertEqual({'1': 1, '2': 1}, self._run(paths, jobs_per_device=1))
+        # devices are read in parallel
+        self.assertLess(time.monotonic() - start, 8 * 0.05)
+
+    def test_jobs_per_device(self):
+        paths = [f"1/movie_{i}.mkv" for i in range(6)]
+        self.assertEqual({'1': 3}, self._run(paths, jobs_per_device=3))
+
+    def test_path_of_item(self):
+        with DeviceScheduler(path_of=lambda item: item['path']) as scheduler:
+            future = scheduler.submit(lambda item: item['name'], {'path': __file__, 'name': 'test'})
+            self.assertEqual('test', future.result())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,16 @@
 import json
 import os
 import shutil
+import sqlite3
 import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta
 from random import shuffle
 
 from iso639_json_parser import Iso639Decoder
-from storage import Storage
+from storage import Storage, VideoFileScanRecord, VideoSubtitleRecord, JOB_DONE, JOB_FAILED, JOB_PENDING, \
+    JOB_RUNNING
 
 
 def read_cache(file_path):
@@ -43,6 +47,232 @@ class TestStorage(unittest.TestCase):
             self.assertEqual(len(file['subtitles']) + len(file['merged_subtitles']),
                              len(storage.get_all_subtitles_by_video_file_id(s_file['id'])))
 
+    def test_migration_of_cache_with_duplicated_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        _cache_file_path = os.path.join(tmp_dir, 'cache_sample.json')
+        with open('cache_sample.json') as f:
+            cache = json.load(f)
+        duplicated_file = dict(cache['files'][0], subtitles=cache['files'][0]['subtitles'] * 2)
+        cache['files'].append(duplicated_file)
+        with open(_cache_file_path, 'w') as f:
+            json.dump(cache, f)
+
+        with Storage(':memory:') as storage:
+            storage._migrate_from_cache_file(_cache_file_path)
+            self.assertEqual(len(cache['files']) - 1, len(storage.get_all_video_files()))
+            s_file = storage.get_video_file_by_full_path(duplicated_file['full_path'])
+            self.assertEqual(len(duplicated_file['subtitles']) + len(duplicated_file['merged_subtitles']),
+                             len(storage.get_all_subtitles_by_video_file_id(s_file['id'])))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_fingerprint_columns_added_to_old_db(self):
+        tmp_dir = tempfile.mkdtemp()
+        db_file = os.path.join(tmp_dir, 'old.sqlite3')
+        with sqlite3.connect(db_file) as conn:
+            conn.execute("CREATE TABLE video_file (id INTEGER PRIMARY KEY, dir TEXT NOT NULL, filename TEXT NOT NULL, "
+                         "scan_time TEXT NOT NULL)")
+            conn.execute("INSERT INTO video_file (dir, filename, scan_time) VALUES ('/movies', 'a.mkv', '')")
+        conn.close()
+
+        with Storage(db_file) as storage:
+            fingerprints = storage.get_scanned_fingerprints()
+            self.assertEqual({('/movies', 'a.mkv')}, set(fingerprints.keys()))
+            self.assertIsNone(fingerprints[('/movies', 'a.mkv')].size)
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_bulk_session_commits_once_per_n_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        db_file = os.path.join(tmp_dir, 'bulk.sqlite3')
+
+        def scan(i):
+            return VideoFileScanRecord('/movies', f"movie_{i}.mkv", None,
+                                       [VideoSubtitleRecord(f"/movies/movie_{i}_en.srt", 'eng', 2, 'FILE'),
+                                        VideoSubtitleRecord(f"/movies/movie_{i}.ru_en.ass", 'rus,eng', None, 'Merge')])
+
+        def committed_files_count():
+            with sqlite3.connect(db_file) as reader:
+                return reader.execute("SELECT count(*) FROM video_file").fetchone()[0]
+
+        with Storage(db_file) as storage:
+            with storage.bulk_session(commit_every=2):
+                storage.save_scan_results([scan(0)])
+                self.assertEqual(0, committed_files_count())
+                storage.save_scan_results([scan(1)])
+                self.assertEqual(2, committed_files_count())
+                storage.save_scan_results([scan(2)])
+                self.assertEqual(2, committed_files_count())
+            self.assertEqual(3, committed_files_count())
+
+            with storage.bulk_session(commit_every=100, commit_interval=0):
+                storage.save_scan_results([scan(3)])
+                self.assertEqual(4, committed_files_count())
+
+            # saving a scan of the same file again replaces it
+            storage.save_scan_results([scan(0)])
+            self.assertEqual(4, len(storage.get_all_video_files()))
+            self.assertEqual(8, len(storage.get_all_subtitles()))
+            s_file = storage.get_video_file_by_full_path('/movies/movie_0.mkv')
+            self.assertEqual(1, len(storage.get_all_merged_subtitles_by_video_file_id(s_file['id'])))
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_migration_removes_duplicates_and_adds_indexes(self):
+        tmp_dir = tempfile.mkdtemp()
+        db_file = os.path.join(tmp_dir, 'duplicates.sqlite3')
+        with sqlite3.connect(db_file) as conn:
+            conn.execute("CREATE TABLE video_file (id INTEGER PRIMARY KEY, dir TEXT NOT NULL, filename TEXT NOT NULL, "
+                         "scan_time TEXT NOT NULL)")
+            conn.execute("CREATE TABLE video_subtitle (id integer PRIMARY key, video_file_id integer not NULL, "
+                         "full_path TEXT NOT NULL, language_iso639_3 TEXT NOT NULL, track_id INTEGER, "
+                         "source TEXT NOT NULL)")
+            conn.executemany("INSERT INTO video_file (id, dir, filename, scan_time) VALUES (?, '/movies', ?, '')",
+                             [(1, 'a.mkv'), (2, 'a.mkv'), (3, 'b.mkv')])
+            conn.executemany("INSERT INTO video_subtitle (video_file_id, full_path, language_iso639_3, track_id, "
+                             "source) VALUES (?, ?, 'eng', 3, 'FILE')",
+                             [(1, '/movies/a_en.srt'), (2, '/movies/a_en.srt'), (2, '/movies/a_en.srt'),
+                              (3, '/movies/b_en.srt')])
+        conn.close()
+
+        with Storage(db_file) as storage:
+            self.assertEqual([2, 3], sorted(f['id'] for f in storage.get_all_video_files()))
+            self.assertEqual(1, len(storage.get_all_subtitles_by_video_file_id(2)))
+            self.assertEqual(2, len(storage.get_all_subtitles()))
+
+            with self.assertRaises(sqlite3.IntegrityError):
+                storage.create_video_file('/movies', 'a.mkv')
+            self.assertEqual(2, storage.create_video_file('/movies/', 'a.mkv', override_on_exist=True)['id'])
+
+            plan = storage.conn.execute("EXPLAIN QUERY PLAN SELECT * FROM video_subtitle WHERE video_file_id = 2")
+            self.assertIn('USING INDEX', ' '.join(row['detail'] for row in plan.fetchall()))
+            plan = storage.conn.execute("EXPLAIN QUERY PLAN SELECT * FROM video_file WHERE dir = ? AND filename = ?",
+                                        ('/movies', 'a.mkv'))
+            self.assertIn('USING INDEX', ' '.join(row['detail'] for row in plan.fetchall()))
+            schema_version = storage.conn.execute("PRAGMA user_version").fetchone()['user_version']
+            self.assertTrue(schema_version >= 2)
+            subtitle_columns = {row['name'] for row in storage.conn.execute("PRAGMA table_info(video_subtitle)")}
+            self.assertIn('merge_inputs', subtitle_columns)
+
+        # migrations run once
+        with Storage(db_file) as storage:
+            self.assertEqual(schema_version, storage.conn.execute("PRAGMA user_version").fetchone()['user_version'])
+            self.assertEqual(2, len(storage.get_all_video_files()))
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_online_subtitle_miss_backoff(self):
+        with Storage(':memory:') as storage:
+            for _ in range(4):
+                storage.record_online_subtitle_miss('hash', 'eng', '/movies/a.mkv', timedelta(days=1),
+                                                    timedelta(days=5))
+            storage.record_online_subtitle_miss('hash', 'fra', '/movies/a.mkv', timedelta(days=1), timedelta(days=5))
+
+            misses = {m['language_iso639_3']: m for m in storage.get_online_subtitle_misses('hash')}
+            self.assertEqual(4, misses['eng']['attempts'])
+            self.assertEqual(1, misses['fra']['attempts'])
+
+            def interval(miss):
+                return datetime.fromisoformat(miss['next_check_time']) - datetime.fromisoformat(
+                    miss['last_check_time'])
+
+            # 1, 2, 4, 8 days capped by 5
+            self.assertEqual(timedelta(days=5), interval(misses['eng']))
+            self.assertEqual(timedelta(days=1), interval(misses['fra']))
+            self.assertEqual(['fra', 'eng'], [m['language_iso639_3'] for m in storage.get_all_online_subtitle_misses()])
+
+            storage.delete_online_subtitle_misses('hash', ['fra'])
+            self.assertEqual(['eng'], [m['language_iso639_3'] for m in storage.get_online_subtitle_misses('hash')])
+            storage.delete_online_subtitle_misses()
+            self.assertEqual([], storage.get_all_online_subtitle_misses())
+
+    def test_merge_inputs_saved_with_merged_subtitle(self):
+        merge_inputs = [{'path': '/movies/a_ru.srt', 'size': 10, 'mtime_ns': 1},
+                        {'path': '/movies/a_en.srt', 'size': 20, 'mtime_ns': 2}]
+        with Storage(':memory:') as storage:
+            storage.save_scan_results([VideoFileScanRecord('/movies', 'a.mkv', None, [
+                VideoSubtitleRecord('/movies/a_en.srt', 'eng', 2, 'FILE'),
+                VideoSubtitleRecord('/movies/a.ru_en.ass', 'rus,eng', None, 'Merge', merge_inputs),
+                VideoSubtitleRecord('/movies/a.ru_fr.ass', 'rus,fra', None, 'Merge')])])
+            self.assertEqual({'/movies/a.ru_en.ass': merge_inputs}, storage.get_merge_inputs())
+
+    def test_job_claimed_by_one_worker(self):
+        tmp_dir = tempfile.mkdtemp()
+        db_file = os.path.join(tmp_dir, 'jobs.sqlite3')
+        files = [('/movies/', f"movie_{i}.mkv") for i in range(40)]
+        with Storage(db_file) as storage:
+            storage.enqueue_jobs(files)
+        claimed = []
+
+        def work(worker):
+            # every worker has its own connection like a separate process
+            with Storage(db_file) as worker_storage:
+                while True:
+                    jobs = worker_storage.claim_jobs(worker, 3, timedelta(minutes=10), 3)
+                    if not jobs:
+                        return
+                    claimed.extend(jobs)
+                    for dir, filename in jobs:
+                        worker_storage.finish_job(dir, filename, worker)
+
+        workers = [threading.Thread(target=work, args=(f"worker_{i}",)) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(('/movies', filename) for _, filename in files), sorted(claimed))
+        with Storage(db_file) as storage:
+            self.assertEqual({JOB_DONE: 40}, storage.count_jobs())
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_job_of_crashed_worker_claimed_again(self):
+        with Storage(':memory:') as storage:
+            storage.enqueue_jobs([('/movies', 'a.mkv')])
+            # the lease of a crashed worker is already expired
+            self.assertEqual([('/movies', 'a.mkv')], storage.claim_jobs('crashed', 10, timedelta(seconds=-1), 2))
+            self.assertEqual([('/movies', 'a.mkv')], storage.claim_jobs('alive', 10, timedelta(minutes=10), 2))
+            self.assertEqual([], storage.claim_jobs('other', 10, timedelta(minutes=10), 2))
+            # a job finished by a worker which lost the lease stays running
+            storage.finish_job('/movies', 'a.mkv', 'crashed')
+            job = storage.get_all_jobs()[0]
+            self.assertEqual((JOB_RUNNING, 'alive', 2), (job['state'], job['worker'], job['attempts']))
+
+            storage.renew_job_leases('alive', timedelta(seconds=-1))
+            self.assertEqual([], storage.claim_jobs('other', 10, timedelta(minutes=10), 2))
+            job = storage.get_all_jobs()[0]
+            self.assertEqual((JOB_FAILED, 'lease expired'), (job['state'], job['error']))
+
+    def test_failed_job_retried_until_max_attempts(self):
+        with Storage(':memory:') as storage:
+            storage.enqueue_jobs([('/movies', 'a.mkv')])
+            for attempt in range(1, 3):
+                self.assertEqual([('/movies', 'a.mkv')], storage.claim_jobs('worker', 1, timedelta(minutes=10), 2))
+                storage.fail_job('/movies', 'a.mkv', 'worker', 'broken file', 2)
+                self.assertEqual(JOB_PENDING if attempt < 2 else JOB_FAILED, storage.get_all_jobs()[0]['state'])
+            storage.enqueue_jobs([('/movies', 'b.mkv')])
+            self.assertEqual([('/movies', 'b.mkv')], storage.claim_jobs('worker', 10, timedelta(minutes=10), 2))
+
+            # the running job isn't reset, the failed one is queued again
+            storage.enqueue_jobs([('/movies', 'a.mkv'), ('/movies', 'b.mkv')])
+            jobs = {job['filename']: job for job in storage.get_all_jobs()}
+            self.assertEqual((JOB_PENDING, 0, None), (jobs['a.mkv']['state'], jobs['a.mkv']['attempts'],
+                                                      jobs['a.mkv']['error']))
+            self.assertEqual(JOB_RUNNING, jobs['b.mkv']['state'])
+
+    def test_failed_job_not_claimed_before_retry_time(self):
+        with Storage(':memory:') as storage:
+            storage.enqueue_jobs([('/movies', 'a.mkv')])
+            self.assertEqual([('/movies', 'a.mkv')], storage.claim_jobs('worker', 1, timedelta(minutes=10), 3))
+            storage.fail_job('/movies', 'a.mkv', 'worker', 'mkvextract timed out', 3,
+                             datetime.utcnow() + timedelta(hours=1))
+            self.assertEqual(JOB_PENDING, storage.get_all_jobs()[0]['state'])
+            self.assertEqual([], storage.claim_jobs('worker', 1, timedelta(minutes=10), 3))
+
+            with storage.conn:
+                storage.conn.execute("UPDATE job SET retry_after = ?",
+                                     ((datetime.utcnow() - timedelta(seconds=1)).isoformat(),))
+            self.assertEqual([('/movies', 'a.mkv')], storage.claim_jobs('worker', 1, timedelta(minutes=10), 3))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 
 from extract_mkv_info import parse_mkv_subtitles_info_from_str
-from util import bcp47_language_code_to_iso_639, iso639_from_str
+from util import bcp47_language_code_to_iso_639, iso639_from_bcp47, iso639_from_str
 
 
 class TestUtils(unittest.TestCase):
@@ -26,6 +26,20 @@ class TestUtils(unittest.TestCase):
         self.assertIsNotNone(iso639_from_str('en'))
         self.assertEqual(iso639_from_str('en').name, "English")
 
+    def test_iso639_from_str_unknown_or_upper_case(self):
+        self.assertIsNone(iso639_from_str(None))
+        self.assertIsNone(iso639_from_str('xx'))
+        self.assertIsNone(iso639_from_str('english'))
+        self.assertEqual(iso639_from_str('ENG').name, "English")
+        # part2b code and part3 code resolve to the same language
+        self.assertIs(iso639_from_str('ger'), iso639_from_str('deu'))
+
+    def test_iso639_from_bcp47(self):
+        self.assertEqual(iso639_from_bcp47('pt-BR').name, "Portuguese")
+        self.assertEqual(iso639_from_bcp47('zh-Hans-CN').name, "Chinese")
+        self.assertEqual(iso639_from_bcp47(None, default='rus').name, "Russian")
+        self.assertIsNone(iso639_from_bcp47(None))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import walker
+
+
+class TestWalker(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for path in ['movie.mkv', 'notes.txt',
+                     'disk1/a/movie_a.mkv', 'disk1/a/b/movie_b.avi', 'disk1/a/movie_a.srt',
+                     'disk2/movie_c.mp4',
+                     '@Recycle/deleted.mkv', 'disk1/@Recently-Snapshot/GMT+03/a/movie_a.mkv',
+                     'disk2/.streams/stream.mkv']:
+            full_path = os.path.join(self.tmp_dir, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, 'w').close()
+        self.expected = {(self.tmp_dir, 'movie.mkv'), (os.path.join(self.tmp_dir, 'disk1/a'), 'movie_a.mkv'),
+                         (os.path.join(self.tmp_dir, 'disk1/a/b'), 'movie_b.avi'),
+                         (os.path.join(self.tmp_dir, 'disk2'), 'movie_c.mp4')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _iter_files(self, jobs):
+        return set(walker.iter_files([self.tmp_dir], ['.mkv', '.avi', '.mp4'],
+                                     [*walker.DEFAULT_EXCLUDE_DIRS, f"{self.tmp_dir}/disk2/.*"], jobs))
+
+    def test_iter_files(self):
+        self.assertEqual(self.expected, self._iter_files(jobs=1))
+
+    def test_iter_files_concurrently(self):
+        self.assertEqual(self.expected, self._iter_files(jobs=4))
+
+    def test_excluded_dirs_are_not_read(self):
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self._iter_files(jobs=1)
+        scanned_dirs = {os.path.relpath(call.args[0], self.tmp_dir) for call in scandir.call_args_list}
+        self.assertEqual({'.', 'disk1', 'disk1/a', 'disk1/a/b', 'disk2'}, scanned_dirs)
+
+    def test_is_in_excluded_dir(self):
+        self.assertTrue(walker.is_in_excluded_dir('/share/@Recycle/movie/movie.mkv', walker.DEFAULT_EXCLUDE_DIRS))
+        self.assertTrue(walker.is_in_excluded_dir('/share/@Recently-Snapshot/GMT+03/movie.mkv', ['@Recently-*']))
+        self.assertFalse(walker.is_in_excluded_dir('/share/Movies/Recycle.mkv', walker.DEFAULT_EXCLUDE_DIRS))
+
+
+if __name__ == '__main__':
+    unittest.main()
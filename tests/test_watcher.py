@@ -0,0 +1,78 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from watcher import InotifyWatcher
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is available only on Linux')
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_written_files_reported(self):
+        with InotifyWatcher(self.tmp_dir, ['.mkv'], settle_seconds=0.1) as watcher:
+            self.assertEqual([], watcher.wait_for_files(timeout=0.2))
+
+            file = os.path.join(self.tmp_dir, 'movie.mkv')
+            with open(file, 'w') as f:
+                f.write('data')
+            with open(os.path.join(self.tmp_dir, 'movie.nfo'), 'w') as f:
+                f.write('data')
+
+            self.assertEqual([file], watcher.wait_for_files(timeout=2))
+            self.assertEqual([], watcher.wait_for_files(timeout=0.2))
+
+    def test_new_directories_watched(self):
+        outside_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(outside_dir, 'season_1'))
+        moved_file = os.path.join(outside_dir, 'season_1', 'episode_1.mkv')
+        open(moved_file, 'w').close()
+
+        with InotifyWatcher(self.tmp_dir, ['.mkv'], settle_seconds=0.1) as watcher:
+            new_dir = os.path.join(self.tmp_dir, 'new')
+            os.makedirs(new_dir)
+            self.assertEqual([], watcher.wait_for_files(timeout=0.2))
+            file = os.path.join(new_dir, 'movie.mkv')
+            with open(file, 'w') as f:
+                f.write('data')
+            self.assertEqual([file], watcher.wait_for_files(timeout=2))
+
+            shutil.move(os.path.join(outside_dir, 'season_1'), self.tmp_dir)
+            self.assertEqual([os.path.join(self.tmp_dir, 'season_1', 'episode_1.mkv')],
+                             watcher.wait_for_files(timeout=2))
+
+        shutil.rmtree(outside_dir, ignore_errors=True)
+
+    def test_excluded_directories_not_watched(self):
+        os.makedirs(os.path.join(self.tmp_dir, '@Recycle', 'old'))
+        with InotifyWatcher(self.tmp_dir, ['.mkv'], settle_seconds=0.1) as watcher:
+            self.assertEqual([self.tmp_dir], list(watcher._watches.values()))
+            with open(os.path.join(self.tmp_dir, '@Recycle', 'movie.mkv'), 'w') as f:
+                f.write('data')
+            snapshot_dir = os.path.join(self.tmp_dir, '@Recently-Snapshot', 'GMT+03_2024-01-01')
+            os.makedirs(snapshot_dir)
+            with open(os.path.join(snapshot_dir, 'movie.mkv'), 'w') as f:
+                f.write('data')
+            self.assertEqual([], watcher.wait_for_files(timeout=0.3))
+            self.assertEqual([self.tmp_dir], list(watcher._watches.values()))
+
+    def test_file_reported_after_writing_stopped(self):
+        file = os.path.join(self.tmp_dir, 'movie.mkv')
+        with InotifyWatcher(self.tmp_dir, ['.mkv'], settle_seconds=0.3) as watcher:
+            with open(file, 'w') as f:
+                f.write('first part')
+            self.assertEqual([], watcher.wait_for_files(timeout=0.1))
+            with open(file, 'a') as f:
+                f.write('second part')
+            self.assertEqual([], watcher.wait_for_files(timeout=0.1))
+            self.assertEqual([file], watcher.wait_for_files(timeout=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,14 @@
+import functools
+import hashlib
+import os
+from collections import namedtuple
+from types import MappingProxyType
+from typing import Mapping
+
 from iso639 import languages as iso639
 
+FileFingerprint = namedtuple('FileFingerprint', ['size', 'mtime_ns', 'partial_hash'])
+
 _DETECTED_TO_ISO_639_PART1_DICT = {
     "zh-cn": "zh",
     "zh-tw": "zh"
@@ -23,25 +32,60 @@ def bcp47_language_code_to_iso_639(bcp47_code: str, default=None) -> str:
         return default
 
 
-def iso639_from_str(lang_str: str) -> iso639:
-    def _try_iso639_from_str(**kwargs) -> iso639:
-        try:
-            return iso639.get(**kwargs)
-        except:
-            return None
+# the first part wins when a code is used by several parts
+_LANGUAGE_INDEX_PARTS = ('part1', 'part3', 'part2b', 'part2t', 'part5')
 
+
+@functools.lru_cache(maxsize=None)
+def _language_index() -> Mapping[str, iso639]:
+    """
+    Immutable index of iso-639 part1, part3, part2b, part2t and part5 codes to languages, built once on first use
+    """
+    index = {}
+    for part in reversed(_LANGUAGE_INDEX_PARTS):
+        index.update(getattr(iso639, part))
+    return MappingProxyType(index)
+
+
+def iso639_from_str(lang_str: str) -> iso639:
+    """
+    :param lang_str: 2 or 3 letter iso-639 code
+    :return: language or None for an unknown code
+    """
     if not lang_str:
         return None
+    return _language_index().get(lang_str.lower())
 
-    if len(lang_str) == 2:
-        return _try_iso639_from_str(part1=lang_str)
-
-    if len(lang_str) == 3:
-        iso639_lang = _try_iso639_from_str(part3=lang_str)
-        if not iso639_lang:
-            iso639_lang = _try_iso639_from_str(part2b=lang_str)
-        if not iso639_lang:
-            iso639_lang = _try_iso639_from_str(part2t=lang_str)
-        if not iso639_lang:
-            iso639_lang = _try_iso639_from_str(part5=lang_str)
-        return iso639_lang
+
+@functools.lru_cache(maxsize=1024)
+def iso639_from_bcp47(bcp47_code: str, default: str = None) -> iso639:
+    """
+    :param bcp47_code: BCP 47 tag, e.g. 'pt-BR', or a plain iso-639 code
+    :param default: iso-639 code used when bcp47_code is empty
+    """
+    return iso639_from_str(bcp47_language_code_to_iso_639(bcp47_code, default=default))
+
+
+def partial_hash(file_path: str, size_mb: int) -> str:
+    """
+    sha1 of the first and the last size_mb megabytes of a file, the whole file for small files
+    """
+    chunk_size = size_mb * 1024 * 1024
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        sha1.update(f.read(chunk_size))
+        if file_size > chunk_size:
+            f.seek(max(chunk_size, file_size - chunk_size))
+            sha1.update(f.read(chunk_size))
+    return sha1.hexdigest()
+
+
+def file_fingerprint(file_path: str, hash_size_mb: int = 0, stat: os.stat_result = None) -> FileFingerprint:
+    """
+    :param hash_size_mb: megabytes hashed at the beginning and at the end of the file, 0 - don't hash
+    :param stat: already known stat of the file
+    """
+    stat = stat or os.stat(file_path)
+    return FileFingerprint(stat.st_size, stat.st_mtime_ns,
+                           partial_hash(file_path, hash_size_mb) if hash_size_mb > 0 else None)
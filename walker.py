@@ -0,0 +1,123 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import Iterable, Iterator, List, Tuple
+
+# NAS recycle bins and snapshots, e.g. QNAP /share/Movies/@Recycle, /share/Movies/@Recently-Snapshot/GMT+03_...
+DEFAULT_EXCLUDE_DIRS = ('@Recycle*', '@Recently-Snapshot*')
+
+_DONE = object()
+
+
+def is_excluded_dir(path: str, exclude: Iterable[str]) -> bool:
+    """
+    :param exclude: globs matched against a directory name, globs with '/' are matched against the whole path
+    """
+    name = os.path.basename(path.rstrip('/'))
+    return any(fnmatchcase(path if '/' in pattern else name, pattern) for pattern in exclude)
+
+
+def is_in_excluded_dir(path: str, exclude: Iterable[str]) -> bool:
+    """
+    Any directory of the path is excluded
+    """
+    directory = os.path.dirname(path)
+    while directory and directory != os.path.dirname(directory):
+        if is_excluded_dir(directory, exclude):
+            return True
+        directory = os.path.dirname(directory)
+    return False
+
+
+def _scan_dir(path: str, extensions: Iterable[str], exclude: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """
+    :return: names of files with one of the extensions and paths of not excluded subdirectories
+    """
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    # the type of an entry comes from readdir, it's stat'ed only if the file system doesn't report it
+                    if entry.is_dir(follow_symlinks=False):
+                        if not is_excluded_dir(entry.path, exclude):
+                            dirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in extensions and entry.is_file():
+                        files.append(entry.name)
+                except OSError:
+                    continue
+    except OSError as e:
+        logging.error(f"Can't read directory {path}: {e}")
+    return files, dirs
+
+
+def _walk(root: str, extensions: Iterable[str], exclude: Iterable[str]) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Walk a tree top-down like os.walk, excluded directories are pruned before they are read
+    :return: directory path with names of its files with one of the extensions
+    """
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        files, dirs = _scan_dir(path, extensions, exclude)
+        yield path, files
+        stack.extend(reversed(dirs))
+
+
+def iter_files(roots: List[str], extensions: Iterable[str], exclude: Iterable[str] = DEFAULT_EXCLUDE_DIRS,
+               jobs: int = 1) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily find files with one of the extensions under the roots, directories matching exclude globs aren't read.
+    With jobs > 1 subtrees of the top level directories of the roots are walked concurrently,
+    e.g. several disks of a NAS share, the order of files isn't defined then
+    :return: (directory path, file name)
+    """
+    extensions = set(extensions)
+    exclude = list(exclude)
+    if jobs <= 1:
+        for root in roots:
+            for path, files in _walk(root, extensions, exclude):
+                for name in files:
+                    yield path, name
+        return
+
+    subtrees = []
+    for root in roots:
+        files, dirs = _scan_dir(root, extensions, exclude)
+        for name in files:
+            yield root, name
+        subtrees.extend(dirs)
+
+    # unbounded, so a worker never blocks when the consumer stops early
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def walk_subtree(subtree: str):
+        try:
+            for path, files in _walk(subtree, extensions, exclude):
+                if stop.is_set():
+                    return
+                if files:
+                    results.put((path, files))
+        finally:
+            results.put(_DONE)
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='walker') as executor:
+        for subtree in subtrees:
+            executor.submit(walk_subtree, subtree)
+        remaining = len(subtrees)
+        try:
+            while remaining:
+                result = results.get()
+                if result is _DONE:
+                    remaining -= 1
+                    continue
+                path, files = result
+                for name in files:
+                    yield path, name
+        finally:
+            stop.set()
@@ -0,0 +1,178 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import walker
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = _IN_CREATE | _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_DELETE | \
+              _IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_BUFFER_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    """
+    Recursively watch a directory tree with inotify and report files which are completely written:
+    a file is ready when it was closed after writing or moved into the tree and its size and mtime
+    haven't changed for settle_seconds. Directories matching exclude_dirs globs aren't watched,
+    every watch counts against fs.inotify.max_user_watches
+    """
+
+    def __init__(self, root: str, extensions: List[str], settle_seconds: float = 10,
+                 exclude_dirs: Iterable[str] = walker.DEFAULT_EXCLUDE_DIRS):
+        self._root = root
+        self._extensions = set(extensions)
+        self._settle_seconds = settle_seconds
+        self._exclude_dirs = list(exclude_dirs)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 error {os.strerror(ctypes.get_errno())}")
+        self._watches: Dict[int, str] = {}
+        # path -> (deadline, (size, mtime_ns)) of files waiting to settle
+        self._pending: Dict[str, Tuple[float, Tuple[int, int]]] = {}
+        self._add_watches(root, report_files=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            # ENOSPC - fs.inotify.max_user_watches is reached
+            logging.error(f"Can't watch directory {path}: {os.strerror(errno)}")
+            return
+        self._watches[wd] = path
+
+    def _add_watches(self, root: str, report_files: bool):
+        """
+        :param report_files: files already inside of root are reported as written, e.g. a directory moved into the tree
+        """
+        for dirpath, dirs, files in os.walk(root):
+            # excluded directories are pruned before os.walk reads them
+            dirs[:] = [name for name in dirs
+                       if not walker.is_excluded_dir(os.path.join(dirpath, name), self._exclude_dirs)]
+            self._add_watch(dirpath)
+            if report_files:
+                for name in files:
+                    self._file_written(os.path.join(dirpath, name))
+
+    def _is_supported(self, path: str) -> bool:
+        return os.path.splitext(path)[1] in self._extensions
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+            return stat.st_size, stat.st_mtime_ns
+        except OSError:
+            return None
+
+    def _file_written(self, path: str):
+        if not self._is_supported(path):
+            return
+        stat = self._stat(path)
+        if stat is not None:
+            self._pending[path] = (time.monotonic() + self._settle_seconds, stat)
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & _IN_Q_OVERFLOW:
+            logging.warning("inotify queue overflow, some events are lost")
+            return
+        dir_path = self._watches.get(wd)
+        if dir_path is None:
+            return
+        if mask & (_IN_IGNORED | _IN_DELETE_SELF):
+            self._watches.pop(wd, None)
+            return
+        path = os.path.join(dir_path, name)
+        if mask & _IN_ISDIR:
+            if mask & (_IN_CREATE | _IN_MOVED_TO) and not walker.is_excluded_dir(path, self._exclude_dirs):
+                self._add_watches(path, report_files=True)
+            return
+        if mask & (_IN_DELETE | _IN_MOVED_FROM):
+            self._pending.pop(path, None)
+        elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+            self._file_written(path)
+        elif mask & _IN_MODIFY and path in self._pending:
+            # still being written, wait for the next close
+            self._pending.pop(path)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, _READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            self._handle_event(wd, mask, name)
+
+    def _pop_settled(self) -> List[str]:
+        now = time.monotonic()
+        settled = []
+        for path, (deadline, stat) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            current_stat = self._stat(path)
+            if current_stat is None:
+                self._pending.pop(path)
+            elif current_stat != stat:
+                self._pending[path] = (now + self._settle_seconds, current_stat)
+            else:
+                self._pending.pop(path)
+                settled.append(path)
+        return settled
+
+    def wait_for_files(self, timeout: float = None) -> List[str]:
+        """
+        Block until at least one file is completely written or timeout (seconds) expires
+        :return: paths of completely written files, empty on timeout
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            settled = self._pop_settled()
+            if settled:
+                return settled
+            now = time.monotonic()
+            wait = None
+            if self._pending:
+                wait = max(0.0, min(deadline for deadline, _ in self._pending.values()) - now)
+            if end is not None:
+                if now >= end:
+                    return []
+                wait = end - now if wait is None else min(wait, end - now)
+            readable, _, _ = select.select([self._fd], [], [], wait)
+            if readable:
+                self._read_events()